@@ -0,0 +1,219 @@
+# agregats.py
+# Agrégats 1 min / 15 min / 1 h (nombre, somme, min, max, énergie) par site, maintenus à
+# l'ingestion dans la même transaction que les mesures brutes
+#
+# Reconstruction depuis l'historique brut : python agregats.py reconstruire
+
+import os
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case, delete, select, tuple_
+from sqlalchemy.orm import Session
+
+from models import (
+    Production, Batterie, Consommation,
+    AgregatProduction, AgregatBatterie, AgregatConsommation, AgregatDernierPoint
+)
+
+logger = logging.getLogger(__name__)
+
+AGREGATS_ACTIFS = os.getenv("AGREGATS_ACTIFS", "1") == "1"
+PAS_AGREGATS = (60, 900, 3600)  # s
+ECART_MAX_S = 300  # au-delà (coupure, appareil hors ligne), pas d'énergie intégrée
+SITE_HISTORIQUE = 0  # site_id des agrégats de l'installation historique (NULL dans les tables brutes)
+DIALECTES = ("postgresql", "sqlite")  # INSERT ... ON CONFLICT
+
+MODELES_AGREGATS = {
+    "production": AgregatProduction,
+    "batterie": AgregatBatterie,
+    "consommation": AgregatConsommation,
+}
+
+
+def debut_creneau(timestamp: datetime, pas: int) -> datetime:
+    """Début du créneau de `pas` secondes (diviseur de 3600) contenant timestamp"""
+    secondes = (timestamp.minute * 60 + timestamp.second) // pas * pas
+    return timestamp.replace(minute=secondes // 60, second=secondes % 60, microsecond=0)
+
+
+def site_agregat(site_id: Optional[int]) -> int:
+    return SITE_HISTORIQUE if site_id is None else site_id
+
+
+def _points(lignes: Dict[str, List[Dict]]) -> Dict[Tuple[int, str], List[Tuple]]:
+    """
+    Séries à agréger par (site, série) : (timestamp, valeur agrégée, puissance à intégrer en W, id_charge).
+    Chaque site a ses propres séries : l'énergie n'est jamais intégrée entre deux installations.
+    """
+    points = {}
+    for l in lignes.get("production", []):
+        cle = (site_agregat(l.get("site_id")), "production")
+        points.setdefault(cle, []).append((l["timestamp"], l["production"], l["production"], None))
+    for l in lignes.get("batterie", []):
+        puissance = (l["tension"] or 0) * (l["courant"] or 0)
+        cle = (site_agregat(l.get("site_id")), "batterie")
+        points.setdefault(cle, []).append((l["timestamp"], l["soc"], puissance, None))
+    for l in lignes.get("consommation", []):
+        cle = (site_agregat(l.get("site_id")), f"consommation:{l['id_charge']}")
+        points.setdefault(cle, []).append((l["timestamp"], l["consommation"], l["consommation"], l["id_charge"]))
+    return points
+
+
+def verifier_dialecte(moteur):
+    """Au démarrage : les agrégats reposent sur ON CONFLICT, une autre base est une erreur de configuration"""
+    if AGREGATS_ACTIFS and moteur.dialect.name not in DIALECTES:
+        raise ValueError(f"Agrégats non supportés pour {moteur.dialect.name} ({', '.join(DIALECTES)}) : "
+                         f"définir AGREGATS_ACTIFS=0")
+
+
+def _insert(db: Session):
+    """insert() du dialecte, avec on_conflict_do_update / on_conflict_do_nothing"""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as insert_dialecte
+    else:
+        from sqlalchemy.dialects.sqlite import insert as insert_dialecte
+    return insert_dialecte
+
+
+def _upserter(db: Session, modele, lignes: List[Dict]):
+    """INSERT ... ON CONFLICT : fusionne les cumuls dans les créneaux existants"""
+    table = modele.__table__
+    requete = _insert(db)(table)
+    nouveau = requete.excluded
+    requete = requete.on_conflict_do_update(
+        index_elements=[c.name for c in table.primary_key],
+        set_={
+            "nombre": table.c.nombre + nouveau.nombre,
+            "somme": table.c.somme + nouveau.somme,
+            "minimum": case((nouveau.minimum < table.c.minimum, nouveau.minimum), else_=table.c.minimum),
+            "maximum": case((nouveau.maximum > table.c.maximum, nouveau.maximum), else_=table.c.maximum),
+            "energie_wh": table.c.energie_wh + nouveau.energie_wh,
+        }
+    )
+    db.execute(requete, lignes)
+
+
+def mettre_a_jour(db: Session, lignes: Dict[str, List[Dict]]):
+    """
+    Ajoute des mesures brutes (format ingestion.construire_lignes) aux agrégats, sans commit.
+    L'énergie de l'intervalle [échantillon précédent, échantillon] est comptée dans le créneau
+    de l'échantillon, avec la puissance du précédent. Le dernier point de chaque série est
+    verrouillé (FOR UPDATE) pour que deux workers n'intègrent pas le même intervalle.
+    """
+    points = _points(lignes)
+    if not points:
+        return
+
+    derniers = _verrouiller_derniers_points(db, list(points))
+    manquants = sorted(set(points) - set(derniers))
+    if manquants:
+        # New series: an empty row is inserted first (a concurrent insert of the same series
+        # waits on the key, then does nothing), so both workers lock an existing row
+        db.execute(
+            _insert(db)(AgregatDernierPoint.__table__).on_conflict_do_nothing(),
+            [{"site_id": site_id, "serie": serie, "timestamp": None, "valeur": None} for site_id, serie in manquants]
+        )
+        derniers.update(_verrouiller_derniers_points(db, manquants))
+
+    cumuls: Dict[tuple, List[float]] = {}
+    for site_id, serie in sorted(points):
+        nom = serie.split(":")[0]
+        dernier = derniers[(site_id, serie)]
+        precedent = (dernier.timestamp, dernier.valeur) if dernier.timestamp else None
+
+        for timestamp, valeur, puissance, id_charge in sorted(points[(site_id, serie)], key=lambda p: p[0]):
+            energie = 0.0
+            if precedent:
+                ecart = (timestamp - precedent[0]).total_seconds()
+                if 0 < ecart <= ECART_MAX_S:
+                    energie = precedent[1] * ecart / 3600
+            if precedent is None or timestamp > precedent[0]:
+                precedent = (timestamp, puissance)  # a late sample does not move the cursor back
+
+            for pas in PAS_AGREGATS:
+                cle = (nom, site_id, pas, debut_creneau(timestamp, pas), id_charge)
+                cumul = cumuls.get(cle)
+                if cumul is None:
+                    cumuls[cle] = [1, valeur, valeur, valeur, energie]
+                else:
+                    cumul[0] += 1
+                    cumul[1] += valeur
+                    cumul[2] = min(cumul[2], valeur)
+                    cumul[3] = max(cumul[3], valeur)
+                    cumul[4] += energie
+
+        dernier.timestamp, dernier.valeur = precedent
+
+    par_modele: Dict[str, List[Dict]] = {}
+    # Primary key order: concurrent upserts lock the buckets in the same order
+    for (nom, site_id, pas, debut, id_charge), (nombre, somme, minimum, maximum, energie) in sorted(
+        cumuls.items(), key=lambda c: (c[0][0], c[0][2], c[0][1], c[0][4] or 0, c[0][3])
+    ):
+        ligne = {"pas": pas, "site_id": site_id, "debut": debut, "nombre": nombre, "somme": somme,
+                 "minimum": minimum, "maximum": maximum, "energie_wh": energie}
+        if nom == "consommation":
+            ligne["id_charge"] = id_charge
+        par_modele.setdefault(nom, []).append(ligne)
+
+    db.flush()
+    for nom, valeurs in par_modele.items():
+        _upserter(db, MODELES_AGREGATS[nom], valeurs)
+
+
+def _verrouiller_derniers_points(db: Session, cles: List[Tuple[int, str]]) -> Dict[Tuple[int, str], AgregatDernierPoint]:
+    return {
+        (p.site_id, p.serie): p for p in db.query(AgregatDernierPoint)
+        .filter(tuple_(AgregatDernierPoint.site_id, AgregatDernierPoint.serie).in_(cles))
+        .order_by(AgregatDernierPoint.site_id, AgregatDernierPoint.serie)
+        .with_for_update()
+        .populate_existing()
+    }
+
+
+def combiner_statistiques(lignes: List[Tuple]) -> Dict:
+    """Fusionne des lignes (sum(nombre), sum(somme), min(minimum), max(maximum), sum(energie_wh))"""
+    lignes = [l for l in lignes if l and l[0]]
+    nombre = sum(l[0] for l in lignes)
+    somme = sum(l[1] for l in lignes)
+    return {
+        "nombre": nombre,
+        "moyenne": somme / nombre if nombre else 0,
+        "minimum": min((l[2] for l in lignes), default=0),
+        "maximum": max((l[3] for l in lignes), default=0),
+        "energie_wh": sum(l[4] or 0 for l in lignes),
+    }
+
+
+def reconstruire(taille_lot: int = 20_000):
+    """Recalcule tous les agrégats depuis les tables brutes (bases existantes)"""
+    from database import engine
+
+    with Session(engine) as db:
+        for modele in (*MODELES_AGREGATS.values(), AgregatDernierPoint):
+            db.execute(delete(modele))
+        db.commit()
+
+    sources = {"production": Production, "batterie": Batterie, "consommation": Consommation}
+    with engine.connect() as lecture, Session(engine) as ecriture:
+        for nom, modele in sources.items():
+            colonnes = [c for c in modele.__table__.columns if c.name != "id"]
+            resultat = lecture.execution_options(stream_results=True, yield_per=taille_lot).execute(
+                select(*colonnes).order_by(modele.timestamp, modele.id)
+            )
+            total = 0
+            for lot in resultat.mappings().partitions():
+                mettre_a_jour(ecriture, {nom: [dict(l) for l in lot]})
+                ecriture.commit()
+                total += len(lot)
+            logger.info(f"Agrégats {nom} reconstruits ({total} mesures)")
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["reconstruire"]:
+        reconstruire()
+    else:
+        print("Usage : python agregats.py reconstruire")
@@ -1,54 +1,119 @@
 # api.py
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Header, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, date, time, timedelta
-import requests
-import os
 from gtts import gTTS
-import io
-from pydantic import BaseModel
-from typing import List
+import asyncio
 
-from database import SessionLocal, engine, get_db, Base
-from models import Charge, Consommation, Production, Batterie, Calendrier, Decision, Utilisateur
+import database
+from database import SessionLocal, engine, get_db, DB_MODE, etat_pool
+from schemas import MesuresData, LotMesures
+from models import Charge, Calendrier, Site
 from optimiseur_robuste import OptimiseurRobuste
-from solcast_manager import GestionnaireSolcast
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
+from cache_commandes import CacheCommandes
+from diffusion_commandes import diffuseur
+from migrations import preparer_base
+from export import flux_export, TABLES_EXPORT, FORMATS
+from requetes import (
+    executer, requetes_dernieres_mesures, formater_dernieres_mesures, requetes_tendances,
+    formater_tendances, requetes_historique_charge, formater_historique_charge, fenetre_serie,
+    completer_tendances, completer_historique_charge
+)
+from ingestion import (
+    enregistrer_mesures, construire_lignes, tampon, TamponPlein, INGESTION_MODE, references, ReferenceInconnue
+)
+from solcast_manager import get_gestionnaire_solcast
+from etat_courant import etat_courant
+import planificateur_previsions
+import agregats
+import archivage
+import partitionnement
+import optimisation_flotte
+import metriques
+
+# Create missing tables; columns and indexes of an existing database: python migrations.py
+preparer_base(engine)
+# Rollups need an upsert: refuse to start on a database that has none rather than fail every batch
+agregats.verifier_dialecte(engine)
 
 app = FastAPI(title="AI Repert API", description="API pour le système de relais intelligent")
 
-# Initialize robust optimizer
-optimiseur_robuste = OptimiseurRobuste()
+# Async routes are registered first so they take precedence over the sync ones below
+if DB_MODE == "async":
+    from api_async import routeur as routeur_async
+    app.include_router(routeur_async)
 
+# Per-route latency and SQL queries per request (GET /metrics)
+app.add_middleware(metriques.MiddlewareMetriques)
 
-class ConsommationData(BaseModel):
-    charge_id: int
-    consommation: float
+# Initialize robust optimizer
+optimiseur_robuste = OptimiseurRobuste()
+cache_commandes = CacheCommandes(optimiseur_robuste)
 
-class MesuresData(BaseModel):
-    production: float
-    soc_batterie: float
-    tension_batterie: float
-    courant_batterie: float
-    consommations: List[ConsommationData]
+def verifier_commandes():
+    """Recalcule les commandes si leurs entrées ont changé (appelé par le diffuseur SSE)"""
+    db = SessionLocal()
+    try:
+        cache_commandes.obtenir(db, etat_courant.contexte_optimisation(), etat_courant.instantane()["charges"])
+    finally:
+        db.close()
+
+# Push every new command version to the SSE clients
+cache_commandes.abonner(diffuseur.publier)
+diffuseur.verifier = verifier_commandes
+
+# Keep the optional etat_courant mirror row in the same transaction as the measurements
+tampon.avant_commit = etat_courant.ecrire_miroir
+
+# Repair the horizon schedule when a measurement deviates from it, on a worker thread
+# (never on the request path, nor on the event loop in DB_MODE=async)
+etat_courant.abonner(optimiseur_robuste.horizon.signaler_mesure)
+
+@app.on_event("startup")
+async def demarrer_taches_fond():
+    """Rafraîchissement des prévisions Solcast et écriture groupée des mesures hors du chemin des requêtes"""
+    planificateur_previsions.demarrer()
+    archivage.demarrer()
+    partitionnement.demarrer()
+    diffuseur.demarrer()
+    if INGESTION_MODE == "tampon":
+        tampon.demarrer()
+
+@app.on_event("shutdown")
+async def arreter_taches_fond():
+    await planificateur_previsions.arreter()
+    await archivage.arreter()
+    await partitionnement.arreter()
+    await diffuseur.arreter()
+    # Drain pending measurements before the worker exits
+    await asyncio.to_thread(tampon.arreter)
+    await asyncio.to_thread(optimisation_flotte.arreter_pool)
+    await asyncio.to_thread(metriques.profileur.arreter)
 
 # Endpoints for charges
 @app.get("/charges/", response_model=List[dict])
 def get_charges(db: Session = Depends(get_db)):
     """Récupérer toutes les charges"""
     charges = db.query(Charge).all()
-    return [{"id": c.id, "nom": c.nom, "type": c.type, "puissance_nominale": c.puissance_nominale, "etat": c.etat} for c in charges]
+    return [{"id": c.id, "nom": c.nom, "type": c.type, "puissance_nominale": c.puissance_nominale, "etat": c.etat,
+             "site_id": c.site_id} for c in charges]
 
 @app.post("/charges/")
-def create_charge(nom: str, type: str, puissance_nominale: float, db: Session = Depends(get_db)):
-    """Créer une nouvelle charge"""
-    charge = Charge(nom=nom, type=type, puissance_nominale=puissance_nominale)
+def create_charge(nom: str, type: str, puissance_nominale: float, site_id: Optional[int] = None,
+                  db: Session = Depends(get_db)):
+    """Créer une nouvelle charge (site_id : installation de la flotte, absent pour l'installation historique)"""
+    if site_id is not None and db.get(Site, site_id) is None:
+        raise HTTPException(status_code=404, detail="Site non trouvé")
+    charge = Charge(nom=nom, type=type, puissance_nominale=puissance_nominale, site_id=site_id)
     db.add(charge)
     db.commit()
     db.refresh(charge)
+    etat_courant.maj_charge(charge)
+    cache_commandes.invalider()
+    optimiseur_robuste.horizon.invalider()
+    diffuseur.signaler()
     return {"id": charge.id, "nom": charge.nom, "type": charge.type}
 
 @app.put("/charges/{charge_id}/etat")
@@ -59,106 +124,250 @@ def update_charge_state(charge_id: int, etat: bool, db: Session = Depends(get_db
         raise HTTPException(status_code=404, detail="Charge non trouvée")
     charge.etat = etat
     db.commit()
+    etat_courant.maj_charge(charge)
+    cache_commandes.invalider()
+    optimiseur_robuste.horizon.invalider()
+    diffuseur.signaler()
     return {"id": charge.id, "etat": charge.etat}
 
 # Endpoints for measurements (Arduino)
+def verifier_references(echantillons):
+    """Refuse avant tout dépôt un échantillon qui cite une charge ou un site inconnu"""
+    try:
+        references.verifier(echantillons)
+    except ReferenceInconnue as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
 @app.post("/mesures")
 @app.post("/mesures/")
 def receive_measurements(data: MesuresData, db: Session = Depends(get_db)):
     """Recevoir les mesures d'Arduino"""
-    # Save production
-    prod = Production(production=data.production, timestamp=datetime.now())
-    db.add(prod)
-    
-    # Save battery state
-    bat = Batterie(
-        soc=data.soc_batterie, 
-        tension=data.tension_batterie, 
-        courant=data.courant_batterie, 
-        timestamp=datetime.now()
-    )
-    db.add(bat)
-    
-    # Save consumptions
-    for cons in data.consommations:
-        conso = Consommation(
-            id_charge=cons.charge_id,
-            consommation=cons.consommation,
-            timestamp=datetime.now()
-        )
-        db.add(conso)
-    
-    db.commit()
+    verifier_references([data])
+    # The snapshot and SSE clients only see samples that were buffered or written
+    if INGESTION_MODE == "tampon" and tampon.actif:
+        # Acknowledge right away, rows are written by the group-commit thread
+        try:
+            tampon.ajouter(construire_lignes([data]))
+        except TamponPlein as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        etat_courant.enregistrer_echantillons([data])
+        diffuseur.signaler()
+        return {"message": "Mesures reçues", "status": "success"}
+    enregistrer_mesures(db, [data], avant_commit=etat_courant.avant_commit_mesures([data]))
+    etat_courant.enregistrer_echantillons([data])
+    diffuseur.signaler()
     return {"message": "Mesures enregistrées", "status": "success"}
 
+@app.post("/mesures/lot/")
+def receive_measurements_batch(lot: LotMesures, db: Session = Depends(get_db)):
+    """Recevoir un lot d'échantillons horodatés (un INSERT multi-lignes par table)"""
+    if not lot.echantillons:
+        raise HTTPException(status_code=422, detail="Lot vide")
+    verifier_references(lot.echantillons)
+    resultat = enregistrer_mesures(db, lot.echantillons, avant_commit=etat_courant.avant_commit_mesures(lot.echantillons))
+    etat_courant.enregistrer_echantillons(lot.echantillons)
+    diffuseur.signaler()
+    return {"message": "Lot enregistré", "status": "success", **resultat}
+
 @app.get("/commandes/")
-def get_commands(db: Session = Depends(get_db)):
+def get_commands(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Récupérer les commandes pour Arduino (optimisation robuste)"""
-    # Get current context
-    derniere_production = db.query(Production).order_by(Production.timestamp.desc()).first()
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    
-    contexte = {
-        "production_actuelle": derniere_production.production if derniere_production else 0,
-        "soc_batterie": derniere_batterie.soc if derniere_batterie else 0,
-        "evenement_special": False  # To be implemented with calendar
-    }
+    # Get current context (in-memory snapshot, no history query)
+    instantane = etat_courant.instantane()
+    contexte = etat_courant.contexte_optimisation()
     
-    # Run robust optimization
-    resultat = optimiseur_robuste.optimiser_complet(db, contexte)
+    # Cached commands, re-optimised only when the inputs changed
+    commandes = cache_commandes.obtenir(db, contexte, instantane["charges"])
+    etag = f'"{commandes["version"]}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     
     return {
-        "charges": resultat["decisions"],
-        "strategie": resultat["strategie"]["nom"],
-        "score": resultat["strategie"]["score"],
-        "alerte": resultat["alerte_vocale"],
+        "charges": commandes["charges"],
+        "strategie": commandes["strategie"],
+        "score": commandes["score"],
+        "alerte": commandes["alerte"],
+        "version": commandes["version"],
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/commandes/flux/")
+async def stream_commands(last_event_id: Optional[str] = Header(None)):
+    """
+    Flux Server-Sent Events des commandes : un événement par nouvelle version,
+    limité aux charges modifiées. Reprise sans perte avec Last-Event-ID.
+    """
+    return StreamingResponse(
+        diffuseur.flux(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Endpoints for dashboard
 @app.get("/dashboard/")
-def get_dashboard_data(db: Session = Depends(get_db)):
+def get_dashboard_data():
     """Données pour le tableau de bord"""
-    # Latest production
-    derniere_production = db.query(Production).order_by(Production.timestamp.desc()).first()
-    
-    # Latest battery state
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    
-    # Current charges
-    charges = db.query(Charge).all()
+    # Latest production, battery state and charges from the in-memory snapshot
+    instantane = etat_courant.instantane()
     
     return {
-        "production_actuelle": derniere_production.production if derniere_production else 0,
-        "soc_batterie": derniere_batterie.soc if derniere_batterie else 0,
-        "charges": [{"id": c.id, "nom": c.nom, "type": c.type, "etat": c.etat} for c in charges]
+        "production_actuelle": instantane["production_actuelle"],
+        "soc_batterie": instantane["soc_batterie"],
+        "charges": [{"id": c["id"], "nom": c["nom"], "type": c["type"], "etat": c["etat"]} for c in instantane["charges"]]
     }
 
 # Endpoint for weather forecast (Solcast) - Enhanced version
 @app.get("/meteo/")
 def get_weather_forecast():
-    solcast_manager = GestionnaireSolcast()
-    return solcast_manager.get_previsions_demain()
+    solcast_manager = get_gestionnaire_solcast()
+    return solcast_manager.lire_previsions()
 
 # New endpoint for robust optimization
 @app.post("/optimisation_robuste/")
 def optimisation_robuste(db: Session = Depends(get_db)):
     """Lancer l'optimisation robuste complète"""
-    # Get current context
-    derniere_production = db.query(Production).order_by(Production.timestamp.desc()).first()
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    
-    contexte = {
-        "production_actuelle": derniere_production.production if derniere_production else 0,
-        "soc_batterie": derniere_batterie.soc if derniere_batterie else 0,
-        "evenement_special": False
-    }
+    # Get current context (in-memory snapshot, no history query)
+    contexte = etat_courant.contexte_optimisation()
     
     # Run robust optimization
     resultat = optimiseur_robuste.optimiser_complet(db, contexte)
     
     return resultat
 
+# Endpoints for the per-slot schedule over the forecast horizon
+@app.get("/planning/")
+def get_planning(db: Session = Depends(get_db)):
+    """Planning marche/arrêt par charge sur les créneaux de 30 min des prévisions"""
+    return optimiseur_robuste.planifier_horizon(db, etat_courant.contexte_optimisation())
+
+@app.get("/planning/probabiliste/")
+def get_planning_probabiliste(db: Session = Depends(get_db)):
+    """Planning évalué sur des scénarios de production P10-P90, avec le risque de passer sous batterie_securite"""
+    return optimiseur_robuste.planifier_scenarios(db, etat_courant.contexte_optimisation())
+
+@app.post("/planning/recalculer/")
+def recalculer_planning(db: Session = Depends(get_db)):
+    """Forcer le recalcul du planning"""
+    return optimiseur_robuste.planifier_horizon(db, etat_courant.contexte_optimisation(), forcer=True)
+
+# Endpoints for the fleet of sites
+@app.get("/sites/")
+def get_sites(db: Session = Depends(get_db)):
+    """Installations de la flotte"""
+    return [{"id": s.id, "nom": s.nom, "solcast_site_id": s.solcast_site_id,
+             "capacite_batterie_kwh": s.capacite_batterie_kwh, "puissance_batterie_kw": s.puissance_batterie_kw}
+            for s in db.query(Site).order_by(Site.id).all()]
+
+@app.post("/sites/")
+def create_site(nom: str, solcast_site_id: Optional[str] = None, capacite_batterie_kwh: Optional[float] = None,
+                puissance_batterie_kw: Optional[float] = None, db: Session = Depends(get_db)):
+    """Déclarer une installation (batterie par défaut : BATTERIE_CAPACITE_KWH / BATTERIE_PUISSANCE_MAX_KW)"""
+    site = Site(nom=nom, solcast_site_id=solcast_site_id, capacite_batterie_kwh=capacite_batterie_kwh,
+                puissance_batterie_kw=puissance_batterie_kw)
+    db.add(site)
+    db.commit()
+    db.refresh(site)
+    return {"id": site.id, "nom": site.nom, "solcast_site_id": site.solcast_site_id}
+
+@app.post("/optimisation_flotte/")
+def optimiser_flotte(db: Session = Depends(get_db)):
+    """Replanifier tous les sites en une passe (pool de processus), avec les temps par site"""
+    return optimisation_flotte.optimiser_flotte(db, optimiseur_robuste.seuils)
+
+@app.get("/optimisation_flotte/")
+def get_bilan_flotte():
+    """Bilan de la dernière passe sur la flotte"""
+    bilan = optimisation_flotte.dernier_bilan()
+    if bilan is None:
+        raise HTTPException(status_code=404, detail="Aucune optimisation de flotte effectuée")
+    return bilan
+
+@app.get("/sites/{site_id}/planning/")
+def get_planning_site(site_id: int):
+    """Dernier planning calculé pour un site par /optimisation_flotte/"""
+    plan = optimisation_flotte.plan_site(site_id)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Pas de planning pour ce site")
+    return plan
+
+@app.get("/statistiques_planning/")
+def get_planning_statistics():
+    """Nombre et durée des résolutions complètes et des réparations incrémentales du planning"""
+    return optimiseur_robuste.horizon.get_statistiques()
+
+# Endpoint for ingestion buffer statistics
+@app.get("/statistiques_ingestion/")
+def get_ingestion_statistics():
+    """Récupérer l'état du tampon d'écriture des mesures"""
+    return {"mode": INGESTION_MODE, **tampon.get_statistiques()}
+
+# Endpoint for connection pool metrics
+@app.get("/metriques/pool/")
+def get_pool_metrics():
+    """Connexions prises / libres et temps d'attente du pool de connexions"""
+    metriques = {"sync": etat_pool(engine)}
+    if database.async_engine is not None:
+        metriques["async"] = etat_pool(database.async_engine.sync_engine)
+    return metriques
+
+# State read at scrape time (GET /metrics)
+def _quota_solcast() -> Optional[dict]:
+    gestionnaire = optimiseur_robuste.solcast_manager
+    if gestionnaire is None:
+        return None
+    return {"utilises": gestionnaire.appels_aujourd_hui,
+            "restants": gestionnaire.limite_appels_quotidien - gestionnaire.appels_aujourd_hui}
+
+metriques.Calculee("solcast_appels_jour", "Appels Solcast du jour (quota partagé entre workers)",
+                   _quota_solcast, ("etat",))
+metriques.Calculee("ingestion_tampon_lignes_en_attente", "Lignes dans le tampon d'ingestion",
+                   lambda: tampon.get_statistiques()["en_attente"])
+metriques.Calculee("ingestion_tampon_refus_total", "Dépôts refusés, tampon plein",
+                   lambda: tampon.stats["refus"], type_="counter")
+metriques.Calculee("db_pool_connexions", "Connexions du pool par état",
+                   lambda: {("prises",): engine.pool.checkedout(), ("libres",): engine.pool.checkedin()}, ("etat",))
+metriques.Calculee("db_pool_timeouts_total", "Attentes de connexion abandonnées",
+                   lambda: engine.statistiques_pool.timeouts, type_="counter")
+
+@app.get("/metrics", include_in_schema=False)
+def exposer_metriques():
+    """Métriques du worker au format texte de Prometheus"""
+    return Response(metriques.exposer(), media_type=metriques.TYPE_CONTENU)
+
+# Sampling profiler, switchable at runtime (PROFILAGE_AUTORISE=1)
+@app.get("/profilage/")
+def get_profilage():
+    """État du profileur de ce worker"""
+    return {"autorise": metriques.PROFILAGE_AUTORISE, **metriques.profileur.etat()}
+
+@app.post("/profilage/")
+def piloter_profilage(actif: bool, intervalle_ms: float = metriques.PROFILAGE_INTERVALLE_MS,
+                      duree_max_s: float = metriques.PROFILAGE_DUREE_MAX_S):
+    """Démarre (piles remises à zéro) ou arrête l'échantillonnage des piles de ce worker"""
+    if not metriques.PROFILAGE_AUTORISE:
+        raise HTTPException(status_code=403, detail="Profilage désactivé (PROFILAGE_AUTORISE=1)")
+    if actif:
+        metriques.profileur.demarrer(intervalle_ms, duree_max_s)
+    else:
+        metriques.profileur.arreter()
+    return metriques.profileur.etat()
+
+@app.get("/profilage/piles/")
+def get_piles_profilage():
+    """Piles échantillonnées au format "collapsed" (flamegraph.pl, speedscope)"""
+    return Response(metriques.profileur.piles(), media_type="text/plain; charset=utf-8")
+
+# Endpoint for command cache statistics
+@app.get("/statistiques_commandes/")
+def get_commands_statistics():
+    """Récupérer les statistiques du cache de commandes (recalculs / réponses en cache)"""
+    return {**cache_commandes.get_statistiques(), "flux": diffuseur.get_statistiques()}
+
 # Endpoint for Solcast statistics
 @app.get("/statistiques_solcast/")
 def get_solcast_statistics():
@@ -197,6 +406,9 @@ def add_calendar_event(
     )
     db.add(event)
     db.commit()
+    cache_commandes.invalider()
+    optimiseur_robuste.horizon.invalider()
+    diffuseur.signaler()
     return {"message": "Événement ajouté"}
 
 @app.get("/calendrier/")
@@ -214,33 +426,25 @@ def get_calendar_events(db: Session = Depends(get_db)):
 
 # Endpoint for trend analysis
 @app.get("/tendances/")
-def analyser_tendances(db: Session = Depends(get_db)):
-    """Analyser les tendances de consommation et production"""
-    # Last 24 hours of data
-    maintenant = datetime.now()
-    hier = maintenant.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # Production in the last 24 hours
-    productions = db.query(Production).filter(
-        Production.timestamp >= hier
-    ).all()
-    
-    # Consumptions in the last 24 hours
-    consommations = db.query(Consommation).filter(
-        Consommation.timestamp >= hier
-    ).all()
-    
-    # Calculate averages
-    prod_moyenne = sum(p.production for p in productions) / len(productions) if productions else 0
-    conso_moyenne = sum(c.consommation for c in consommations) / len(consommations) if consommations else 0
-    
-    return {
-        "production_moyenne_24h": prod_moyenne,
-        "consommation_moyenne_24h": conso_moyenne,
-        "efficacite": (prod_moyenne / conso_moyenne * 100) if conso_moyenne > 0 else 0,
-        "nombre_mesures_production": len(productions),
-        "nombre_mesures_consommation": len(consommations)
-    }
+def analyser_tendances(
+    debut: Optional[datetime] = None,
+    fin: Optional[datetime] = None,
+    pas: Optional[int] = None,
+    site_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Analyser les tendances de consommation et production (série agrégée par créneaux de `pas` secondes)
+    d'un site de la flotte, de l'installation historique par défaut
+    """
+    # Since midnight by default
+    minuit = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        debut, fin, pas = fenetre_serie(debut, fin, pas, minuit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    resultats = completer_tendances(executer(db, requetes_tendances(debut, fin, pas, site_id)), debut, fin, pas, site_id)
+    return formater_tendances(resultats, debut, fin, pas)
 
 @app.post("/forcer_charges/")
 def forcer_charges(
@@ -251,11 +455,10 @@ def forcer_charges(
     Permet à l'utilisateur de forcer l'activation/coupure de charges.
     Retourne une alerte si l'énergie disponible ne suffira pas.
     """
-    solcast_manager = GestionnaireSolcast()
-    previsions = solcast_manager.get_previsions_demain()
+    solcast_manager = get_gestionnaire_solcast()
+    previsions = solcast_manager.lire_previsions()
     production_totale = sum(p["pv_estimate"] for p in previsions["previsions"])
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    soc_batterie = derniere_batterie.soc if derniere_batterie else 0
+    soc_batterie = etat_courant.instantane()["soc_batterie"]
     capacite_batterie = 10  # kWh, adjust according to the actual system
 
     # Calculate total consumption of forced charges
@@ -282,11 +485,9 @@ def forcer_prevision():
     """
     Force la mise à jour de la prévision IA si le quota le permet.
     """
-    solcast_manager = GestionnaireSolcast()
+    solcast_manager = get_gestionnaire_solcast()
     if solcast_manager.peut_appeler_api():
-        previsions = solcast_manager._appel_api_demain()
-        solcast_manager._mettre_a_jour_cache(previsions)
-        solcast_manager.appels_aujourd_hui += 1
+        solcast_manager.rafraichir_previsions()
         return {"message": "Prévision mise à jour", "appels_restants": solcast_manager.limite_appels_quotidien - solcast_manager.appels_aujourd_hui}
     else:
         return {"message": "Quota d'appels atteint, prévision non rafraîchie", "appels_restants": 0}
@@ -303,8 +504,7 @@ def anticipation_batterie(
     """
     # Get battery capacity and current SOC
     capacite_batterie = 10_000  # Wh (10 kWh, adjust according to the actual system)
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    soc_batterie = derniere_batterie.soc if derniere_batterie else 0
+    soc_batterie = etat_courant.instantane()["soc_batterie"]
     energie_disponible = capacite_batterie * soc_batterie / 100
 
     # Get selected charges
@@ -335,118 +535,86 @@ def anticipation_batterie(
     }
 
 @app.get("/mesures/dernieres/")
-def get_latest_measurements(limit: int = 10, db: Session = Depends(get_db)):
-    """Récupérer les dernières mesures reçues"""
-    # Latest productions
-    productions = db.query(Production).order_by(Production.timestamp.desc()).limit(limit).all()
-    
-    # Latest battery states
-    batteries = db.query(Batterie).order_by(Batterie.timestamp.desc()).limit(limit).all()
-    
-    # Latest consumptions
-    consommations = db.query(Consommation).order_by(Consommation.timestamp.desc()).limit(limit).all()
-    
-    return {
-        "productions": [{
-            "id": p.id,
-            "production": p.production,
-            "timestamp": p.timestamp.isoformat()
-        } for p in productions],
-        "batteries": [{
-            "id": b.id,
-            "soc": b.soc,
-            "tension": b.tension,
-            "courant": b.courant,
-            "timestamp": b.timestamp.isoformat()
-        } for b in batteries],
-        "consommations": [{
-            "id": c.id,
-            "charge_id": c.id_charge,
-            "consommation": c.consommation,
-            "timestamp": c.timestamp.isoformat()
-        } for c in consommations]
-    }
+def get_latest_measurements(limit: int = 10, site_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """Récupérer les dernières mesures reçues (installation historique par défaut)"""
+    return formater_dernieres_mesures(executer(db, requetes_dernieres_mesures(limit, site_id)))
+
+@app.get("/export/{table}/")
+def export_history(
+    table: str,
+    format: str = "ndjson",
+    debut: Optional[datetime] = None,
+    fin: Optional[datetime] = None,
+    apres_timestamp: Optional[datetime] = None,
+    apres_id: Optional[int] = None
+):
+    """
+    Exporter en flux l'historique d'une table (production, batterie, consommation, decisions).
+    Reprise d'un export interrompu avec apres_timestamp / apres_id de la dernière ligne reçue.
+    """
+    if table not in TABLES_EXPORT:
+        raise HTTPException(status_code=404, detail=f"Table inconnue: {table}")
+    if format not in FORMATS:
+        raise HTTPException(status_code=422, detail=f"Format non supporté: {format}")
+    if (apres_timestamp is None) != (apres_id is None):
+        raise HTTPException(status_code=422, detail="apres_timestamp et apres_id vont ensemble")
+
+    apres = (apres_timestamp, apres_id) if apres_timestamp is not None else None
+    return StreamingResponse(
+        flux_export(table, format, debut=debut, fin=fin, apres=apres),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    )
 
 @app.get("/mesures/temps_reel/")
-def get_realtime_measurements(db: Session = Depends(get_db)):
+def get_realtime_measurements():
     """Récupérer les mesures des 60 dernières secondes"""
-    maintenant = datetime.now()
-    il_y_a_une_minute = maintenant - timedelta(minutes=1)
-    
-    # Productions in the last minute
-    productions = db.query(Production).filter(
-        Production.timestamp >= il_y_a_une_minute
-    ).order_by(Production.timestamp.desc()).all()
-    
-    # Battery states in the last minute
-    batteries = db.query(Batterie).filter(
-        Batterie.timestamp >= il_y_a_une_minute
-    ).order_by(Batterie.timestamp.desc()).all()
-    
-    # Consumptions in the last minute by charge
-    consommations = db.query(Consommation).filter(
-        Consommation.timestamp >= il_y_a_une_minute
-    ).order_by(Consommation.timestamp.desc()).all()
+    # Served from the in-memory snapshot, without touching the history tables
+    instantane = etat_courant.instantane()
+    recentes = etat_courant.mesures_recentes()
+    batterie = instantane["batterie"] if recentes else None
     
     # Group consumptions by charge
     consommations_par_charge = {}
-    for c in consommations:
-        if c.id_charge not in consommations_par_charge:
-            consommations_par_charge[c.id_charge] = []
-        consommations_par_charge[c.id_charge].append({
-            "consommation": c.consommation,
-            "timestamp": c.timestamp.isoformat()
-        })
+    nombre_consommations = 0
+    for timestamp, _, _, consommations in recentes:
+        for charge_id, consommation in consommations.items():
+            consommations_par_charge.setdefault(charge_id, []).append({
+                "consommation": consommation,
+                "timestamp": timestamp.isoformat()
+            })
+            nombre_consommations += 1
     
     return {
         "periode": "60 dernières secondes",
-        "production_actuelle": productions[0].production if productions else 0,
+        "production_actuelle": instantane["production_actuelle"] if recentes else 0,
         "batterie_actuelle": {
-            "soc": batteries[0].soc if batteries else 0,
-            "tension": batteries[0].tension if batteries else 0,
-            "courant": batteries[0].courant if batteries else 0
+            "soc": batterie["soc"] if batterie else 0,
+            "tension": batterie["tension"] if batterie else 0,
+            "courant": batterie["courant"] if batterie else 0
         },
         "consommations_par_charge": consommations_par_charge,
         "total_mesures": {
-            "productions": len(productions),
-            "batteries": len(batteries),
-            "consommations": len(consommations)
+            "productions": len(recentes),
+            "batteries": len(recentes),
+            "consommations": nombre_consommations
         }
     }
 
 @app.get("/mesures/charge/{charge_id}/")
-def get_charge_history(charge_id: int, heures: int = 24, db: Session = Depends(get_db)):
-    """Récupérer l'historique de consommation d'une charge"""
-    maintenant = datetime.now()
-    debut_periode = maintenant - timedelta(hours=heures)
-    
-    consommations = db.query(Consommation).filter(
-        Consommation.id_charge == charge_id,
-        Consommation.timestamp >= debut_periode
-    ).order_by(Consommation.timestamp.desc()).all()
-    
-    # Statistics
-    if consommations:
-        consommations_values = [c.consommation for c in consommations]
-        moyenne = sum(consommations_values) / len(consommations_values)
-        maximum = max(consommations_values)
-        minimum = min(consommations_values)
-        total_energie = sum(consommations_values) * (5 / 3600)  # Wh (measurements every 5s)
-    else:
-        moyenne = maximum = minimum = total_energie = 0
-    
-    return {
-        "charge_id": charge_id,
-        "periode_heures": heures,
-        "statistiques": {
-            "moyenne_watts": round(moyenne, 2),
-            "maximum_watts": maximum,
-            "minimum_watts": minimum,
-            "energie_totale_wh": round(total_energie, 2),
-            "nombre_mesures": len(consommations)
-        },
-        "historique": [{
-            "consommation": c.consommation,
-            "timestamp": c.timestamp.isoformat()
-        } for c in consommations[:100]]  # Limit to 100 measurements for display
-    }
\ No newline at end of file
+def get_charge_history(
+    charge_id: int,
+    heures: int = 24,
+    debut: Optional[datetime] = None,
+    fin: Optional[datetime] = None,
+    pas: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Récupérer l'historique de consommation d'une charge (les `heures` dernières par défaut)"""
+    try:
+        debut, fin, pas = fenetre_serie(debut, fin, pas, (fin or datetime.now()) - timedelta(hours=heures))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    resultats = executer(db, requetes_historique_charge(charge_id, debut, fin, pas))
+    resultats = completer_historique_charge(resultats, charge_id, debut, fin, pas)
+    return formater_historique_charge(charge_id, debut, fin, pas, resultats)
\ No newline at end of file
@@ -0,0 +1,138 @@
+# api_async.py
+# Versions async (DB_MODE=async) des routes d'ingestion, de tableau de bord et d'historique.
+# Incluses par api.py avant les routes sync, qu'elles remplacent alors.
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import get_async_db
+from schemas import MesuresData, LotMesures
+from etat_courant import etat_courant
+from diffusion_commandes import diffuseur
+from ingestion import (
+    enregistrer_mesures_async, construire_lignes, tampon, TamponPlein, INGESTION_MODE, references, ReferenceInconnue
+)
+from requetes import (
+    executer_async, requetes_dernieres_mesures, formater_dernieres_mesures, requetes_tendances,
+    formater_tendances, requetes_historique_charge, formater_historique_charge, fenetre_serie,
+    completer_tendances, completer_historique_charge
+)
+
+routeur = APIRouter()
+
+
+async def _etat_courant_a_jour():
+    """La première lecture (ou la resynchronisation du miroir) passe par la base sync : hors de la boucle"""
+    if not etat_courant.est_a_jour():
+        await run_in_threadpool(etat_courant.synchroniser)
+
+
+async def _verifier_references(echantillons):
+    """Identifiants déjà connus : vérifiés en mémoire ; sinon la relecture des tables se fait hors de la boucle"""
+    if references.connues(echantillons):
+        return
+    try:
+        await run_in_threadpool(references.verifier, echantillons)
+    except ReferenceInconnue as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+# Endpoints for measurements (Arduino)
+@routeur.post("/mesures")
+@routeur.post("/mesures/")
+async def receive_measurements(data: MesuresData, db: AsyncSession = Depends(get_async_db)):
+    """Recevoir les mesures d'Arduino"""
+    await _verifier_references([data])
+    # The snapshot and SSE clients only see samples that were buffered or written
+    if INGESTION_MODE == "tampon" and tampon.actif:
+        lignes = construire_lignes([data])
+        try:
+            tampon.ajouter(lignes, attente_max_s=0)
+        except TamponPlein:
+            # Buffer full: wait for room in a worker thread, never on the event loop
+            try:
+                await run_in_threadpool(tampon.ajouter, lignes)
+            except TamponPlein as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        etat_courant.enregistrer_echantillons([data])
+        diffuseur.signaler()
+        return {"message": "Mesures reçues", "status": "success"}
+    await enregistrer_mesures_async(db, [data], avant_commit=etat_courant.avant_commit_mesures([data]))
+    etat_courant.enregistrer_echantillons([data])
+    diffuseur.signaler()
+    return {"message": "Mesures enregistrées", "status": "success"}
+
+@routeur.post("/mesures/lot/")
+async def receive_measurements_batch(lot: LotMesures, db: AsyncSession = Depends(get_async_db)):
+    """Recevoir un lot d'échantillons horodatés (un INSERT multi-lignes par table)"""
+    if not lot.echantillons:
+        raise HTTPException(status_code=422, detail="Lot vide")
+    await _verifier_references(lot.echantillons)
+    resultat = await enregistrer_mesures_async(db, lot.echantillons,
+                                               avant_commit=etat_courant.avant_commit_mesures(lot.echantillons))
+    etat_courant.enregistrer_echantillons(lot.echantillons)
+    diffuseur.signaler()
+    return {"message": "Lot enregistré", "status": "success", **resultat}
+
+# Endpoints for dashboard
+@routeur.get("/dashboard/")
+async def get_dashboard_data():
+    """Données pour le tableau de bord"""
+    await _etat_courant_a_jour()
+    instantane = etat_courant.instantane()
+
+    return {
+        "production_actuelle": instantane["production_actuelle"],
+        "soc_batterie": instantane["soc_batterie"],
+        "charges": [{"id": c["id"], "nom": c["nom"], "type": c["type"], "etat": c["etat"]} for c in instantane["charges"]]
+    }
+
+# Endpoints for history
+@routeur.get("/tendances/")
+async def analyser_tendances(
+    debut: Optional[datetime] = None,
+    fin: Optional[datetime] = None,
+    pas: Optional[int] = None,
+    site_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Analyser les tendances de consommation et production (série agrégée par créneaux de `pas` secondes)
+    d'un site de la flotte, de l'installation historique par défaut
+    """
+    minuit = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        debut, fin, pas = fenetre_serie(debut, fin, pas, minuit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    resultats = await executer_async(db, requetes_tendances(debut, fin, pas, site_id))
+    resultats = await run_in_threadpool(completer_tendances, resultats, debut, fin, pas, site_id)
+    return formater_tendances(resultats, debut, fin, pas)
+
+@routeur.get("/mesures/dernieres/")
+async def get_latest_measurements(limit: int = 10, site_id: Optional[int] = None,
+                                  db: AsyncSession = Depends(get_async_db)):
+    """Récupérer les dernières mesures reçues (installation historique par défaut)"""
+    return formater_dernieres_mesures(await executer_async(db, requetes_dernieres_mesures(limit, site_id)))
+
+@routeur.get("/mesures/charge/{charge_id}/")
+async def get_charge_history(
+    charge_id: int,
+    heures: int = 24,
+    debut: Optional[datetime] = None,
+    fin: Optional[datetime] = None,
+    pas: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Récupérer l'historique de consommation d'une charge (les `heures` dernières par défaut)"""
+    try:
+        debut, fin, pas = fenetre_serie(debut, fin, pas, (fin or datetime.now()) - timedelta(hours=heures))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    resultats = await executer_async(db, requetes_historique_charge(charge_id, debut, fin, pas))
+    resultats = await run_in_threadpool(completer_historique_charge, resultats, charge_id, debut, fin, pas)
+    return formater_historique_charge(charge_id, debut, fin, pas, resultats)
@@ -1,12 +1,13 @@
 from fastapi import FastAPI, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from api import app as api_routes
+from api import app as api_routes, demarrer_taches_fond, arreter_taches_fond
 from database import Base, engine, SessionLocal
 from models import Charge
 from sqlalchemy.orm import Session
 from fastapi import Request
 from models import Charge, Consommation, Production, Batterie, Calendrier, Decision, Utilisateur
+from etat_courant import etat_courant
 
 
 
@@ -62,22 +63,24 @@ def create_initial_charges():
     finally:
         db.close()
 
+# Mounted sub-applications do not receive lifespan events: start the API background tasks here
+app.add_event_handler("startup", demarrer_taches_fond)
+app.add_event_handler("shutdown", arreter_taches_fond)
+
 # Create database tables
 Base.metadata.create_all(bind=engine)
 
 @app.get("/")
-def read_root(request: Request, db: Session = Depends(get_db)):
+def read_root(request: Request):
     """Render the dashboard"""
-    # Get dashboard data
-    derniere_production = db.query(Production).order_by(Production.timestamp.desc()).first()
-    derniere_batterie = db.query(Batterie).order_by(Batterie.timestamp.desc()).first()
-    charges = db.query(Charge).all()
+    # Get dashboard data from the in-memory snapshot
+    instantane = etat_courant.instantane()
     
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
-        "production_actuelle": derniere_production.production if derniere_production else 0,
-        "soc_batterie": derniere_batterie.soc if derniere_batterie else 0,
-        "charges": [{"id": c.id, "nom": c.nom, "type": c.type, "etat": c.etat} for c in charges]
+        "production_actuelle": instantane["production_actuelle"],
+        "soc_batterie": instantane["soc_batterie"],
+        "charges": [{"id": c["id"], "nom": c["nom"], "type": c["type"], "etat": c["etat"]} for c in instantane["charges"]]
     })
 
 @app.get("/charges")
@@ -0,0 +1,277 @@
+# archivage.py
+# Archive des mesures anciennes en fichiers Parquet compressés, partitionnés par jour :
+#   <ARCHIVE_REPERTOIRE>/<table>/date=AAAA-MM-JJ/mesures.parquet
+# Les tables PostgreSQL ne gardent que les ARCHIVE_RETENTION_JOURS derniers jours ; les
+# endpoints d'historique fusionnent les partitions archivées avec les lignes en base.
+#
+# Archivage manuel : python archivage.py archiver
+
+import os
+import fcntl
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, delete, func, Integer, Float, String, Text, TIMESTAMP
+
+from database import SessionLocal, engine
+from models import Production, Batterie, Consommation
+from export import pages, colonnes
+import partitionnement
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # archive disabled without pyarrow
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ACTIVE = os.getenv("ARCHIVE_ACTIVE", "0") == "1"
+ARCHIVE_REPERTOIRE = os.getenv(
+    "ARCHIVE_REPERTOIRE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives")
+)
+RETENTION_JOURS = int(os.getenv("ARCHIVE_RETENTION_JOURS", "90"))
+HEURE_ARCHIVAGE = int(os.getenv("ARCHIVE_HEURE", "3"))
+COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+
+TABLES_ARCHIVEES = {
+    "production": Production,
+    "batterie": Batterie,
+    "consommation": Consommation,
+}
+
+_tache: Optional[asyncio.Task] = None
+
+
+def _schema(modele):
+    types = {Integer: pa.int64(), Float: pa.float64(), TIMESTAMP: pa.timestamp("us"), String: pa.string(), Text: pa.string()}
+    return pa.schema([
+        (c.name, next(t for sql, t in types.items() if isinstance(c.type, sql)))
+        for c in modele.__table__.columns
+    ])
+
+
+def _dossier(table: str) -> str:
+    return os.path.join(ARCHIVE_REPERTOIRE, table)
+
+
+def _chemin_partition(table: str, jour: date) -> str:
+    return os.path.join(_dossier(table), f"date={jour.isoformat()}", "mesures.parquet")
+
+
+def dates_archivees(table: str) -> List[date]:
+    try:
+        noms = os.listdir(_dossier(table))
+    except FileNotFoundError:
+        return []
+    return sorted(date.fromisoformat(n[5:]) for n in noms if n.startswith("date="))
+
+
+def couvre(table: str, debut: datetime, fin: datetime) -> bool:
+    """Vrai si des partitions archivées recoupent [debut, fin)"""
+    if pa is None:
+        return False
+    return any(debut.date() <= jour <= fin.date() for jour in dates_archivees(table))
+
+
+@contextmanager
+def _verrou():
+    """Un seul archivage à la fois entre les workers (même hôte, même répertoire)"""
+    os.makedirs(ARCHIVE_REPERTOIRE, exist_ok=True)
+    with open(os.path.join(ARCHIVE_REPERTOIRE, ".archivage.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def archiver_jour(table: str, jour: date) -> int:
+    """
+    Écrit les lignes d'un jour dans sa partition Parquet, puis les supprime de la base.
+    Une partition existante (échantillons arrivés en retard) est complétée, pas écrasée ;
+    le fichier est remplacé atomiquement avant toute suppression.
+    La partition PostgreSQL du jour n'est supprimée que si elle n'a pas changé depuis la lecture ;
+    sinon la suppression des lignes lues est annulée si une autre ligne du jour s'y est ajoutée.
+    """
+    modele = TABLES_ARCHIVEES[table]
+    schema = _schema(modele)
+    debut = datetime.combine(jour, time.min)
+    fin = debut + timedelta(days=1)
+    chemin = _chemin_partition(table, jour)
+    os.makedirs(os.path.dirname(chemin), exist_ok=True)
+    chemin_tmp = chemin + ".tmp"
+
+    ids_existants = None
+    nombre = 0
+    lues = 0  # rows read from the database, including those already in the file
+    id_max = None
+    with pq.ParquetWriter(chemin_tmp, schema, compression=COMPRESSION) as ecrivain:
+        if os.path.exists(chemin):
+            existant = pq.read_table(chemin, schema=schema)
+            ids_existants = existant["id"]
+            ecrivain.write_table(existant)
+        for page in pages(modele, debut=debut, fin=fin):
+            lot = pa.Table.from_pylist([dict(zip(schema.names, ligne)) for ligne in page], schema=schema)
+            if ids_existants is not None:
+                lot = lot.filter(pc.invert(pc.is_in(lot["id"], value_set=ids_existants)))
+            ecrivain.write_table(lot)
+            nombre += lot.num_rows
+            lues += len(page)
+            id_max = max(id_max or 0, max(ligne[0] for ligne in page))
+    os.replace(chemin_tmp, chemin)
+
+    if id_max is None:
+        return nombre
+    if partitionnement.PARTITIONNEMENT == "jour" and partitionnement.est_partitionnee(engine, table):
+        # Daily partitions: the whole day goes with a DROP instead of a DELETE, unless rows
+        # arrived while the file was written (the guarded DELETE below keeps them). The
+        # check runs under the table lock, in the DROP's own transaction
+        if partitionnement.supprimer_partition(engine, table, jour, attendu=(lues, id_max)):
+            return nombre
+
+    # Rows inserted for that day while archiving (higher ids) stay for the next run. A lower id
+    # can still commit after the read (ids are drawn before commit): the DELETE counts what it
+    # matched in the same transaction and rolls back unless it is exactly the rows read.
+    # Remaining window: a row still uncommitted when the DELETE runs is not matched at all; it
+    # stays in the database and the next run adds it to the file.
+    with SessionLocal() as db:
+        supprimees = db.execute(delete(modele).where(
+            modele.timestamp >= debut, modele.timestamp < fin, modele.id <= id_max
+        )).rowcount
+        if supprimees != lues:
+            db.rollback()
+            logger.info(f"{table} {jour}: {supprimees - lues} ligne(s) validée(s) pendant l'archivage, "
+                        f"suppression reportée au prochain passage")
+            return nombre
+        db.commit()
+    return nombre
+
+
+def jours_a_archiver(table: str, limite: date) -> List[date]:
+    """Jours antérieurs à la limite encore présents en base"""
+    modele = TABLES_ARCHIVEES[table]
+    with SessionLocal() as db:
+        plus_ancien = db.execute(select(func.min(modele.timestamp))).scalar()
+    if plus_ancien is None or plus_ancien.date() >= limite:
+        return []
+    return [plus_ancien.date() + timedelta(days=i) for i in range((limite - plus_ancien.date()).days)]
+
+
+def archiver(retention_jours: int = RETENTION_JOURS) -> Dict[str, int]:
+    """Archive toutes les tables de mesures jusqu'à la rétention ; retourne les lignes archivées par table"""
+    if pa is None:
+        raise RuntimeError("pyarrow est requis pour l'archivage (pip install pyarrow)")
+    limite = date.today() - timedelta(days=retention_jours)
+    bilan = {}
+    with _verrou():
+        for table in TABLES_ARCHIVEES:
+            bilan[table] = 0
+            for jour in jours_a_archiver(table, limite):
+                bilan[table] += archiver_jour(table, jour)
+            logger.info(f"Archivage {table}: {bilan[table]} lignes avant le {limite.isoformat()}")
+    return bilan
+
+
+# --- Lecture ----------------------------------------------------------------
+
+def _jeu(table: str):
+    # Explicit schema: files written before a column was added (site_id) read it as null
+    partitions = pa.schema([("date", pa.date32())])
+    return ds.dataset(
+        _dossier(table), format="parquet",
+        schema=pa.unify_schemas([_schema(TABLES_ARCHIVEES[table]), partitions]),
+        partitioning=ds.partitioning(partitions, flavor="hive"),
+        exclude_invalid_files=True
+    )
+
+
+def _filtre(debut: datetime, fin: datetime, id_charge: Optional[int], site_id: Optional[int] = None):
+    # The partition key prunes whole files before the row-group statistics
+    filtre = ((ds.field("date") >= debut.date()) & (ds.field("date") <= fin.date())
+              & (ds.field("timestamp") >= debut) & (ds.field("timestamp") < fin))
+    if id_charge is not None:
+        filtre &= ds.field("id_charge") == id_charge
+    elif site_id is None:
+        filtre &= ds.field("site_id").is_null()
+    else:
+        filtre &= ds.field("site_id") == site_id
+    return filtre
+
+
+def serie_archivee(table: str, valeur: str, debut: datetime, fin: datetime, pas: int,
+                   id_charge: Optional[int] = None, site_id: Optional[int] = None) -> List[tuple]:
+    """Même forme que requetes.requete_serie : (créneau, nombre, somme, minimum, maximum)"""
+    donnees = _jeu(table).to_table(columns=["timestamp", valeur], filter=_filtre(debut, fin, id_charge, site_id))
+    if not donnees.num_rows:
+        return []
+    secondes = pc.divide(pc.cast(donnees["timestamp"], pa.int64()), 1_000_000)
+    creneaux = pc.multiply(pc.divide(secondes, pas), pas)
+    groupes = pa.table({"creneau": creneaux, "v": donnees[valeur]}).group_by("creneau").aggregate(
+        [("v", "count"), ("v", "sum"), ("v", "min"), ("v", "max")]
+    )
+    return sorted(zip(*(groupes[c].to_pylist() for c in ("creneau", "v_count", "v_sum", "v_min", "v_max"))))
+
+
+def dernieres_archivees(table: str, debut: datetime, fin: datetime, nombre: int,
+                        id_charge: Optional[int] = None) -> list:
+    """Les `nombre` lignes archivées les plus récentes de la fenêtre, en objets du modèle (non attachés)"""
+    modele = TABLES_ARCHIVEES[table]
+    donnees = _jeu(table).to_table(columns=colonnes(modele), filter=_filtre(debut, fin, id_charge))
+    if not donnees.num_rows:
+        return []
+    indices = pc.select_k_unstable(donnees, k=nombre, sort_keys=[("timestamp", "descending")])
+    lignes = sorted(donnees.take(indices).to_pylist(), key=lambda l: l["timestamp"], reverse=True)
+    return [modele(**ligne) for ligne in lignes]
+
+
+# --- Tâche de fond ------------------------------------------------------------
+
+async def boucle_archivage():
+    """Un archivage par nuit, à ARCHIVE_HEURE"""
+    while True:
+        maintenant = datetime.now()
+        prochain = datetime.combine(maintenant.date(), time(HEURE_ARCHIVAGE))
+        if prochain <= maintenant:
+            prochain += timedelta(days=1)
+        await asyncio.sleep((prochain - maintenant).total_seconds())
+        try:
+            await asyncio.to_thread(archiver)
+        except Exception as e:
+            logger.error(f"Erreur archivage des mesures: {e}")
+
+
+def demarrer():
+    """Démarre la tâche de fond (idempotent)"""
+    global _tache
+    if not ARCHIVE_ACTIVE or (_tache and not _tache.done()):
+        return
+    if pa is None:
+        logger.error("Archivage désactivé: pyarrow n'est pas installé")
+        return
+    _tache = asyncio.get_running_loop().create_task(boucle_archivage())
+
+
+async def arreter():
+    global _tache
+    if _tache:
+        _tache.cancel()
+        try:
+            await _tache
+        except asyncio.CancelledError:
+            pass
+        _tache = None
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["archiver"]:
+        print(archiver())
+    else:
+        print("Usage : python archivage.py archiver")
@@ -0,0 +1,238 @@
+# bench.py
+# Bancs de performance des chemins chauds, sur des historiques synthétiques de taille croissante :
+#   analyse des prévisions (GestionnaireSolcast.analyser_previsions, version mémorisée),
+#   OptimiseurRobuste.optimiser_complet, ingestion de POST /mesures/ et /mesures/lot/,
+#   requêtes "dernière valeur" et /tendances/ sur les dernières 24 h.
+# Latence (médiane, p95) et pic mémoire (tracemalloc, passe séparée) sont écrits en JSON,
+# un fichier par commit, pour détecter les régressions d'un commit à l'autre.
+#
+# Usage :
+#   python bench.py [10000 1000000 10000000] [--repetitions 200] [--sortie bench_<commit>.json]
+#   python bench.py comparer bench_avant.json bench_apres.json
+# Base : BENCH_DATABASE_URL (fichier SQLite local par défaut, ou un PostgreSQL local).
+# Comparaison : code de sortie 1 si une latence ou un pic mémoire dépasse
+# BENCH_SEUIL_REGRESSION fois (1.2 par défaut) la valeur de référence.
+
+import os
+import sys
+import json
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import sessionmaker
+
+from models import Production
+from schemas import MesuresData, ConsommationData
+from ingestion import enregistrer_mesures
+from requetes import executer, fenetre_serie, requetes_tendances, completer_tendances, formater_tendances
+from agregats import AGREGATS_ACTIFS
+from stockage_previsions import StockagePrevisions
+from fournisseur_local import FournisseurLocal, previsions_synthetiques
+from solcast_manager import GestionnaireSolcast
+from optimiseur_robuste import OptimiseurRobuste
+from bench_derniere_valeur import (
+    BENCH_DATABASE_URL, DEBUT_HISTORIQUE, NB_CHARGES, REQUETES,
+    preparer_base, remplir_historique, chronometrer
+)
+
+SEUIL_REGRESSION = float(os.getenv("BENCH_SEUIL_REGRESSION", "1.2"))
+TAILLES_DEFAUT = [10_000, 1_000_000, 10_000_000]
+TAILLE_LOT_MESURES = 100  # échantillons par POST /mesures/lot/
+JOURS_PREVISIONS = 7  # horizon d'une réponse Solcast (336 créneaux de 30 min)
+
+
+def pic_memoire(fonction: Callable[[], object]) -> float:
+    """Pic d'allocations Python (Ko) d'un appel, hors du chronométrage (tracemalloc le ralentit)"""
+    tracemalloc.start()
+    try:
+        fonction()
+        _, pic = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(pic / 1024, 1)
+
+
+def mesurer(fonction: Callable[[], object], repetitions: int) -> Dict[str, float]:
+    return {**chronometrer(fonction, repetitions), "pic_memoire_ko": pic_memoire(fonction)}
+
+
+def version_code() -> str:
+    """Commit courant (suffixe -modifie si l'arbre de travail diffère)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        modifie = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "inconnu"
+    return f"{commit}-modifie" if modifie else commit
+
+
+# --- Bancs ---------------------------------------------------------------------
+
+def gestionnaire_bench(dossier: str, maintenant: datetime) -> GestionnaireSolcast:
+    """Gestionnaire hors ligne dont le cache contient des prévisions synthétiques autour de maintenant"""
+    gestionnaire = GestionnaireSolcast(
+        StockagePrevisions(os.path.join(dossier, "cache_bench.json")), espace="bench",
+        fournisseur=FournisseurLocal()
+    )
+    with gestionnaire.stockage.modifier(gestionnaire.espace) as entree:
+        entree["previsions"] = previsions_synthetiques(
+            "bench", maintenant - timedelta(days=1), maintenant + timedelta(days=JOURS_PREVISIONS - 1)
+        )
+        entree["derniere_mise_a_jour"] = maintenant.isoformat()
+    return gestionnaire
+
+
+def bancs_previsions(dossier: str, repetitions: int) -> Dict[str, Dict]:
+    """Analyse des prévisions, sans base"""
+    gestionnaire = gestionnaire_bench(dossier, datetime.now())
+    previsions = gestionnaire.cache_previsions
+    version = gestionnaire.version_previsions()
+    return {
+        "analyser_previsions": mesurer(lambda: gestionnaire.analyser_previsions(previsions), repetitions),
+        "analyse_memorisee": mesurer(lambda: gestionnaire.analyse_memorisee(version, previsions), repetitions),
+    }
+
+
+def echantillon(instant: datetime) -> MesuresData:
+    return MesuresData(
+        production=2500.0, soc_batterie=65.0, tension_batterie=52.0, courant_batterie=-3.5,
+        consommations=[ConsommationData(charge_id=i, consommation=120.0) for i in range(1, NB_CHARGES + 1)],
+        timestamp=instant,
+    )
+
+
+def bancs_base(Session, dossier: str, repetitions: int) -> Dict[str, Dict]:
+    """Chemins chauds qui lisent ou écrivent l'historique"""
+    resultats = {}
+    with Session() as db:
+        nb_lignes = db.execute(select(func.count()).select_from(Production)).scalar()
+        fin_historique = DEBUT_HISTORIQUE + timedelta(seconds=5 * nb_lignes)
+
+        optimiseur = OptimiseurRobuste()
+        optimiseur.solcast_manager = gestionnaire_bench(dossier, fin_historique)
+        contexte = {"production_actuelle": 2500.0, "soc_batterie": 65.0, "evenement_special": False,
+                    "maintenant": fin_historique}
+        resultats["optimiser_complet"] = mesurer(lambda: optimiseur.optimiser_complet(db, contexte), repetitions)
+
+        for nom, requete in REQUETES.items():
+            resultats[nom] = mesurer(lambda: requete(db), repetitions)
+
+        def tendances():
+            debut, fin, pas = fenetre_serie(fin_historique - timedelta(days=1), fin_historique, None, fin_historique)
+            resultats_bruts = completer_tendances(executer(db, requetes_tendances(debut, fin, pas)), debut, fin, pas)
+            return formater_tendances(resultats_bruts, debut, fin, pas)
+        resultats["tendances_24h"] = mesurer(tendances, repetitions)
+
+        # Ingested samples continue the 5 s timeline, so the next fill stays consistent
+        prochain = [nb_lignes]
+
+        def instants(n: int) -> List[datetime]:
+            depart, prochain[0] = prochain[0], prochain[0] + n
+            return [DEBUT_HISTORIQUE + timedelta(seconds=5 * (depart + k)) for k in range(n)]
+
+        resultats["receive_measurements"] = mesurer(
+            lambda: enregistrer_mesures(db, [echantillon(t) for t in instants(1)]), repetitions
+        )
+        resultats["receive_measurements_lot"] = mesurer(
+            lambda: enregistrer_mesures(db, [echantillon(t) for t in instants(TAILLE_LOT_MESURES)]),
+            max(1, repetitions // 10)
+        )
+    return resultats
+
+
+def lancer(tailles: List[int], repetitions: int, url: str = BENCH_DATABASE_URL) -> Dict:
+    moteur = preparer_base(url)
+    Session = sessionmaker(bind=moteur)
+    rapport = {
+        "commit": version_code(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "base": moteur.url.render_as_string(hide_password=True),
+        "python": platform.python_version(),
+        "agregats": AGREGATS_ACTIFS,
+        "repetitions": repetitions,
+        "bancs": {},
+    }
+    with tempfile.TemporaryDirectory() as dossier:
+        for nom, resultat in bancs_previsions(dossier, repetitions).items():
+            rapport["bancs"][f"previsions/{nom}"] = resultat
+            afficher_ligne(f"previsions/{nom}", resultat)
+
+        for taille in sorted(tailles):
+            debut = datetime.now()
+            remplir_historique(moteur, taille, agreger=AGREGATS_ACTIFS)
+            print(f"\n{taille:>12,} lignes par table (remplissage {(datetime.now() - debut).total_seconds():.1f} s)")
+            for nom, resultat in bancs_base(Session, dossier, repetitions).items():
+                rapport["bancs"][f"{taille}/{nom}"] = resultat
+                afficher_ligne(f"{taille}/{nom}", resultat)
+    return rapport
+
+
+def afficher_ligne(nom: str, resultat: Dict):
+    print(f"  {nom:<42} médiane {resultat['mediane_us']:>11} µs   p95 {resultat['p95_us']:>11} µs"
+          f"   pic {resultat['pic_memoire_ko']:>9} Ko")
+
+
+# --- Comparaison ---------------------------------------------------------------
+
+def comparer(reference: Dict, courant: Dict, seuil: float = SEUIL_REGRESSION) -> List[Dict]:
+    """Bancs communs dont la médiane ou le pic mémoire dépasse seuil x la référence"""
+    regressions = []
+    for nom, avant in reference["bancs"].items():
+        apres = courant["bancs"].get(nom)
+        if apres is None:
+            continue
+        for mesure in ("mediane_us", "pic_memoire_ko"):
+            if avant.get(mesure) and apres.get(mesure) is not None:
+                rapport = apres[mesure] / avant[mesure]
+                if rapport > seuil:
+                    regressions.append({"banc": nom, "mesure": mesure, "avant": avant[mesure],
+                                        "apres": apres[mesure], "rapport": round(rapport, 2)})
+    return regressions
+
+
+def _charger(chemin: str) -> Dict:
+    with open(chemin, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    arguments = sys.argv[1:] if arguments is None else arguments
+    if arguments[:1] == ["comparer"]:
+        parseur = argparse.ArgumentParser(description="Compare deux résultats de bench.py")
+        parseur.add_argument("reference")
+        parseur.add_argument("courant")
+        parseur.add_argument("--seuil", type=float, default=SEUIL_REGRESSION)
+        options = parseur.parse_args(arguments[1:])
+        reference, courant = _charger(options.reference), _charger(options.courant)
+        regressions = comparer(reference, courant, options.seuil)
+        print(f"{reference['commit']} -> {courant['commit']} : {len(regressions)} régression(s) (seuil x{options.seuil})")
+        for r in regressions:
+            print(f"  {r['banc']:<42} {r['mesure']:<15} {r['avant']:>11} -> {r['apres']:>11}  x{r['rapport']}")
+        return 1 if regressions else 0
+
+    parseur = argparse.ArgumentParser(description="Bancs de performance des chemins chauds")
+    parseur.add_argument("tailles", nargs="*", type=int, help="lignes par table de mesures")
+    parseur.add_argument("--repetitions", type=int, default=200)
+    parseur.add_argument("--sortie", help="fichier JSON (bench_<commit>.json par défaut)")
+    options = parseur.parse_args(arguments)
+
+    rapport = lancer(options.tailles or TAILLES_DEFAUT, options.repetitions)
+    sortie = options.sortie or f"bench_{rapport['commit']}.json"
+    with open(sortie, "w", encoding="utf-8") as f:
+        json.dump(rapport, f, indent=2, ensure_ascii=False)
+    print(f"\nRésultats : {sortie}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
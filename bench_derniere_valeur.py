@@ -0,0 +1,110 @@
+# bench_derniere_valeur.py
+# Coût des requêtes "dernière valeur" quand l'historique grossit
+#
+# Usage : python bench_derniere_valeur.py 10000 1000000 10000000
+# Base : BENCH_DATABASE_URL (par défaut un fichier SQLite local)
+
+import os
+import sys
+import time
+import random
+import statistics
+from datetime import datetime, timedelta
+from typing import Callable, Dict
+
+from sqlalchemy import create_engine, insert, select, func
+from sqlalchemy.orm import sessionmaker, Session
+
+from database import Base
+from models import Charge, Production, Batterie, Consommation
+import agregats
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL", "sqlite:///bench_historique.db")
+TAILLE_LOT = 50_000
+NB_CHARGES = 5
+DEBUT_HISTORIQUE = datetime(2024, 1, 1)
+
+REQUETES: Dict[str, Callable[[Session], object]] = {
+    "derniere_production": lambda db: db.query(Production).order_by(Production.timestamp.desc()).first(),
+    "derniere_batterie": lambda db: db.query(Batterie).order_by(Batterie.timestamp.desc()).first(),
+    "derniere_consommation_charge": lambda db: db.query(Consommation).filter(
+        Consommation.id_charge == 1
+    ).order_by(Consommation.timestamp.desc()).first(),
+}
+
+
+def preparer_base(url: str = BENCH_DATABASE_URL):
+    """Crée les tables (avec leurs index) et les charges de test"""
+    moteur = create_engine(url)
+    Base.metadata.create_all(bind=moteur)
+    with moteur.begin() as conn:
+        if not conn.execute(select(func.count()).select_from(Charge)).scalar():
+            conn.execute(insert(Charge), [
+                {"id": i, "nom": f"Charge {i}", "type": "prioritaire", "puissance_nominale": 100.0, "etat": False}
+                for i in range(1, NB_CHARGES + 1)
+            ])
+    return moteur
+
+
+def remplir_historique(moteur, nb_lignes: int, agreger: bool = False):
+    """
+    Complète chaque table de mesures jusqu'à nb_lignes (un échantillon toutes les 5 s) ;
+    avec agreger, les agrégats sont alimentés comme à l'ingestion (lectures de /tendances/)
+    """
+    with moteur.connect() as conn:
+        deja = conn.execute(select(func.count()).select_from(Production)).scalar()
+
+    for depart in range(deja, nb_lignes, TAILLE_LOT):
+        n = min(TAILLE_LOT, nb_lignes - depart)
+        horodatages = [DEBUT_HISTORIQUE + timedelta(seconds=5 * (depart + k)) for k in range(n)]
+        lignes = {
+            "production": [{"timestamp": t, "production": random.uniform(0, 4000)} for t in horodatages],
+            "batterie": [
+                {"timestamp": t, "soc": random.uniform(20, 100), "tension": 52.0, "courant": 0.0}
+                for t in horodatages
+            ],
+            "consommation": [
+                {"timestamp": t, "id_charge": (depart + k) % NB_CHARGES + 1, "consommation": random.uniform(0, 200)}
+                for k, t in enumerate(horodatages)
+            ],
+        }
+        with Session(moteur) as db:
+            db.execute(insert(Production), lignes["production"])
+            db.execute(insert(Batterie), lignes["batterie"])
+            db.execute(insert(Consommation), lignes["consommation"])
+            if agreger:
+                agregats.mettre_a_jour(db, lignes)
+            db.commit()
+
+
+def chronometrer(fonction: Callable[[], object], repetitions: int = 200) -> Dict[str, float]:
+    """Médiane et p95 en microsecondes"""
+    fonction()  # warm-up
+    durees = []
+    for _ in range(repetitions):
+        debut = time.perf_counter()
+        fonction()
+        durees.append((time.perf_counter() - debut) * 1e6)
+    durees.sort()
+    return {
+        "mediane_us": round(statistics.median(durees), 1),
+        "p95_us": round(durees[int(len(durees) * 0.95) - 1], 1),
+    }
+
+
+def main(tailles):
+    moteur = preparer_base()
+    fabrique = sessionmaker(bind=moteur)
+    print(f"Base : {moteur.url}")
+    for taille in sorted(tailles):
+        debut = time.perf_counter()
+        remplir_historique(moteur, taille)
+        print(f"\n{taille:>12,} lignes par table (remplissage {time.perf_counter() - debut:.1f} s)")
+        with fabrique() as db:
+            for nom, requete in REQUETES.items():
+                resultat = chronometrer(lambda: requete(db))
+                print(f"  {nom:<30} médiane {resultat['mediane_us']:>9} µs   p95 {resultat['p95_us']:>9} µs")
+
+
+if __name__ == "__main__":
+    main([int(t) for t in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,113 @@
+# cache_commandes.py
+# Commandes Arduino mises en cache : l'optimisation n'est relancée que si ses entrées changent
+
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from optimiseur_robuste import OptimiseurRobuste
+from stockage_previsions import StockagePrevisions
+
+logger = logging.getLogger(__name__)
+
+LARGEUR_BANDE_SOC = 10  # %
+ESPACE_CONFIGURATION = "configuration"
+
+
+class CacheCommandes:
+    """
+    Garde le dernier jeu de commandes et la signature des entrées qui l'ont produit :
+    bande de SOC, niveau de production, période de la journée, version des prévisions,
+    charges et calendrier. Tant que la signature ne change pas, les polls reçoivent
+    les commandes en cache (avec leur version, utilisable comme ETag).
+    La version de la configuration est partagée entre les workers par le fichier de
+    StockagePrevisions : une modification reçue par un worker invalide le cache de tous.
+    """
+
+    def __init__(self, optimiseur: OptimiseurRobuste, stockage: Optional[StockagePrevisions] = None):
+        self.optimiseur = optimiseur
+        self.stockage = stockage or StockagePrevisions()
+        self._verrou = threading.Lock()
+        self._signature = None
+        self._commandes: Optional[Dict] = None
+        self.stats = {"recalculs": 0, "hits": 0}
+        self._abonnes: List[Callable[[Dict], None]] = []
+
+    def abonner(self, callback: Callable[[Dict], None]):
+        """callback(commandes) est appelé à chaque nouvelle version des commandes"""
+        self._abonnes.append(callback)
+
+    @property
+    def version_configuration(self) -> int:
+        """Compteur partagé des modifications de charges et de calendrier (relu seulement s'il a changé)"""
+        return self.stockage.lire(ESPACE_CONFIGURATION).get("version", 0)
+
+    def invalider(self):
+        """À appeler après toute modification des charges ou du calendrier"""
+        with self.stockage.modifier(ESPACE_CONFIGURATION) as entree:
+            entree["version"] = entree.get("version", 0) + 1
+
+    def signature(self, contexte: Dict, charges: List[Dict]) -> tuple:
+        analyse = self.optimiseur._analyser_contexte_actuel(contexte)
+        return (
+            int(contexte.get("soc_batterie", 0) // LARGEUR_BANDE_SOC),
+            analyse["niveau_batterie"],
+            analyse["niveau_production"],
+            analyse["periode_journee"],
+            self.optimiseur.version_previsions(),
+            tuple((c["id"], c["type"], c["puissance_nominale"]) for c in charges),
+            self.version_configuration,
+        )
+
+    @staticmethod
+    def _version(resultat: Dict) -> str:
+        contenu = json.dumps(
+            [resultat["strategie"]["nom"], resultat["strategie"]["score"], resultat["decisions"]],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha1(contenu.encode()).hexdigest()[:16]
+
+    def obtenir(self, db: Session, contexte: Dict, charges: List[Dict]) -> Dict:
+        """Commandes courantes, recalculées seulement si la signature des entrées a changé"""
+        signature = self.signature(contexte, charges)
+        with self._verrou:
+            if self._commandes and signature == self._signature:
+                self.stats["hits"] += 1
+                return self._commandes
+
+            resultat = self.optimiseur.optimiser_complet(db, contexte)
+            commandes = {
+                "charges": resultat["decisions"],
+                "strategie": resultat["strategie"]["nom"],
+                "score": resultat["strategie"]["score"],
+                "alerte": resultat["alerte_vocale"],
+                "version": self._version(resultat),
+                "calcule_le": datetime.now().isoformat(),
+            }
+            self.stats["recalculs"] += 1
+            if resultat["strategie"]["nom"] == "FALLBACK":
+                # Never pin the degraded result: retry on the next poll
+                return commandes
+            nouvelle_version = not self._commandes or self._commandes["version"] != commandes["version"]
+            self._signature = signature
+            self._commandes = commandes
+
+        if nouvelle_version:
+            for callback in self._abonnes:
+                try:
+                    callback(commandes)
+                except Exception as e:
+                    logger.error(f"Erreur notification commandes: {e}")
+        return commandes
+
+    def get_statistiques(self) -> Dict:
+        return {
+            **self.stats,
+            "version": self._commandes["version"] if self._commandes else None,
+            "calcule_le": self._commandes["calcule_le"] if self._commandes else None,
+        }
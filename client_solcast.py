@@ -0,0 +1,192 @@
+# client_solcast.py
+# Fournisseurs de prévisions derrière GestionnaireSolcast (SOLCAST_FOURNISSEUR) :
+#   api   : client HTTP Solcast, session keep-alive partagée (pool de connexions), timeouts
+#           de connexion et de lecture, nouvelles tentatives avec attente aléatoire et
+#           disjoncteur par clé ;
+#   local : fournisseur_local.FournisseurLocal, prévisions enregistrées ou synthétiques
+#           (bancs d'essai et rejeu, sans réseau ni quota).
+# Les compteurs de latence et d'erreurs par clé sont exposés avec les statistiques
+# d'utilisation (/statistiques_solcast/).
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+FOURNISSEUR = os.getenv("SOLCAST_FOURNISSEUR", "api")  # api ou local
+URL_API = os.getenv("SOLCAST_URL_API", "https://api.solcast.com.au")
+TIMEOUT_CONNEXION_S = float(os.getenv("SOLCAST_TIMEOUT_CONNEXION_S", "3.05"))
+TIMEOUT_LECTURE_S = float(os.getenv("SOLCAST_TIMEOUT_LECTURE_S", "10"))
+TENTATIVES = int(os.getenv("SOLCAST_TENTATIVES", "3"))
+ATTENTE_BASE_S = float(os.getenv("SOLCAST_ATTENTE_BASE_S", "0.5"))
+DISJONCTEUR_SEUIL = int(os.getenv("SOLCAST_DISJONCTEUR_SEUIL", "5"))  # échecs consécutifs
+DISJONCTEUR_PAUSE_S = float(os.getenv("SOLCAST_DISJONCTEUR_PAUSE_S", "300"))
+PARALLELISME = int(os.getenv("SOLCAST_PARALLELISME", "8"))  # sites rafraîchis simultanément
+FENETRE_LATENCES = 100
+
+
+class ErreurSolcast(Exception):
+    """Échec après toutes les tentatives (timeout, erreur réseau ou 5xx)"""
+
+
+class CleIndisponible(ErreurSolcast):
+    """Quota atteint (429) ou site inconnu (404) : passer à la clé suivante sans réessayer"""
+
+
+class DisjoncteurOuvert(ErreurSolcast):
+    """Clé suspendue après DISJONCTEUR_SEUIL échecs consécutifs"""
+
+
+class FournisseurPrevisions:
+    """
+    Source de prévisions au format de l'API Solcast (liste "forecasts").
+    Lève CleIndisponible (quota, site inconnu), DisjoncteurOuvert ou ErreurSolcast.
+    """
+
+    def previsions(self, api_key: str, site_id: str, debut: str, fin: str) -> List[Dict]:
+        raise NotImplementedError
+
+    def statistiques(self) -> Dict:
+        return {}
+
+    @staticmethod
+    def _libelle(api_key: str, site_id: str) -> str:
+        """Identifiant exposé dans les statistiques (la clé n'est jamais affichée en entier)"""
+        return f"{site_id}/…{api_key[-4:]}"
+
+
+class _EtatCle:
+    """Compteurs et disjoncteur d'une clé (protégés par le verrou du client)"""
+
+    def __init__(self):
+        self.appels = 0
+        self.erreurs = 0
+        self.timeouts = 0
+        self.indisponible = 0  # 429 / 404
+        self.latences = deque(maxlen=FENETRE_LATENCES)
+        self.echecs_consecutifs = 0
+        self.ouvert_jusqu_a = 0.0
+        self.derniere_erreur: Optional[str] = None
+
+
+class ClientSolcast(FournisseurPrevisions):
+    """Client partagé par tous les gestionnaires (un par processus, thread-safe)"""
+
+    def __init__(self, url_api: str = URL_API, timeout=(TIMEOUT_CONNEXION_S, TIMEOUT_LECTURE_S),
+                 tentatives: int = TENTATIVES, attente_base_s: float = ATTENTE_BASE_S):
+        self.url_api = url_api.rstrip("/")
+        self.timeout = timeout
+        self.tentatives = tentatives
+        self.attente_base_s = attente_base_s
+        self.session = requests.Session()
+        # One keep-alive connection per concurrent site refresh
+        adaptateur = HTTPAdapter(pool_connections=1, pool_maxsize=max(PARALLELISME, 1))
+        self.session.mount("https://", adaptateur)
+        self.session.mount("http://", adaptateur)
+        self._cles: Dict[str, _EtatCle] = {}
+        self._verrou = threading.Lock()
+
+    def _etat(self, libelle: str) -> _EtatCle:
+        with self._verrou:
+            return self._cles.setdefault(libelle, _EtatCle())
+
+    def _noter(self, etat: _EtatCle, debut: float, erreur: Optional[str] = None, nature: Optional[str] = None):
+        with self._verrou:
+            etat.appels += 1
+            etat.latences.append((time.monotonic() - debut) * 1000)
+            if nature == "indisponible":
+                etat.indisponible += 1
+                etat.echecs_consecutifs = 0  # the endpoint answered: not a fault
+            elif erreur is None:
+                etat.echecs_consecutifs = 0
+            else:
+                etat.erreurs += 1
+                if nature == "timeout":
+                    etat.timeouts += 1
+                etat.echecs_consecutifs += 1
+                etat.derniere_erreur = erreur
+                if etat.echecs_consecutifs >= DISJONCTEUR_SEUIL:
+                    etat.ouvert_jusqu_a = time.monotonic() + DISJONCTEUR_PAUSE_S
+
+    def previsions(self, api_key: str, site_id: str, debut: str, fin: str) -> List[Dict]:
+        """
+        GET /rooftop_sites/{site_id}/forecasts entre debut et fin (ISO, UTC).
+        Lève CleIndisponible (429/404), DisjoncteurOuvert ou ErreurSolcast.
+        """
+        libelle = self._libelle(api_key, site_id)
+        etat = self._etat(libelle)
+        if etat.ouvert_jusqu_a > time.monotonic():
+            raise DisjoncteurOuvert(f"Clé {libelle} suspendue ({etat.derniere_erreur})")
+
+        url = f"{self.url_api}/rooftop_sites/{site_id}/forecasts"
+        params = {"format": "json", "api_key": api_key, "start": debut, "end": fin}
+        for tentative in range(self.tentatives):
+            debut_appel = time.monotonic()
+            try:
+                reponse = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.Timeout as e:
+                self._noter(etat, debut_appel, f"timeout: {e}", "timeout")
+            except requests.RequestException as e:
+                self._noter(etat, debut_appel, f"réseau: {e}")
+            else:
+                if reponse.status_code in (429, 404):
+                    self._noter(etat, debut_appel, nature="indisponible")
+                    raise CleIndisponible(f"HTTP {reponse.status_code} pour {libelle}")
+                if reponse.status_code < 500:
+                    try:
+                        reponse.raise_for_status()
+                    except requests.HTTPError as e:
+                        self._noter(etat, debut_appel, f"HTTP {reponse.status_code}")
+                        raise ErreurSolcast(str(e)) from e
+                    self._noter(etat, debut_appel)
+                    return reponse.json().get("forecasts", [])
+                self._noter(etat, debut_appel, f"HTTP {reponse.status_code}")
+
+            if etat.ouvert_jusqu_a > time.monotonic():
+                break
+            if tentative + 1 < self.tentatives:
+                # Full jitter: workers and sites do not retry in lockstep
+                time.sleep(random.uniform(0, self.attente_base_s * 2 ** tentative))
+        raise ErreurSolcast(f"Solcast injoignable pour {libelle} après {tentative + 1} tentative(s): {etat.derniere_erreur}")
+
+    def statistiques(self) -> Dict:
+        """Latences (ms) et erreurs par clé, état du disjoncteur"""
+        maintenant = time.monotonic()
+        with self._verrou:
+            resultat = {}
+            for libelle, etat in self._cles.items():
+                latences = sorted(etat.latences)
+                resultat[libelle] = {
+                    "appels": etat.appels,
+                    "erreurs": etat.erreurs,
+                    "timeouts": etat.timeouts,
+                    "quota_ou_introuvable": etat.indisponible,
+                    "latence_p50_ms": round(latences[len(latences) // 2], 1) if latences else None,
+                    "latence_max_ms": round(latences[-1], 1) if latences else None,
+                    "disjoncteur": "ouvert" if etat.ouvert_jusqu_a > maintenant else "ferme",
+                    "derniere_erreur": etat.derniere_erreur,
+                }
+            return resultat
+
+
+client = ClientSolcast()
+_fournisseur_local: Optional[FournisseurPrevisions] = None
+
+
+def fournisseur_par_defaut() -> FournisseurPrevisions:
+    """Fournisseur choisi par SOLCAST_FOURNISSEUR, partagé par tous les gestionnaires du processus"""
+    global _fournisseur_local
+    if FOURNISSEUR != "local":
+        return client
+    if _fournisseur_local is None:
+        from fournisseur_local import FournisseurLocal
+        _fournisseur_local = FournisseurLocal()
+    return _fournisseur_local
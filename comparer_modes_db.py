@@ -0,0 +1,93 @@
+# comparer_modes_db.py
+# Compare le débit (req/s) et la latence p99 des modes DB_MODE=sync et DB_MODE=async
+#
+# Usage : python comparer_modes_db.py [clients=1000] [duree_s=30]
+# Lance api:app avec uvicorn dans chaque mode (même base PostgreSQL que .env) puis
+# envoie un mélange ingestion / tableau de bord / historique avec `clients` clients simultanés.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import subprocess
+from typing import Dict, List
+
+import httpx
+
+PORT = int(os.getenv("BENCH_PORT", "8765"))
+URL = f"http://127.0.0.1:{PORT}"
+
+
+def mesure_aleatoire() -> Dict:
+    return {
+        "production": random.uniform(0, 3000),
+        "soc_batterie": random.uniform(20, 100),
+        "tension_batterie": random.uniform(48, 54),
+        "courant_batterie": random.uniform(-50, 50),
+        "consommations": [{"charge_id": i, "consommation": random.uniform(0, 200)} for i in range(1, 6)],
+    }
+
+
+async def client(http: httpx.AsyncClient, fin: float, latences: List[float], erreurs: List[int]):
+    while time.perf_counter() < fin:
+        tirage = random.random()
+        debut = time.perf_counter()
+        try:
+            if tirage < 0.6:
+                reponse = await http.post("/mesures/", json=mesure_aleatoire())
+            elif tirage < 0.9:
+                reponse = await http.get("/dashboard/")
+            else:
+                reponse = await http.get("/mesures/dernieres/")
+            if reponse.status_code >= 400:
+                erreurs.append(reponse.status_code)
+        except httpx.HTTPError:
+            erreurs.append(0)
+        latences.append(time.perf_counter() - debut)
+
+
+async def charger(nb_clients: int, duree_s: float) -> Dict:
+    latences: List[float] = []
+    erreurs: List[int] = []
+    limites = httpx.Limits(max_connections=nb_clients, max_keepalive_connections=nb_clients)
+    async with httpx.AsyncClient(base_url=URL, limits=limites, timeout=30) as http:
+        fin = time.perf_counter() + duree_s
+        await asyncio.gather(*(client(http, fin, latences, erreurs) for _ in range(nb_clients)))
+    latences.sort()
+    return {
+        "requetes_par_s": round(len(latences) / duree_s, 1),
+        "p50_ms": round(latences[len(latences) // 2] * 1000, 1) if latences else None,
+        "p99_ms": round(latences[int(len(latences) * 0.99) - 1] * 1000, 1) if latences else None,
+        "erreurs": len(erreurs),
+    }
+
+
+def lancer_serveur(mode: str) -> subprocess.Popen:
+    env = dict(os.environ, DB_MODE=mode)
+    serveur = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(PORT), "--log-level", "warning"],
+        env=env
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"{URL}/docs", timeout=1)
+            return serveur
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    serveur.terminate()
+    raise RuntimeError(f"Le serveur ({mode}) n'a pas démarré")
+
+
+if __name__ == "__main__":
+    nb_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    duree_s = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    for mode in ("sync", "async"):
+        serveur = lancer_serveur(mode)
+        try:
+            resultat = asyncio.run(charger(nb_clients, duree_s))
+        finally:
+            serveur.terminate()
+            serveur.wait()
+        print(f"{mode:>5} : {resultat['requetes_par_s']:>8} req/s   p50 {resultat['p50_ms']} ms   "
+              f"p99 {resultat['p99_ms']} ms   erreurs {resultat['erreurs']}")
@@ -1,8 +1,14 @@
 # database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 import os
+import time
+import threading
+from functools import wraps
+
+from metriques import instrumenter_moteur
 
 # Load environment variables
 local_env = os.path.join(os.path.dirname(__file__), '.env')
@@ -23,15 +29,144 @@ DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POST
 
 print('DATABASE_URL:', DATABASE_URL)
 
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # s, wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # s, -1 to disable
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"  # drop stale connections after a Postgres restart
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = no limit
+
+class StatistiquesPool:
+    """Temps d'attente pour obtenir une connexion du pool, timeouts et reconnexions"""
+    BORNES_ATTENTE_S = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._verrou = threading.Lock()
+        self.acquisitions = 0
+        self.attente_totale_s = 0.0
+        self.attente_max_s = 0.0
+        self.repartition_attente = [0] * (len(self.BORNES_ATTENTE_S) + 1)
+        self.timeouts = 0
+        self.connexions_ouvertes = 0
+        self.connexions_invalidees = 0
+
+    def enregistrer_attente(self, duree: float):
+        with self._verrou:
+            self.acquisitions += 1
+            self.attente_totale_s += duree
+            self.attente_max_s = max(self.attente_max_s, duree)
+            i = next((i for i, borne in enumerate(self.BORNES_ATTENTE_S) if duree <= borne), len(self.BORNES_ATTENTE_S))
+            self.repartition_attente[i] += 1
+
+    def enregistrer_timeout(self):
+        with self._verrou:
+            self.timeouts += 1
+
+    def enregistrer_connexion(self):
+        with self._verrou:
+            self.connexions_ouvertes += 1
+
+    def enregistrer_invalidation(self):
+        with self._verrou:
+            self.connexions_invalidees += 1
+
+def _options_pool():
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+def suivre_pool(moteur) -> StatistiquesPool:
+    """
+    Statistiques propres au moteur (moteur async : passer async_engine.sync_engine),
+    rangées dans moteur.statistiques_pool et conservées après un dispose().
+    """
+    statistiques = StatistiquesPool()
+    moteur.statistiques_pool = statistiques
+    obtenir = moteur.raw_connection
+
+    # Every checkout (Session, Connection, async greenlet) goes through Engine.raw_connection:
+    # the time spent there is the wait for a free connection, pre-ping included
+    @wraps(obtenir)
+    def raw_connection_chronometree():
+        debut = time.perf_counter()
+        try:
+            return obtenir()
+        except PoolTimeoutError:
+            statistiques.enregistrer_timeout()
+            raise
+        finally:
+            statistiques.enregistrer_attente(time.perf_counter() - debut)
+    moteur.raw_connection = raw_connection_chronometree
+
+    # Pool events registered on the engine are carried over to the pool dispose() recreates
+    @event.listens_for(moteur, "connect")
+    def _connexion(dbapi_connection, connection_record):
+        statistiques.enregistrer_connexion()
+
+    @event.listens_for(moteur, "invalidate")
+    def _invalidation(dbapi_connection, connection_record, exception):
+        statistiques.enregistrer_invalidation()
+
+    return statistiques
+
 # Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"} if DB_STATEMENT_TIMEOUT_MS else {},
+    **_options_pool()
+)
+suivre_pool(engine)
+instrumenter_moteur(engine)
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# "sync" (default) or "async": async mode serves ingestion, dashboard and history routes
+# with non-blocking handlers on an asyncpg engine (see api_async.py)
+DB_MODE = os.getenv("DB_MODE", "sync")
+
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_MODE == "async":
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}} if DB_STATEMENT_TIMEOUT_MS else {},
+        **_options_pool()
+    )
+    suivre_pool(async_engine.sync_engine)
+    instrumenter_moteur(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Base class for SQLAlchemy models
 Base = declarative_base()
 
+def etat_pool(moteur) -> dict:
+    """Connexions prises / libres du pool et statistiques d'attente"""
+    pool = moteur.pool
+    stats = moteur.statistiques_pool
+    return {
+        "taille": pool.size(),
+        "connexions_prises": pool.checkedout(),
+        "connexions_libres": pool.checkedin(),
+        "debordement": pool.overflow(),
+        "max_debordement": DB_MAX_OVERFLOW,
+        "acquisitions": stats.acquisitions,
+        "attente_moyenne_ms": round(stats.attente_totale_s / stats.acquisitions * 1000, 3) if stats.acquisitions else 0,
+        "attente_max_ms": round(stats.attente_max_s * 1000, 3),
+        "repartition_attente": dict(zip([f"<={b}s" for b in stats.BORNES_ATTENTE_S] + ["+inf"], stats.repartition_attente)),
+        "timeouts": stats.timeouts,
+        "connexions_ouvertes": stats.connexions_ouvertes,
+        "connexions_invalidees": stats.connexions_invalidees,
+    }
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
@@ -40,6 +175,11 @@ def get_db():
     finally:
         db.close()
 
+# Dependency to get an async DB session (DB_MODE=async)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # Function to load Solcast API keys and site IDs dynamically
 def charger_cles_solcast():
     cles = []
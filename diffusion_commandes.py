@@ -0,0 +1,152 @@
+# diffusion_commandes.py
+# Canal Server-Sent Events : pousse aux contrôleurs de relais les changements de commandes
+
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+INTERVALLE_HEARTBEAT_S = float(os.getenv("SSE_HEARTBEAT_S", "15"))
+INTERVALLE_VERIFICATION_S = float(os.getenv("SSE_VERIFICATION_S", "5"))
+TAILLE_HISTORIQUE = 64
+
+
+class DiffuseurCommandes:
+    """
+    Diffuse les changements du jeu de commandes à toutes les connexions SSE du worker.
+    Une connexion inactive ne coûte qu'une attente sur l'événement partagé : pas de
+    thread ni de requête par client. Les versions récentes sont gardées pour renvoyer
+    seulement le diff à un client qui se reconnecte avec Last-Event-ID.
+    """
+
+    def __init__(self):
+        self._boucle: Optional[asyncio.AbstractEventLoop] = None
+        self._nouvelle_version: Optional[asyncio.Event] = None
+        self._reveil: Optional[asyncio.Event] = None
+        self._tache: Optional[asyncio.Task] = None
+        self.verifier: Optional[Callable[[], None]] = None  # recalcule les commandes si besoin (thread)
+
+        self.version: Optional[str] = None
+        self.commandes: Optional[Dict] = None
+        self._historique: "OrderedDict[str, Dict[str, Dict]]" = OrderedDict()
+        self.connexions = 0
+
+    # --- Lifecycle -------------------------------------------------------
+
+    def demarrer(self):
+        """À appeler depuis la boucle asyncio (startup)"""
+        if self._tache and not self._tache.done():
+            return
+        self._boucle = asyncio.get_running_loop()
+        self._nouvelle_version = asyncio.Event()
+        self._reveil = asyncio.Event()
+        self._tache = self._boucle.create_task(self._boucle_verification())
+
+    async def arreter(self):
+        if self._tache:
+            self._tache.cancel()
+            try:
+                await self._tache
+            except asyncio.CancelledError:
+                pass
+            self._tache = None
+
+    async def _boucle_verification(self):
+        """
+        Réévalue les entrées de l'optimiseur quand on le signale (ingestion, édition)
+        ou périodiquement (prévisions rafraîchies, mesures reçues par un autre worker).
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._reveil.wait(), timeout=INTERVALLE_VERIFICATION_S)
+            except asyncio.TimeoutError:
+                pass
+            self._reveil.clear()
+            if self.connexions and self.verifier:
+                try:
+                    await asyncio.to_thread(self.verifier)
+                except Exception as e:
+                    logger.error(f"Erreur vérification des commandes: {e}")
+
+    # --- Publishing (thread-safe) ----------------------------------------
+
+    def signaler(self):
+        """Les entrées ont peut-être changé : déclenche une vérification sans attendre"""
+        if self._boucle and not self._boucle.is_closed():
+            self._boucle.call_soon_threadsafe(self._reveil.set)
+
+    def publier(self, commandes: Dict):
+        """Appelé par CacheCommandes (depuis n'importe quel thread) après un recalcul"""
+        if self._boucle and not self._boucle.is_closed():
+            self._boucle.call_soon_threadsafe(self._publier, commandes)
+        else:
+            self._publier(commandes)
+
+    def _publier(self, commandes: Dict):
+        if commandes["version"] == self.version:
+            return
+        self.version = commandes["version"]
+        self.commandes = commandes
+        self._historique[self.version] = {str(c["charge_id"]): c for c in commandes["charges"]}
+        while len(self._historique) > TAILLE_HISTORIQUE:
+            self._historique.popitem(last=False)
+        if self._nouvelle_version:
+            # Wake up every waiting connection, then arm a fresh event
+            self._nouvelle_version.set()
+            self._nouvelle_version = asyncio.Event()
+
+    # --- Streaming -------------------------------------------------------
+
+    def _message(self, depuis: Optional[str]) -> str:
+        """Événement SSE : diff par charge depuis `depuis`, ou état complet si version inconnue"""
+        actuelles = self._historique[self.version]
+        precedentes = self._historique.get(depuis) if depuis else None
+        if precedentes is None:
+            changements = actuelles
+        else:
+            changements = {cid: c for cid, c in actuelles.items() if precedentes.get(cid) != c}
+            changements.update({cid: None for cid in precedentes if cid not in actuelles})
+
+        donnees = {
+            "version": self.version,
+            "precedente": depuis if precedentes is not None else None,
+            "complet": precedentes is None,
+            "strategie": self.commandes["strategie"],
+            "score": self.commandes["score"],
+            "alerte": self.commandes["alerte"],
+            "charges": changements,
+        }
+        return f"id: {self.version}\nevent: commandes\ndata: {json.dumps(donnees, default=str)}\n\n"
+
+    async def flux(self, derniere_version: Optional[str] = None) -> AsyncIterator[str]:
+        """Générateur SSE d'une connexion (annulé par Starlette à la déconnexion)"""
+        if self._nouvelle_version is None:
+            self.demarrer()
+        self.connexions += 1
+        connue = derniere_version
+        try:
+            yield f"retry: {int(INTERVALLE_HEARTBEAT_S * 1000)}\n\n"
+            if self.version is None:
+                self.signaler()
+            while True:
+                if self.version and self.version != connue:
+                    yield self._message(connue)
+                    connue = self.version
+                    continue
+                evenement = self._nouvelle_version
+                try:
+                    await asyncio.wait_for(evenement.wait(), timeout=INTERVALLE_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.connexions -= 1
+
+    def get_statistiques(self) -> Dict:
+        return {"connexions": self.connexions, "version": self.version, "versions_gardees": len(self._historique)}
+
+
+diffuseur = DiffuseurCommandes()
@@ -0,0 +1,232 @@
+# etat_courant.py
+# Instantané en mémoire de l'état courant (dernière production, batterie, charges)
+# mis à jour à l'ingestion, pour servir les lectures sans toucher aux tables d'historique
+
+import os
+import logging
+import threading
+import time as chrono
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import update, or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import Charge, Production, Batterie, EtatCourantMiroir
+from ingestion import horodatage_local
+
+logger = logging.getLogger(__name__)
+
+# uvicorn and gunicorn read their worker count from WEB_CONCURRENCY
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1") or "1")
+# Mirror the snapshot to the etat_courant table: on by default with several workers
+MIROIR = os.getenv("ETAT_COURANT_MIROIR", "1" if WORKERS > 1 else "0") == "1"
+if WORKERS > 1 and not MIROIR:
+    logger.warning(f"ETAT_COURANT_MIROIR=0 avec {WORKERS} workers : chaque worker ne voit que ses propres mesures")
+RAFRAICHISSEMENT_MIROIR_S = float(os.getenv("ETAT_COURANT_RAFRAICHISSEMENT_S", "1"))
+# Charge states changed by another worker (or directly in the database), without the mirror
+RAFRAICHISSEMENT_CHARGES_S = float(os.getenv("ETAT_COURANT_CHARGES_S", "10"))
+FENETRE_RECENTE_S = 60
+
+
+class EtatCourant:
+    """État courant du site, protégé par un verrou (les handlers sync tournent dans un pool de threads)"""
+
+    def __init__(self, fabrique_session=SessionLocal, miroir: bool = MIROIR):
+        self.fabrique_session = fabrique_session
+        self.miroir = miroir
+        # Mirror row and charges re-read at this period (charges only without the mirror)
+        self.periode_synchro_s = RAFRAICHISSEMENT_MIROIR_S if miroir else RAFRAICHISSEMENT_CHARGES_S
+        self._verrou = threading.RLock()
+        self._initialise = False
+        self._derniere_synchro = 0.0
+
+        self.production: Optional[Dict] = None   # {"valeur", "timestamp"}
+        self.batterie: Optional[Dict] = None     # {"soc", "tension", "courant", "timestamp"}
+        self.charges: Dict[int, Dict] = {}
+        self._recents = deque()                  # (timestamp, production, batterie, consommations)
+        self._abonnes = []                       # callback(production, soc, timestamp) after each ingestion
+
+    def abonner(self, callback):
+        """Appelé avec la dernière mesure après chaque ingestion (hors verrou)"""
+        self._abonnes.append(callback)
+
+    # --- Loading ---------------------------------------------------------
+
+    def _charger(self, db: Session):
+        """Charge l'état depuis la base (requêtes indexées, une seule fois par processus)"""
+        if self.miroir:
+            self._lire_miroir(db)
+        if self.production is None:
+            p = db.query(Production).filter(Production.site_id.is_(None)).order_by(Production.timestamp.desc()).first()
+            if p:
+                self.production = {"valeur": p.production, "timestamp": p.timestamp}
+        if self.batterie is None:
+            b = db.query(Batterie).filter(Batterie.site_id.is_(None)).order_by(Batterie.timestamp.desc()).first()
+            if b:
+                self.batterie = {"soc": b.soc, "tension": b.tension, "courant": b.courant, "timestamp": b.timestamp}
+        self._charger_charges(db)
+
+    def _charger_charges(self, db: Session):
+        anciens = self.charges
+        self.charges = {}
+        for c in db.query(Charge).filter(Charge.site_id.is_(None)).all():
+            self.maj_charge(c)
+            if c.id in anciens and "consommation" in anciens[c.id]:
+                self.charges[c.id]["consommation"] = anciens[c.id]["consommation"]
+
+    def _lire_miroir(self, db: Session):
+        ligne = db.get(EtatCourantMiroir, 1)
+        if not ligne or not ligne.timestamp:
+            return
+        if not self.production or self.production["timestamp"] < ligne.timestamp:
+            self.production = {"valeur": ligne.production, "timestamp": ligne.timestamp}
+        if not self.batterie or self.batterie["timestamp"] < ligne.timestamp:
+            self.batterie = {"soc": ligne.soc, "tension": ligne.tension, "courant": ligne.courant,
+                             "timestamp": ligne.timestamp}
+
+    def est_a_jour(self) -> bool:
+        """False si une lecture doit d'abord interroger la base (initialisation, miroir ou charges)"""
+        return self._initialise and chrono.monotonic() - self._derniere_synchro <= self.periode_synchro_s
+
+    def synchroniser(self):
+        """Initialisation paresseuse, puis resynchronisation périodique (miroir, état des charges)"""
+        if self.est_a_jour():
+            return
+        with self._verrou:
+            db = self.fabrique_session()
+            try:
+                if not self._initialise:
+                    self._charger(db)
+                    self._initialise = True
+                else:
+                    if self.miroir:
+                        self._lire_miroir(db)
+                    self._charger_charges(db)
+            finally:
+                db.close()
+            self._derniere_synchro = chrono.monotonic()
+
+    # --- Updates ---------------------------------------------------------
+
+    def enregistrer_echantillons(self, echantillons: List, recu_le: Optional[datetime] = None):
+        """Appelé par l'ingestion avec des MesuresData (horodatage appareil ou réception)"""
+        recu_le = recu_le or datetime.now()
+        with self._verrou:
+            for e in echantillons:
+                if getattr(e, "site_id", None) is not None:
+                    continue  # Fleet site: its state is read from the tables by optimisation_flotte
+                timestamp = horodatage_local(getattr(e, "timestamp", None), recu_le)
+                consommations = {c.charge_id: c.consommation for c in e.consommations}
+                self._recents.append((timestamp, e.production,
+                                      (e.soc_batterie, e.tension_batterie, e.courant_batterie), consommations))
+                if self.production and self.production["timestamp"] > timestamp:
+                    continue  # Late sample from a batch: history only
+                self.production = {"valeur": e.production, "timestamp": timestamp}
+                self.batterie = {"soc": e.soc_batterie, "tension": e.tension_batterie,
+                                 "courant": e.courant_batterie, "timestamp": timestamp}
+                for charge_id, valeur in consommations.items():
+                    self.charges.setdefault(charge_id, {"id": charge_id})["consommation"] = valeur
+
+            limite = recu_le - timedelta(seconds=FENETRE_RECENTE_S)
+            while self._recents and self._recents[0][0] < limite:
+                self._recents.popleft()
+            derniere = (self.production, self.batterie)
+
+        production, batterie = derniere
+        if production and batterie:
+            for callback in self._abonnes:
+                callback(production["valeur"], batterie["soc"], production["timestamp"])
+
+    def maj_charge(self, charge: Charge):
+        if charge.site_id is not None:
+            return
+        with self._verrou:
+            entree = self.charges.setdefault(charge.id, {"id": charge.id})
+            entree.update({
+                "nom": charge.nom,
+                "type": charge.type,
+                "puissance_nominale": charge.puissance_nominale,
+                "etat": charge.etat,
+            })
+
+    def avant_commit_mesures(self, echantillons: List) -> Callable[[Session], None]:
+        """
+        Pour une écriture directe : seule la ligne miroir est écrite dans la transaction des mesures.
+        L'instantané n'avance qu'après le commit (enregistrer_echantillons), jamais sur un échantillon non écrit.
+        """
+        def avant_commit(db: Session):
+            self.ecrire_miroir(db, echantillons)
+        return avant_commit
+
+    def _valeurs_miroir(self, echantillons: Optional[List] = None) -> Optional[Dict]:
+        """Ligne miroir tirée de l'instantané, ou du plus récent des échantillons de l'installation historique"""
+        if echantillons is None:
+            with self._verrou:
+                if not self.batterie:
+                    return None
+                return {
+                    "timestamp": self.batterie["timestamp"],
+                    "production": self.production["valeur"] if self.production else 0,
+                    "soc": self.batterie["soc"],
+                    "tension": self.batterie["tension"],
+                    "courant": self.batterie["courant"],
+                }
+        recu_le = datetime.now()
+        datees = [(horodatage_local(getattr(e, "timestamp", None), recu_le), i, e)
+                  for i, e in enumerate(echantillons) if getattr(e, "site_id", None) is None]
+        if not datees:
+            return None
+        timestamp, _, e = max(datees, key=lambda d: d[:2])  # last one wins on equal timestamps
+        return {"timestamp": timestamp, "production": e.production, "soc": e.soc_batterie,
+                "tension": e.tension_batterie, "courant": e.courant_batterie}
+
+    def ecrire_miroir(self, db: Session, echantillons: Optional[List] = None):
+        """Met à jour la ligne miroir dans la transaction courante (sans commit)"""
+        if not self.miroir:
+            return
+        valeurs = self._valeurs_miroir(echantillons)
+        if valeurs is None:
+            return
+        # Only move forward in time: a slower worker must not overwrite a newer sample
+        resultat = db.execute(
+            update(EtatCourantMiroir)
+            .where(EtatCourantMiroir.id == 1)
+            .where(or_(EtatCourantMiroir.timestamp.is_(None), EtatCourantMiroir.timestamp <= valeurs["timestamp"]))
+            .values(**valeurs)
+        )
+        if resultat.rowcount == 0 and db.get(EtatCourantMiroir, 1) is None:
+            db.add(EtatCourantMiroir(id=1, **valeurs))
+
+    # --- Reads -----------------------------------------------------------
+
+    def instantane(self) -> Dict:
+        self.synchroniser()
+        with self._verrou:
+            return {
+                "production_actuelle": self.production["valeur"] if self.production else 0,
+                "soc_batterie": self.batterie["soc"] if self.batterie else 0,
+                "batterie": dict(self.batterie) if self.batterie else None,
+                "timestamp": self.batterie["timestamp"] if self.batterie else None,
+                "charges": [dict(c) for _, c in sorted(self.charges.items()) if "nom" in c],
+            }
+
+    def contexte_optimisation(self) -> Dict:
+        instantane = self.instantane()
+        return {
+            "production_actuelle": instantane["production_actuelle"],
+            "soc_batterie": instantane["soc_batterie"],
+            "evenement_special": False,
+        }
+
+    def mesures_recentes(self) -> List:
+        """Échantillons reçus par ce processus pendant la dernière minute, du plus récent au plus ancien"""
+        self.synchroniser()
+        limite = datetime.now() - timedelta(seconds=FENETRE_RECENTE_S)
+        with self._verrou:
+            return [m for m in reversed(self._recents) if m[0] >= limite]
+
+
+etat_courant = EtatCourant()
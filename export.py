@@ -0,0 +1,96 @@
+# export.py
+# Export en flux (NDJSON ou CSV) de l'historique : pagination par clé (timestamp, id)
+# et curseur côté serveur, mémoire constante quelle que soit la longueur de la période
+
+import io
+import os
+import csv
+import json
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+
+from database import SessionLocal
+from models import Production, Batterie, Consommation, Decision
+
+TAILLE_PAGE = int(os.getenv("EXPORT_TAILLE_PAGE", "5000"))
+
+TABLES_EXPORT = {
+    "production": Production,
+    "batterie": Batterie,
+    "consommation": Consommation,
+    "decisions": Decision,
+}
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def colonnes(modele) -> list:
+    return [c.name for c in modele.__table__.columns]
+
+
+def requete_page(modele, debut: Optional[datetime], fin: Optional[datetime],
+                 apres: Optional[Tuple[datetime, int]], taille: int):
+    """Page suivante après la clé (timestamp, id) : parcours de l'index ix_<table>_timestamp_id, sans OFFSET"""
+    requete = select(*modele.__table__.columns).where(modele.timestamp.isnot(None))
+    if debut:
+        requete = requete.where(modele.timestamp >= debut)
+    if fin:
+        requete = requete.where(modele.timestamp < fin)
+    if apres:
+        requete = requete.where(tuple_(modele.timestamp, modele.id) > tuple_(*apres))
+    return requete.order_by(modele.timestamp, modele.id).limit(taille)
+
+
+def pages(modele, debut: Optional[datetime] = None, fin: Optional[datetime] = None,
+          apres: Optional[Tuple[datetime, int]] = None, taille: int = TAILLE_PAGE) -> Iterator[list]:
+    """
+    Pages de lignes dans l'ordre (timestamp, id). Chaque page est une requête courte sur
+    sa propre session : pas de transaction ouverte pendant tout l'export, pas de connexion
+    du pool retenue pendant que le client lit.
+    """
+    while True:
+        with SessionLocal() as db:
+            resultat = db.execute(
+                requete_page(modele, debut, fin, apres, taille),
+                execution_options={"yield_per": 1000}  # server-side cursor on PostgreSQL
+            )
+            page = [tuple(ligne) for ligne in resultat]
+        if not page:
+            return
+        yield page
+        if len(page) < taille:
+            return
+        derniere = dict(zip(colonnes(modele), page[-1]))
+        apres = (derniere["timestamp"], derniere["id"])
+
+
+def _valeur(valeur):
+    return valeur.isoformat() if isinstance(valeur, datetime) else valeur
+
+
+def flux_ndjson(modele, **options) -> Iterator[str]:
+    noms = colonnes(modele)
+    for page in pages(modele, **options):
+        yield "".join(
+            json.dumps({nom: _valeur(v) for nom, v in zip(noms, ligne)}, ensure_ascii=False) + "\n"
+            for ligne in page
+        )
+
+
+def flux_csv(modele, **options) -> Iterator[str]:
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon)
+    ecrivain.writerow(colonnes(modele))
+    for page in pages(modele, **options):
+        ecrivain.writerows([_valeur(v) for v in ligne] for ligne in page)
+        yield tampon.getvalue()
+        tampon.seek(0)
+        tampon.truncate()
+    if tampon.tell():
+        yield tampon.getvalue()  # header only: empty period
+
+
+def flux_export(table: str, format: str, **options) -> Iterator[str]:
+    modele = TABLES_EXPORT[table]
+    return flux_csv(modele, **options) if format == "csv" else flux_ndjson(modele, **options)
@@ -0,0 +1,153 @@
+# fournisseur_local.py
+# Fournisseur de prévisions hors ligne (SOLCAST_FOURNISSEUR=local) : sert, au format exact
+# de la liste "forecasts" de l'API Solcast, des prévisions enregistrées (SOLCAST_LOCAL_FICHIER,
+# par exemple un cache_solcast.json ou une réponse brute de l'API) ou synthétiques
+# (courbe en cloche entre lever et coucher du soleil, nébulosité tirée par jour et par site).
+# La latence et les réponses 429 sont simulables ; tout est déterministe pour une graine donnée.
+
+import os
+import json
+import math
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+from client_solcast import FournisseurPrevisions, CleIndisponible
+
+FICHIER = os.getenv("SOLCAST_LOCAL_FICHIER", "")  # vide : prévisions synthétiques
+LATENCE_MS = float(os.getenv("SOLCAST_LOCAL_LATENCE_MS", "0"))
+TAUX_429 = float(os.getenv("SOLCAST_LOCAL_TAUX_429", "0"))  # probabilité de 429 par appel
+QUOTA = int(os.getenv("SOLCAST_LOCAL_QUOTA", "0"))  # appels par clé et par jour, 0 : illimité
+CRETE_KW = float(os.getenv("SOLCAST_LOCAL_CRETE_KW", "5"))
+GRAINE = os.getenv("SOLCAST_LOCAL_GRAINE", "0")
+HEURE_LEVER = float(os.getenv("SOLCAST_HEURE_LEVER", "6"))
+HEURE_COUCHER = float(os.getenv("SOLCAST_HEURE_COUCHER", "19"))
+# Site timezone for sunrise and sunset (IANA name): never the host's, so a replay is reproducible
+FUSEAU = os.getenv("SOLCAST_LOCAL_FUSEAU", "UTC")
+
+PAS = timedelta(minutes=30)
+
+
+def _lire_instant(valeur: str) -> datetime:
+    """'2024-06-01T10:30:00.0000000Z' ou '2024-06-01T00:00:00Z' -> datetime UTC naïf"""
+    return datetime.fromisoformat(valeur[:19])
+
+
+def _ecrire_instant(instant: datetime) -> str:
+    return instant.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def charger_enregistrement(chemin: str) -> List[Dict]:
+    """Prévisions d'un fichier : liste, réponse API {"forecasts": [...]} ou cache partagé {"espace": {"previsions": [...]}}"""
+    with open(chemin, "r", encoding="utf-8") as f:
+        donnees = json.load(f)
+    if isinstance(donnees, list):
+        return donnees
+    if "forecasts" in donnees:
+        return donnees["forecasts"]
+    return next((e["previsions"] for e in donnees.values() if isinstance(e, dict) and e.get("previsions")), [])
+
+
+def previsions_synthetiques(site_id: str, debut: datetime, fin: datetime, crete_kw: float = CRETE_KW,
+                            graine: str = GRAINE, heure_lever: float = HEURE_LEVER,
+                            heure_coucher: float = HEURE_COUCHER, fuseau: str = FUSEAU) -> List[Dict]:
+    """
+    Créneaux de 30 min de ]debut, fin] (UTC naïf). Le lever et le coucher sont en heure locale
+    du fuseau du site (pas celui de l'hôte) ; la nébulosité d'un jour ne dépend que de
+    (graine, site, jour).
+    """
+    zone = ZoneInfo(fuseau)
+    previsions = []
+    fin_creneau = debut.replace(minute=0 if debut.minute < 30 else 30, second=0, microsecond=0) + PAS
+    nebulosite_jour = {}
+    while fin_creneau <= fin:
+        milieu = (fin_creneau - PAS / 2).replace(tzinfo=timezone.utc).astimezone(zone)
+        jour = milieu.date()
+        if jour not in nebulosite_jour:
+            tirage = random.Random(f"{graine}:{site_id}:{jour.isoformat()}")
+            nebulosite_jour[jour] = (tirage.betavariate(1.2, 2.0), tirage)
+        base, tirage = nebulosite_jour[jour]
+        opacite = min(max(base + tirage.gauss(0, 0.08), 0.0), 1.0)
+
+        heure = milieu.hour + milieu.minute / 60
+        soleil = math.sin(math.pi * (heure - heure_lever) / (heure_coucher - heure_lever)) \
+            if heure_lever < heure < heure_coucher else 0.0
+        p50 = crete_kw * soleil * (1 - 0.75 * opacite)
+        # Wider P10-P90 band under broken clouds
+        ecart = 0.15 + 0.5 * opacite * (1 - opacite)
+        previsions.append({
+            "pv_estimate": round(p50, 4),
+            "pv_estimate10": round(p50 * (1 - ecart), 4),
+            "pv_estimate90": round(min(p50 * (1 + ecart), crete_kw * soleil), 4),
+            "cloud_opacity": round(opacite, 3),
+            "period_end": _ecrire_instant(fin_creneau),
+            "period": "PT30M",
+        })
+        fin_creneau += PAS
+    return previsions
+
+
+class FournisseurLocal(FournisseurPrevisions):
+    """Même contrat que ClientSolcast, sans réseau"""
+
+    def __init__(self, fichier: str = FICHIER, latence_ms: float = LATENCE_MS, taux_429: float = TAUX_429,
+                 quota: int = QUOTA, graine: str = GRAINE, fuseau: str = FUSEAU):
+        self.fuseau = fuseau
+        self.enregistrement = charger_enregistrement(fichier) if fichier else None
+        self.latence_ms = latence_ms
+        self.taux_429 = taux_429
+        self.quota = quota
+        self.graine = graine
+        self._tirage = random.Random(f"{graine}:429")
+        self._appels: Dict[str, Dict] = {}
+        self._verrou = threading.Lock()
+
+    def _enregistrees(self, debut: datetime, fin: datetime) -> List[Dict]:
+        """
+        Créneaux enregistrés de la fenêtre ; si l'enregistrement ne la couvre pas, son premier
+        jour est recopié à la date demandée (même profil horaire)
+        """
+        dans_fenetre = [p for p in self.enregistrement if debut < _lire_instant(p["period_end"]) <= fin]
+        if dans_fenetre or not self.enregistrement:
+            return dans_fenetre
+        premier_jour = min(_lire_instant(p["period_end"]) for p in self.enregistrement).date()
+        decalage = datetime.combine(debut.date(), datetime.min.time()) - datetime.combine(premier_jour, datetime.min.time())
+        projetees = []
+        for p in self.enregistrement:
+            instant = _lire_instant(p["period_end"]) + decalage
+            if debut < instant <= fin:
+                projetees.append({**p, "period_end": _ecrire_instant(instant)})
+        return projetees
+
+    def previsions(self, api_key: str, site_id: str, debut: str, fin: str) -> List[Dict]:
+        libelle = self._libelle(api_key, site_id)
+        with self._verrou:
+            compteur = self._appels.setdefault(libelle, {"appels": 0, "erreurs_429": 0, "jour": None, "du_jour": 0})
+            aujourd_hui = datetime.now().date()
+            if compteur["jour"] != aujourd_hui:
+                compteur["jour"], compteur["du_jour"] = aujourd_hui, 0
+            compteur["appels"] += 1
+            compteur["du_jour"] += 1
+            refus = (self.quota and compteur["du_jour"] > self.quota) or self._tirage.random() < self.taux_429
+            if refus:
+                compteur["erreurs_429"] += 1
+        if self.latence_ms:
+            time.sleep(self.latence_ms / 1000)
+        if refus:
+            raise CleIndisponible(f"HTTP 429 simulé pour {libelle}")
+
+        debut_utc, fin_utc = _lire_instant(debut), _lire_instant(fin)
+        if self.enregistrement is not None:
+            return self._enregistrees(debut_utc, fin_utc)
+        return previsions_synthetiques(site_id, debut_utc, fin_utc, graine=self.graine, fuseau=self.fuseau)
+
+    def statistiques(self) -> Dict:
+        with self._verrou:
+            return {
+                libelle: {"appels": c["appels"], "erreurs": c["erreurs_429"], "quota_ou_introuvable": c["erreurs_429"],
+                          "latence_p50_ms": self.latence_ms, "disjoncteur": "ferme", "fournisseur": "local"}
+                for libelle, c in self._appels.items()
+            }
@@ -0,0 +1,394 @@
+# ingestion.py
+# Écriture groupée des mesures Arduino (production, batterie, consommations)
+
+import os
+import atexit
+import logging
+import threading
+import time as chrono
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as DelaiPoolDepasse
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import SessionLocal
+from models import Production, Batterie, Consommation, Charge, Site
+import agregats
+from agregats import AGREGATS_ACTIFS
+from metriques import INGESTION_LIGNES, INGESTION_ECRITURES
+
+logger = logging.getLogger(__name__)
+
+# "tampon" : écriture différée avec commits groupés, "direct" : un commit par requête
+INGESTION_MODE = os.getenv("INGESTION_MODE", "tampon")
+# Attempts of a row that keeps failing on its own before it is dropped (tampon mode)
+TENTATIVES_MAX = int(os.getenv("INGESTION_TENTATIVES_MAX", "3"))
+
+TABLES = {
+    "production": Production,
+    "batterie": Batterie,
+    "consommation": Consommation,
+}
+
+
+def horodatage_local(timestamp: Optional[datetime], defaut: datetime) -> datetime:
+    """Les colonnes TIMESTAMP sont en heure locale naïve, comme datetime.now()"""
+    if timestamp is None:
+        return defaut
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+def construire_lignes(echantillons: Iterable, recu_le: Optional[datetime] = None) -> Dict[str, List[Dict]]:
+    """Convertit des échantillons MesuresData en lignes prêtes pour un INSERT multi-lignes"""
+    recu_le = recu_le or datetime.now()
+    lignes = {nom: [] for nom in TABLES}
+
+    for echantillon in echantillons:
+        timestamp = horodatage_local(getattr(echantillon, "timestamp", None), recu_le)
+        # Always present so every row of a multi-row INSERT has the same keys
+        site_id = getattr(echantillon, "site_id", None)
+        lignes["production"].append({"timestamp": timestamp, "production": echantillon.production, "site_id": site_id})
+        lignes["batterie"].append({
+            "timestamp": timestamp,
+            "soc": echantillon.soc_batterie,
+            "tension": echantillon.tension_batterie,
+            "courant": echantillon.courant_batterie,
+            "site_id": site_id,
+        })
+        for cons in echantillon.consommations:
+            lignes["consommation"].append({
+                "timestamp": timestamp,
+                "id_charge": cons.charge_id,
+                "consommation": cons.consommation,
+                "site_id": site_id,
+            })
+
+    return lignes
+
+
+class ReferenceInconnue(ValueError):
+    """Échantillon qui cite une charge ou un site absent de la base"""
+
+
+class ReferencesConnues:
+    """
+    Identifiants des charges et des sites, vérifiés avant d'accepter un échantillon :
+    en mode tampon la réponse 200 part avant l'INSERT, une clé étrangère invalide
+    doit donc être refusée ici. Rechargés depuis la base à chaque identifiant inconnu
+    (tables de quelques lignes), pour voir les charges créées par un autre worker.
+    """
+
+    def __init__(self, fabrique_session=SessionLocal):
+        self.fabrique_session = fabrique_session
+        self._verrou = threading.Lock()
+        self._charges: Set[int] = set()
+        self._sites: Set[int] = set()
+
+    def _recharger(self):
+        db = self.fabrique_session()
+        try:
+            charges = set(db.execute(select(Charge.id)).scalars())
+            sites = set(db.execute(select(Site.id)).scalars())
+        finally:
+            db.close()
+        with self._verrou:
+            self._charges, self._sites = charges, sites
+
+    @staticmethod
+    def _citees(echantillons: Iterable) -> Tuple[Set[int], Set[int]]:
+        charges, sites = set(), set()
+        for echantillon in echantillons:
+            if getattr(echantillon, "site_id", None) is not None:
+                sites.add(echantillon.site_id)
+            charges.update(cons.charge_id for cons in echantillon.consommations)
+        return charges, sites
+
+    def _inconnues(self, charges: Set[int], sites: Set[int]) -> Tuple[Set[int], Set[int]]:
+        with self._verrou:
+            return charges - self._charges, sites - self._sites
+
+    def connues(self, echantillons: Iterable) -> bool:
+        """Vérification en mémoire seulement (sans requête, utilisable sur la boucle async)"""
+        return not any(self._inconnues(*self._citees(echantillons)))
+
+    def verifier(self, echantillons: Iterable):
+        """Lève ReferenceInconnue si un échantillon cite une charge ou un site inconnu"""
+        charges, sites = self._citees(echantillons)
+        if not any(self._inconnues(charges, sites)):
+            return
+        self._recharger()
+        charges_inconnues, sites_inconnus = self._inconnues(charges, sites)
+        if charges_inconnues:
+            raise ReferenceInconnue(f"Charge(s) inconnue(s): {sorted(charges_inconnues)}")
+        if sites_inconnus:
+            raise ReferenceInconnue(f"Site(s) inconnu(s): {sorted(sites_inconnus)}")
+
+
+references = ReferencesConnues()
+
+
+def erreur_transitoire(erreur: Exception) -> bool:
+    """Base injoignable ou surchargée : le lot sera réécrit tel quel (à l'inverse d'une ligne invalide)"""
+    return isinstance(erreur, (OperationalError, InterfaceError, DelaiPoolDepasse)) or \
+        getattr(erreur, "connection_invalidated", False)
+
+
+def inserer_lignes(db: Session, lignes: Dict[str, List[Dict]]) -> int:
+    """Un seul INSERT multi-lignes par table, plus la mise à jour des agrégats (sans commit)"""
+    total = 0
+    for nom, modele in TABLES.items():
+        if lignes.get(nom):
+            db.execute(insert(modele), lignes[nom])
+            total += len(lignes[nom])
+    if total and AGREGATS_ACTIFS:
+        agregats.mettre_a_jour(db, lignes)
+    return total
+
+
+def enregistrer_mesures(db: Session, echantillons: List, avant_commit: Optional[Callable[[Session], None]] = None) -> Dict:
+    """Insère un lot d'échantillons en une transaction et mesure le débit"""
+    debut = chrono.perf_counter()
+    lignes = construire_lignes(echantillons)
+    total = inserer_lignes(db, lignes)
+    if avant_commit:
+        avant_commit(db)
+    db.commit()
+    return _bilan(echantillons, lignes, total, chrono.perf_counter() - debut)
+
+
+async def enregistrer_mesures_async(db: AsyncSession, echantillons: List,
+                                    avant_commit: Optional[Callable[[Session], None]] = None) -> Dict:
+    """Version async (DB_MODE=async) : mêmes INSERT, exécutés sans bloquer la boucle"""
+    debut = chrono.perf_counter()
+    lignes = construire_lignes(echantillons)
+    total = await db.run_sync(inserer_lignes, lignes)
+    if avant_commit:
+        await db.run_sync(avant_commit)
+    await db.commit()
+    return _bilan(echantillons, lignes, total, chrono.perf_counter() - debut)
+
+
+def noter_ecriture(lignes: Dict[str, List[Dict]], duree: float, mode: str):
+    """Métriques d'un lot validé en base (débit : rate(ingestion_lignes_total))"""
+    for nom, valeurs in lignes.items():
+        if valeurs:
+            INGESTION_LIGNES.inc(len(valeurs), table=nom, mode=mode)
+    INGESTION_ECRITURES.observe(duree, mode=mode)
+
+
+def _bilan(echantillons: List, lignes: Dict[str, List[Dict]], total: int, duree: float) -> Dict:
+    noter_ecriture(lignes, duree, "direct")
+    return {
+        "echantillons": len(echantillons),
+        "lignes": {nom: len(valeurs) for nom, valeurs in lignes.items()},
+        "lignes_total": total,
+        "duree_ms": round(duree * 1000, 2),
+        "lignes_par_seconde": round(total / duree, 1) if duree > 0 else None,
+    }
+
+
+class TamponPlein(Exception):
+    """Le tampon d'ingestion est plein (la base ne suit pas)"""
+
+
+class TamponIngestion:
+    """
+    Tampon d'écriture différée : les requêtes déposent leurs lignes et repartent,
+    un thread écrit le tout en commits groupés toutes les `intervalle_ms` ms
+    ou dès que `lignes_max` lignes sont en attente.
+    Si un commit groupé échoue sur une erreur transitoire (base injoignable), le lot est remis
+    en tête du tampon ; sinon ses lignes sont réécrites une à une, et une ligne qui échoue
+    `tentatives_max` fois est écartée (journalisée, comptée dans lignes_rejetees).
+    """
+
+    def __init__(self, fabrique_session=SessionLocal, capacite: int = 50_000,
+                 intervalle_ms: int = 200, lignes_max: int = 2_000, attente_max_s: float = 2.0,
+                 tentatives_max: int = TENTATIVES_MAX):
+        self.fabrique_session = fabrique_session
+        # Extra writes done in the same transaction as each group commit
+        self.avant_commit: Optional[Callable[[Session], None]] = None
+        self.capacite = capacite
+        self.intervalle_s = intervalle_ms / 1000
+        self.lignes_max = lignes_max
+        self.attente_max_s = attente_max_s
+        self.tentatives_max = tentatives_max
+
+        self._condition = threading.Condition()
+        self._lignes = {nom: [] for nom in TABLES}
+        self._taille = 0
+        self._a_reessayer: List[Tuple[str, Dict, int]] = []  # (table, ligne, échecs), rejouées une à une
+        self._arret = False
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_enregistre = False
+
+        self.stats = {"lignes_ecrites": 0, "commits": 0, "echecs": 0, "refus": 0, "lignes_rejetees": 0,
+                      "derniere_duree_ms": 0.0}
+
+    @property
+    def actif(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def demarrer(self):
+        if self.actif:
+            return
+        self._arret = False
+        self._thread = threading.Thread(target=self._boucle, name="tampon-ingestion", daemon=True)
+        self._thread.start()
+        if not self._atexit_enregistre:
+            # Final flush at exit, registered once however many times the buffer is restarted
+            atexit.register(self.arreter)
+            self._atexit_enregistre = True
+
+    def ajouter(self, lignes: Dict[str, List[Dict]], attente_max_s: Optional[float] = None) -> int:
+        """Dépose des lignes ; bloque au plus `attente_max_s` si le tampon est plein"""
+        n = sum(len(v) for v in lignes.values())
+        attente = self.attente_max_s if attente_max_s is None else attente_max_s
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._taille + n <= self.capacite, timeout=attente):
+                self.stats["refus"] += 1
+                raise TamponPlein(f"Tampon d'ingestion plein ({self._taille}/{self.capacite} lignes)")
+            for nom, valeurs in lignes.items():
+                self._lignes[nom].extend(valeurs)
+            self._taille += n
+            if self._taille >= self.lignes_max:
+                self._condition.notify_all()
+        return n
+
+    def _extraire(self) -> Dict[str, List[Dict]]:
+        lot = self._lignes
+        self._lignes = {nom: [] for nom in TABLES}
+        self._taille = 0
+        self._condition.notify_all()  # Wake up producers waiting for room
+        return lot
+
+    def _remettre(self, lot: Dict[str, List[Dict]]):
+        """Remet un lot non écrit en tête du tampon (aucun échantillon perdu)"""
+        with self._condition:
+            for nom, valeurs in lot.items():
+                self._lignes[nom] = valeurs + self._lignes[nom]
+                self._taille += len(valeurs)
+
+    def _ecrire(self, lot: Dict[str, List[Dict]]) -> bool:
+        debut = chrono.perf_counter()
+        db = self.fabrique_session()
+        try:
+            total = inserer_lignes(db, lot)
+            if self.avant_commit:
+                self.avant_commit(db)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.stats["echecs"] += 1
+            if erreur_transitoire(e):
+                logger.error(f"Erreur écriture groupée des mesures: {e}")
+                self._remettre(lot)
+                return False
+            # A bad row must not block the rows behind it: isolate it
+            logger.error(f"Erreur écriture groupée des mesures, lot réécrit ligne par ligne: {e}")
+            return self._ecrire_une_a_une([(nom, ligne, 0) for nom, valeurs in lot.items() for ligne in valeurs])
+        finally:
+            db.close()
+        self._noter_commit(lot, total, chrono.perf_counter() - debut)
+        return True
+
+    def _ecrire_une_a_une(self, entrees: List[Tuple[str, Dict, int]]) -> bool:
+        """Une transaction, un point de sauvegarde par ligne : seules les lignes fautives restent en attente"""
+        debut = chrono.perf_counter()
+        ecrites = {nom: [] for nom in TABLES}
+        echouees = []
+        db = self.fabrique_session()
+        try:
+            for nom, ligne, echecs in entrees:
+                try:
+                    with db.begin_nested():
+                        db.execute(insert(TABLES[nom]), [ligne])
+                except Exception as e:
+                    if erreur_transitoire(e):
+                        raise
+                    echouees.append((nom, ligne, echecs + 1, e))
+                else:
+                    ecrites[nom].append(ligne)
+            total = sum(len(v) for v in ecrites.values())
+            if total and AGREGATS_ACTIFS:
+                agregats.mettre_a_jour(db, ecrites)
+            if self.avant_commit:
+                self.avant_commit(db)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.stats["echecs"] += 1
+            logger.error(f"Erreur écriture ligne par ligne des mesures: {e}")
+            transitoire = erreur_transitoire(e)
+            self._garder([(nom, ligne, echecs if transitoire else echecs + 1, e) for nom, ligne, echecs in entrees])
+            return False
+        finally:
+            db.close()
+        self._garder(echouees)
+        if total:
+            self._noter_commit(ecrites, total, chrono.perf_counter() - debut)
+        return True
+
+    def _garder(self, echouees: List[Tuple[str, Dict, int, Exception]]):
+        """Remet les lignes fautives en attente, ou les écarte après tentatives_max échecs"""
+        gardees = []
+        for nom, ligne, echecs, erreur in echouees:
+            if echecs >= self.tentatives_max:
+                self.stats["lignes_rejetees"] += 1
+                logger.error(f"Ligne {nom} écartée après {echecs} échec(s): {ligne} ({erreur})")
+            else:
+                gardees.append((nom, ligne, echecs))
+        with self._condition:
+            self._a_reessayer = gardees + self._a_reessayer
+
+    def _noter_commit(self, lot: Dict[str, List[Dict]], total: int, duree: float):
+        self.stats["lignes_ecrites"] += total
+        self.stats["commits"] += 1
+        self.stats["derniere_duree_ms"] = round(duree * 1000, 2)
+        noter_ecriture(lot, duree, "tampon")
+
+    def _boucle(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._taille >= self.lignes_max or self._arret,
+                                         timeout=self.intervalle_s)
+                if self._arret and self._taille == 0 and not self._a_reessayer:
+                    return
+                lot = self._extraire() if self._taille else None
+                a_reessayer, self._a_reessayer = self._a_reessayer, []
+            ecrit = self._ecrire(lot) if lot else True
+            if a_reessayer:
+                ecrit = self._ecrire_une_a_une(a_reessayer) and ecrit
+            if not ecrit:
+                # Back off before retrying; pending rows stay in the buffer
+                chrono.sleep(min(1.0, self.intervalle_s * 5))
+
+    def arreter(self, timeout: float = 30.0):
+        """Arrêt propre : vide le tampon avant de rendre la main"""
+        if not self._thread:
+            return
+        with self._condition:
+            self._arret = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Tampon d'ingestion non vidé à l'arrêt ({self._taille} lignes en attente)")
+        self._thread = None
+
+    def get_statistiques(self) -> Dict:
+        with self._condition:
+            taille = self._taille
+            a_reessayer = len(self._a_reessayer)
+        return {"actif": self.actif, "en_attente": taille, "a_reessayer": a_reessayer, "capacite": self.capacite,
+                **self.stats}
+
+
+tampon = TamponIngestion(
+    capacite=int(os.getenv("INGESTION_TAMPON_CAPACITE", "50000")),
+    intervalle_ms=int(os.getenv("INGESTION_FLUSH_MS", "200")),
+    lignes_max=int(os.getenv("INGESTION_FLUSH_LIGNES", "2000")),
+)
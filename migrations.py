@@ -0,0 +1,200 @@
+# migrations.py
+# Mise à niveau des bases existantes : create_all() ne crée ni les colonnes ni les index
+# des tables déjà présentes.
+#
+# Commande explicite, lancée une fois par déploiement avant les workers : python migrations.py
+# Au démarrage, chaque worker crée seulement les tables manquantes et signale les migrations
+# en attente (preparer_base), sans construire d'index.
+
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from database import Base, engine
+import partitionnement
+
+logger = logging.getLogger(__name__)
+
+TABLES_AGREGATS = ("agregat_production", "agregat_batterie", "agregat_consommation", "agregat_dernier_point")
+
+
+def ajouter_colonnes_manquantes(moteur: Engine = engine) -> list:
+    """
+    Ajoute les colonnes nullables déclarées dans models.py qui manquent en base
+    (ALTER TABLE ... ADD COLUMN, sans réécriture de la table).
+    """
+    inspecteur = inspect(moteur)
+    tables_existantes = set(inspecteur.get_table_names())
+    ajoutees = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables_existantes:
+            continue
+        colonnes_existantes = {c["name"] for c in inspecteur.get_columns(table.name)}
+        for colonne in table.columns:
+            if colonne.name in colonnes_existantes:
+                continue
+            if not colonne.nullable:
+                logger.error(f"Colonne non nullable {table.name}.{colonne.name} : migration manuelle requise")
+                continue
+            definition = f"{colonne.name} {colonne.type.compile(dialect=moteur.dialect)}"
+            for fk in colonne.foreign_keys:
+                definition += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+            with moteur.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+            ajoutees.append(f"{table.name}.{colonne.name}")
+            logger.info(f"Colonne ajoutée: {table.name}.{colonne.name}")
+
+    return ajoutees
+
+
+def migrer_agregats_par_site(moteur: Engine = engine) -> list:
+    """
+    Ajoute site_id à la clé primaire des agrégats (0 : installation historique). Les créneaux
+    existants sont rattachés à l'installation historique ; si des sites de la flotte ont déjà
+    envoyé des mesures, `python agregats.py reconstruire` les sépare.
+    """
+    inspecteur = inspect(moteur)
+    tables_existantes = set(inspecteur.get_table_names())
+    migrees = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in TABLES_AGREGATS or table.name not in tables_existantes:
+            continue
+        if "site_id" in {c["name"] for c in inspecteur.get_columns(table.name)}:
+            continue
+        cles = ", ".join(c.name for c in table.primary_key)
+        colonnes = ", ".join(c.name for c in table.columns if c.name != "site_id")
+        with moteur.begin() as conn:
+            if moteur.dialect.name == "postgresql":
+                contrainte = inspecteur.get_pk_constraint(table.name)["name"]
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN site_id INTEGER NOT NULL DEFAULT 0"))
+                conn.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {contrainte}, ADD PRIMARY KEY ({cles})"))
+            else:
+                # SQLite cannot change a primary key: copy into a new table
+                conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_avant_sites"))
+                table.create(bind=conn)
+                conn.execute(text(
+                    f"INSERT INTO {table.name} ({colonnes}, site_id) SELECT {colonnes}, 0 FROM {table.name}_avant_sites"
+                ))
+                conn.execute(text(f"DROP TABLE {table.name}_avant_sites"))
+        migrees.append(table.name)
+        logger.info(f"Agrégats par site: {table.name} migrée")
+
+    if migrees and "production" in tables_existantes:
+        with moteur.connect() as conn:
+            flotte = conn.execute(text("SELECT 1 FROM production WHERE site_id IS NOT NULL LIMIT 1")).first()
+        if flotte:
+            logger.warning("Des mesures de sites de la flotte sont mêlées aux agrégats existants : "
+                           "lancer `python agregats.py reconstruire`")
+    return migrees
+
+
+def index_invalides(moteur: Engine = engine) -> set:
+    """
+    Index laissés INVALID par un CREATE INDEX CONCURRENTLY interrompu ou en échec (PostgreSQL) :
+    IF NOT EXISTS les considère comme présents, ils doivent être supprimés puis reconstruits
+    """
+    if moteur.dialect.name != "postgresql":
+        return set()
+    with moteur.connect() as conn:
+        return {nom for (nom,) in conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid)"
+        ))}
+
+
+def creer_index_manquants(moteur: Engine = engine) -> list:
+    """
+    Crée les index déclarés dans models.py qui manquent en base, et reconstruit ceux
+    qu'une construction interrompue a laissés invalides.
+    Sur PostgreSQL, CREATE INDEX CONCURRENTLY évite de bloquer l'ingestion
+    pendant la construction sur de grosses tables (sauf tables partitionnées,
+    qui ne le supportent pas).
+    """
+    inspecteur = inspect(moteur)
+    tables_existantes = set(inspecteur.get_table_names())
+    invalides = index_invalides(moteur)
+    crees = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables_existantes:
+            continue
+        index_existants = {i["name"] for i in inspecteur.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in index_existants and index.name not in invalides:
+                continue
+            try:
+                concurrent = moteur.dialect.name == "postgresql" and not partitionnement.est_partitionnee(moteur, table.name)
+                if index.name in invalides:
+                    with moteur.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        conn.execute(text(f"DROP INDEX {'CONCURRENTLY ' if concurrent else ''}IF EXISTS {index.name}"))
+                    logger.warning(f"Index invalide supprimé avant reconstruction: {index.name}")
+                if concurrent:
+                    colonnes = ", ".join(c.name for c in index.columns)
+                    with moteur.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        conn.execute(text(
+                            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {table.name} ({colonnes})"
+                        ))
+                else:
+                    index.create(bind=moteur, checkfirst=True)
+                crees.append(index.name)
+                logger.info(f"Index créé: {index.name}")
+            except Exception as e:
+                logger.error(f"Erreur création index {index.name}: {e}")
+
+    return crees
+
+
+def migrations_en_attente(moteur: Engine = engine) -> list:
+    """Colonnes et index (manquants ou invalides) à migrer, d'après le catalogue seulement"""
+    inspecteur = inspect(moteur)
+    tables_existantes = set(inspecteur.get_table_names())
+    invalides = index_invalides(moteur)
+    attente = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables_existantes:
+            continue
+        colonnes = {c["name"] for c in inspecteur.get_columns(table.name)}
+        attente += [f"{table.name}.{c.name}" for c in table.columns if c.name not in colonnes]
+        index_existants = {i["name"] for i in inspecteur.get_indexes(table.name)}
+        attente += [f"{i.name}{' (invalide)' if i.name in invalides else ''}" for i in table.indexes
+                    if i.name not in index_existants or i.name in invalides]
+    return attente
+
+
+def creer_tables(moteur: Engine = engine):
+    """Crée les tables manquantes (partitionnées si PARTITIONNEMENT est défini)"""
+    partitionnees = partitionnement.tables_a_creer(moteur)
+    Base.metadata.create_all(bind=moteur, tables=[t for t in Base.metadata.sorted_tables if t not in partitionnees])
+    partitionnement.creer_tables(moteur, partitionnees)
+
+
+def preparer_base(moteur: Engine = engine) -> list:
+    """
+    Au démarrage d'un worker : tables manquantes seulement (base neuve). Les colonnes et index
+    d'une base existante sont laissés à `python migrations.py`, une construction d'index sur une
+    grosse table ne doit ni retarder le démarrage ni être lancée par chaque worker en parallèle.
+    """
+    creer_tables(moteur)
+    attente = migrations_en_attente(moteur)
+    if attente:
+        logger.warning(f"Migrations en attente ({', '.join(attente)}) : lancer `python migrations.py`")
+    return attente
+
+
+def appliquer_migrations(moteur: Engine = engine):
+    """
+    Crée les tables manquantes, passe les agrégats par site, puis ajoute les colonnes
+    et index manquants (reconstruit les index invalides)
+    """
+    creer_tables(moteur)
+    migrer_agregats_par_site(moteur)
+    ajouter_colonnes_manquantes(moteur)
+    return creer_index_manquants(moteur)
+
+
+if __name__ == "__main__":
+    import models  # noqa: F401  (registers the tables on Base.metadata)
+    logging.basicConfig(level=logging.INFO)
+    print("Index créés :", appliquer_migrations() or "aucun")
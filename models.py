@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Date, Time, Text, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Date, Time, Text, TIMESTAMP, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -10,6 +10,15 @@ class Utilisateur(Base):
     email = Column(String(100))
     mot_de_passe = Column(String(255))
 
+class Site(Base):
+    """Installation (batterie, charges, mesures) liée à son site Solcast ; site_id NULL = installation historique"""
+    __tablename__ = 'sites'
+    id = Column(Integer, primary_key=True, index=True)
+    nom = Column(String(100))
+    solcast_site_id = Column(String(100))
+    capacite_batterie_kwh = Column(Float)
+    puissance_batterie_kw = Column(Float)
+
 class Charge(Base):
     __tablename__ = 'charges'
     id = Column(Integer, primary_key=True, index=True)
@@ -17,28 +26,47 @@ class Charge(Base):
     type = Column(String(20))  # prioritaire, semi-prioritaire, non-prioritaire
     puissance_nominale = Column(Float)
     etat = Column(Boolean, default=False)
+    site_id = Column(Integer, ForeignKey('sites.id'), index=True)
 
 class Consommation(Base):
     __tablename__ = 'consommation'
     id = Column(Integer, primary_key=True, index=True)
     id_charge = Column(Integer, ForeignKey('charges.id'))
-    timestamp = Column(TIMESTAMP)
+    timestamp = Column(TIMESTAMP, index=True)
     consommation = Column(Float)
+    site_id = Column(Integer, ForeignKey('sites.id'))
     charge = relationship('Charge')
+    __table_args__ = (
+        # Latest value and history of one charge
+        Index('ix_consommation_charge_timestamp', 'id_charge', 'timestamp'),
+        # Keyset pagination of the export (export.py)
+        Index('ix_consommation_timestamp_id', 'timestamp', 'id'),
+    )
 
 class Production(Base):
     __tablename__ = 'production'
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(TIMESTAMP)
+    timestamp = Column(TIMESTAMP, index=True)
     production = Column(Float)
+    site_id = Column(Integer, ForeignKey('sites.id'))
+    __table_args__ = (
+        Index('ix_production_timestamp_id', 'timestamp', 'id'),
+        # Latest value per site (fleet optimisation)
+        Index('ix_production_site_timestamp', 'site_id', 'timestamp'),
+    )
 
 class Batterie(Base):
     __tablename__ = 'batterie'
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(TIMESTAMP)
+    timestamp = Column(TIMESTAMP, index=True)
     soc = Column(Float)
     tension = Column(Float)
     courant = Column(Float)
+    site_id = Column(Integer, ForeignKey('sites.id'))
+    __table_args__ = (
+        Index('ix_batterie_timestamp_id', 'timestamp', 'id'),
+        Index('ix_batterie_site_timestamp', 'site_id', 'timestamp'),
+    )
 
 class Calendrier(Base):
     __tablename__ = 'calendrier'
@@ -53,9 +81,64 @@ class Calendrier(Base):
 class Decision(Base):
     __tablename__ = 'decisions'
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(TIMESTAMP)
+    timestamp = Column(TIMESTAMP, index=True)
     action = Column(String(100))
     cible = Column(String(100))
     raison = Column(Text)
     utilisateur = Column(Integer, ForeignKey('utilisateur.id'))
-    user = relationship('Utilisateur')
\ No newline at end of file
+    user = relationship('Utilisateur')
+    __table_args__ = (Index('ix_decisions_timestamp_id', 'timestamp', 'id'),)
+
+class EtatCourantMiroir(Base):
+    """Copie sur une ligne de l'instantané en mémoire (etat_courant.py), partagée entre workers"""
+    __tablename__ = 'etat_courant'
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(TIMESTAMP)
+    production = Column(Float)
+    soc = Column(Float)
+    tension = Column(Float)
+    courant = Column(Float)
+
+# Rollups maintained at ingestion (agregats.py): one row per site and bucket of `pas` seconds (60, 900, 3600).
+# site_id is part of the primary key, so the historical installation is 0 instead of NULL.
+class AgregatProduction(Base):
+    __tablename__ = 'agregat_production'
+    pas = Column(Integer, primary_key=True)
+    site_id = Column(Integer, primary_key=True, default=0)
+    debut = Column(TIMESTAMP, primary_key=True)
+    nombre = Column(Integer)
+    somme = Column(Float)
+    minimum = Column(Float)
+    maximum = Column(Float)
+    energie_wh = Column(Float)  # intégrée sur les écarts réels entre échantillons
+
+class AgregatBatterie(Base):
+    __tablename__ = 'agregat_batterie'
+    pas = Column(Integer, primary_key=True)
+    site_id = Column(Integer, primary_key=True, default=0)
+    debut = Column(TIMESTAMP, primary_key=True)
+    nombre = Column(Integer)
+    somme = Column(Float)  # SOC
+    minimum = Column(Float)
+    maximum = Column(Float)
+    energie_wh = Column(Float)  # tension x courant (> 0 en charge)
+
+class AgregatConsommation(Base):
+    __tablename__ = 'agregat_consommation'
+    pas = Column(Integer, primary_key=True)
+    site_id = Column(Integer, primary_key=True, default=0)
+    id_charge = Column(Integer, primary_key=True)
+    debut = Column(TIMESTAMP, primary_key=True)
+    nombre = Column(Integer)
+    somme = Column(Float)
+    minimum = Column(Float)
+    maximum = Column(Float)
+    energie_wh = Column(Float)
+
+class AgregatDernierPoint(Base):
+    """Dernier échantillon intégré de chaque série d'un site, partagé par les workers"""
+    __tablename__ = 'agregat_dernier_point'
+    site_id = Column(Integer, primary_key=True, default=0)
+    serie = Column(String(50), primary_key=True)
+    timestamp = Column(TIMESTAMP)
+    valeur = Column(Float)  # puissance (W) de l'échantillon, pour l'intégration suivante
\ No newline at end of file
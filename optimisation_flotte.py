@@ -0,0 +1,300 @@
+# optimisation_flotte.py
+# Replanification de toutes les installations de la table sites en une seule passe.
+#
+# Les entrées sont chargées en quelques requêtes groupées (dernier SOC et dernière production
+# par site, charges, calendrier) plus les prévisions Solcast en cache de chaque site, puis
+# chaque site est résolu par la programmation dynamique d'optimiseur_horizon dans un pool de
+# processus persistant : le calcul d'un site ne dépend ni d'une session ni d'un état partagé,
+# seuls des tuples et des tableaux NumPy traversent la frontière des processus.
+# Les plannings et le bilan de la dernière passe sont écrits dans FLOTTE_PLANS_FICHIER,
+# lu par tous les workers uvicorn (même stockage que le cache des prévisions).
+#
+# Lancement manuel : python optimisation_flotte.py
+
+import os
+import time as chrono
+import logging
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import Site, Charge, Calendrier, Batterie, Production
+from optimiseur_horizon import (
+    OptimiseurHorizon, CAPACITE_BATTERIE_KWH, PUISSANCE_BATTERIE_KW, HORIZON_CRENEAUX, NIVEAUX_SOC
+)
+from solcast_manager import get_gestionnaire_solcast
+from stockage_previsions import StockagePrevisions, CHEMIN_PAR_DEFAUT
+
+logger = logging.getLogger(__name__)
+
+NB_PROCESSUS = int(os.getenv("FLOTTE_PROCESSUS", "0"))  # 0 : os.cpu_count()
+TAILLE_LOT = int(os.getenv("FLOTTE_LOT", "0"))  # sites par tâche envoyée au pool, 0 : automatique
+SEUIL_POOL = int(os.getenv("FLOTTE_SEUIL_POOL", "8"))  # en dessous, résolution dans le processus courant
+NIVEAUX_SOC_FLOTTE = int(os.getenv("FLOTTE_NIVEAUX_SOC", str(NIVEAUX_SOC)))
+FENETRE_MESURES = timedelta(hours=24)  # au-delà, le site est planifié sans mesure (SOC 0, production 0)
+FICHIER_PLANS = os.getenv("FLOTTE_PLANS_FICHIER",
+                          os.path.join(os.path.dirname(CHEMIN_PAR_DEFAUT), "plans_flotte.json"))
+ESPACE_PLANS = "flotte"
+
+ChargeSite = namedtuple("ChargeSite", "id type puissance_nominale")
+EvenementSite = namedtuple("EvenementSite", "id_charge date heure_debut heure_fin priorite_temporaire")
+EntreeSite = namedtuple(
+    "EntreeSite",
+    "site_id capacite_kwh puissance_kw soc production_actuelle charges calendrier previsions "
+    "version_previsions seuils maintenant"
+)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_verrou_pool = threading.Lock()
+# Separate file: the plans of a large fleet must not be rewritten with every quota update
+stockage = StockagePrevisions(FICHIER_PLANS)
+
+
+# --- Chargement des entrées (processus principal) ------------------------------
+
+def _dernieres_valeurs(db: Session, modele, colonne, site_ids: List[int], depuis: datetime) -> Dict[int, float]:
+    """
+    Dernière valeur de chaque site sur la fenêtre, en une requête : sous-requête corrélée
+    ORDER BY timestamp DESC LIMIT 1 par site, soit une descente d'index (site_id, timestamp)
+    par site au lieu d'une lecture de toute la fenêtre
+    """
+    derniere = (
+        select(colonne)
+        .where(modele.site_id == Site.id, modele.timestamp >= depuis)
+        .order_by(modele.timestamp.desc(), modele.id.desc())
+        .limit(1)
+        .correlate(Site)
+        .scalar_subquery()
+    )
+    return {
+        site_id: valeur
+        for site_id, valeur in db.execute(select(Site.id, derniere).where(Site.id.in_(site_ids)))
+        if valeur is not None
+    }
+
+
+def _previsions_site(solcast_site_id: Optional[str]) -> tuple:
+    """Prévisions en cache (jamais d'appel API ici), réduites aux champs utilisés par le solveur"""
+    if not solcast_site_id:
+        return [], None
+    try:
+        gestionnaire = get_gestionnaire_solcast(solcast_site_id)
+    except ValueError as e:
+        logger.error(f"Prévisions indisponibles pour le site Solcast {solcast_site_id}: {e}")
+        return [], None
+    previsions = gestionnaire.cache_previsions or []
+    return (
+        [{"period_end": p["period_end"], "pv_estimate": p.get("pv_estimate", 0)} for p in previsions],
+        gestionnaire.version_previsions()
+    )
+
+
+def charger_entrees(db: Session, seuils: Dict, site_ids: Optional[List[int]] = None,
+                    maintenant: Optional[datetime] = None) -> List[EntreeSite]:
+    """Entrées de tous les sites (ou de site_ids) en un nombre constant de requêtes"""
+    maintenant = maintenant or datetime.now()
+    requete = db.query(Site).order_by(Site.id)
+    if site_ids is not None:
+        requete = requete.filter(Site.id.in_(site_ids))
+    sites = requete.all()
+    if not sites:
+        return []
+
+    depuis = maintenant - FENETRE_MESURES
+    ids = [s.id for s in sites]
+    socs = _dernieres_valeurs(db, Batterie, Batterie.soc, ids, depuis)
+    productions = _dernieres_valeurs(db, Production, Production.production, ids, depuis)
+
+    charges: Dict[int, List[ChargeSite]] = {}
+    for site_id, *champs in db.execute(
+        select(Charge.site_id, Charge.id, Charge.type, Charge.puissance_nominale)
+        .where(Charge.site_id.in_(ids))
+        .order_by(Charge.id)
+    ):
+        charges.setdefault(site_id, []).append(ChargeSite(*champs))
+
+    jours = [maintenant.date() + timedelta(days=i) for i in range(HORIZON_CRENEAUX // 48 + 2)]
+    calendrier: Dict[int, List[EvenementSite]] = {}
+    for site_id, *champs in db.execute(
+        select(Charge.site_id, Calendrier.id_charge, Calendrier.date, Calendrier.heure_debut,
+               Calendrier.heure_fin, Calendrier.priorite_temporaire)
+        .join(Charge, Charge.id == Calendrier.id_charge)
+        .where(Charge.site_id.in_(ids), Calendrier.date.in_(jours))
+    ):
+        calendrier.setdefault(site_id, []).append(EvenementSite(*champs))
+
+    # Several sites may share one Solcast site: one read per distinct id
+    previsions = {s.solcast_site_id: _previsions_site(s.solcast_site_id) for s in sites}
+    seuils = tuple(sorted(seuils.items()))
+    return [
+        EntreeSite(
+            site_id=s.id,
+            capacite_kwh=s.capacite_batterie_kwh or CAPACITE_BATTERIE_KWH,
+            puissance_kw=s.puissance_batterie_kw or PUISSANCE_BATTERIE_KW,
+            soc=socs.get(s.id) or 0.0,
+            production_actuelle=productions.get(s.id) or 0.0,
+            charges=tuple(charges.get(s.id, ())),
+            calendrier=tuple(calendrier.get(s.id, ())),
+            previsions=previsions[s.solcast_site_id][0],
+            version_previsions=previsions[s.solcast_site_id][1],
+            seuils=seuils,
+            maintenant=maintenant,
+        )
+        for s in sites
+    ]
+
+
+# --- Résolution d'un site (processus du pool) ----------------------------------
+
+@lru_cache(maxsize=64)
+def _optimiseur(seuils: tuple, capacite_kwh: float, puissance_kw: float) -> OptimiseurHorizon:
+    """Un optimiseur par batterie distincte et par processus (la grille de SOC est réutilisée)"""
+    return OptimiseurHorizon(dict(seuils), capacite_kwh, NIVEAUX_SOC_FLOTTE, puissance_kw=puissance_kw)
+
+
+def optimiser_site(entree: EntreeSite) -> Dict:
+    """
+    Planning d'un site, au format d'OptimiseurHorizon.planifier (formatable par formater()).
+    Fonction pure : les erreurs sont retournées, pas levées, pour ne pas interrompre le lot.
+    """
+    debut = chrono.perf_counter()
+    try:
+        horizon = _optimiseur(entree.seuils, entree.capacite_kwh, entree.puissance_kw)
+        donnees = horizon.assembler(
+            entree.charges, entree.calendrier, entree.production_actuelle, entree.previsions, entree.maintenant
+        )
+        production_w = donnees["production"]["pv_estimate"]
+        solution = horizon.resoudre(production_w, donnees["puissances"], donnees["poids"], entree.soc)
+    except Exception as e:
+        return {"site_id": entree.site_id, "erreur": str(e), "duree_ms": (chrono.perf_counter() - debut) * 1000}
+
+    return {
+        "site_id": entree.site_id,
+        "debuts": donnees["debuts"],
+        "charges": [c.id for c in entree.charges],
+        "production_w": production_w,
+        "version_previsions": entree.version_previsions,
+        "calcule_le": entree.maintenant,
+        "duree_ms": (chrono.perf_counter() - debut) * 1000,
+        "creneau_courant": 0,
+        "planning": solution["planning"],
+        "soc_prevu": solution["soc_prevu"],
+        "reseau_kwh": solution["reseau_kwh"],
+    }
+
+
+# --- Passe sur la flotte ----------------------------------------------------------
+
+def _nb_processus() -> int:
+    return NB_PROCESSUS or os.cpu_count() or 1
+
+
+def _obtenir_pool() -> ProcessPoolExecutor:
+    """
+    Pool persistant (les processus gardent numpy importé et leurs optimiseurs en cache).
+    forkserver : pas de fork d'un processus qui a déjà des threads et des connexions ouvertes.
+    """
+    global _pool
+    with _verrou_pool:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=_nb_processus(),
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pool
+
+
+def arreter_pool():
+    global _pool
+    with _verrou_pool:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def _statistiques(durees: np.ndarray) -> Dict:
+    if not len(durees):
+        return {"p50_ms": None, "p99_ms": None, "max_ms": None, "total_ms": 0.0}
+    p50, p99 = np.percentile(durees, [50, 99])
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(durees.max()), 3),
+        "total_ms": round(float(durees.sum()), 1),
+    }
+
+
+def optimiser_flotte(db: Session, seuils: Dict, site_ids: Optional[List[int]] = None) -> Dict:
+    """
+    Replanifie tous les sites : chargement groupé, résolution répartie sur le pool, plans
+    partagés entre workers pour GET /sites/{id}/planning/. Retourne le bilan avec les temps par site.
+    """
+    debut = chrono.perf_counter()
+    entrees = charger_entrees(db, seuils, site_ids)
+    duree_chargement = (chrono.perf_counter() - debut) * 1000
+
+    debut_calcul = chrono.perf_counter()
+    if len(entrees) < SEUIL_POOL or NB_PROCESSUS == 1:
+        resultats = [optimiser_site(e) for e in entrees]
+    else:
+        pool = _obtenir_pool()
+        # Batches amortise the pickling round-trips; a few per worker keeps the load balanced
+        lot = TAILLE_LOT or max(1, len(entrees) // (_nb_processus() * 4))
+        resultats = list(pool.map(optimiser_site, entrees, chunksize=lot))
+    duree_calcul = (chrono.perf_counter() - debut_calcul) * 1000
+
+    erreurs = {r["site_id"]: r["erreur"] for r in resultats if "erreur" in r}
+    # Stored formatted (JSON), keyed by str(site_id) like any JSON object key
+    plans = {str(r["site_id"]): OptimiseurHorizon.formater(r) for r in resultats if "erreur" not in r}
+    for site_id, erreur in erreurs.items():
+        logger.error(f"Optimisation du site {site_id} en échec: {erreur}")
+
+    durees = np.array([r["duree_ms"] for r in resultats])
+    lents = np.argsort(durees)[::-1][:5]
+    bilan = {
+        "calcule_le": datetime.now().isoformat(),
+        "nb_sites": len(entrees),
+        "nb_erreurs": len(erreurs),
+        "chargement_ms": round(duree_chargement, 1),
+        "calcul_ms": round(duree_calcul, 1),
+        "total_ms": round((chrono.perf_counter() - debut) * 1000, 1),
+        "par_site": _statistiques(durees),
+        "sites_les_plus_lents": [
+            {"site_id": resultats[i]["site_id"], "duree_ms": round(float(durees[i]), 3)} for i in lents
+        ],
+        "erreurs": erreurs,
+    }
+    with stockage.modifier(ESPACE_PLANS) as entree:
+        entree["plans"] = {**entree.get("plans", {}), **plans}
+        entree["bilan"] = bilan
+    logger.info(f"Flotte: {len(entrees)} sites en {bilan['total_ms']} ms "
+                f"(p99 par site {bilan['par_site']['p99_ms']} ms)")
+    return bilan
+
+
+def plan_site(site_id: int) -> Optional[Dict]:
+    """Dernier planning calculé pour un site, quel que soit le worker qui l'a calculé (None si jamais optimisé)"""
+    return stockage.lire(ESPACE_PLANS).get("plans", {}).get(str(site_id))
+
+
+def dernier_bilan() -> Optional[Dict]:
+    return stockage.lire(ESPACE_PLANS).get("bilan")
+
+
+if __name__ == "__main__":
+    import json
+    from database import SessionLocal
+    from optimiseur_robuste import OptimiseurRobuste
+    logging.basicConfig(level=logging.INFO)
+    with SessionLocal() as db:
+        bilan = optimiser_flotte(db, OptimiseurRobuste().seuils)
+    arreter_pool()
+    print(json.dumps(bilan, indent=2))
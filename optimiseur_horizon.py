@@ -0,0 +1,393 @@
+# optimiseur_horizon.py
+# Planning marche/arrêt par charge sur les créneaux de 30 min des prévisions Solcast (24 à 48 h),
+# par programmation dynamique vectorisée NumPy sur l'état de charge de la batterie.
+#
+# À chaque créneau, les charges sont classées par priorité (type de la charge, ou priorité
+# temporaire du calendrier) puis par puissance croissante : une action = « les k premières
+# charges du classement sont alimentées ». L'espace d'actions reste linéaire en nombre de
+# charges (k = 0..N), ce qui permet de résoudre 50 charges x 96 créneaux en quelques ms.
+
+import os
+import time as chrono
+import logging
+import threading
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import Charge, Calendrier
+
+logger = logging.getLogger(__name__)
+
+CAPACITE_BATTERIE_KWH = float(os.getenv("BATTERIE_CAPACITE_KWH", "10"))
+PUISSANCE_BATTERIE_KW = float(os.getenv("BATTERIE_PUISSANCE_MAX_KW", "5"))  # charge / décharge
+RENDEMENT_BATTERIE = float(os.getenv("BATTERIE_RENDEMENT", "0.9"))  # aller-retour, appliqué à la charge
+NIVEAUX_SOC = int(os.getenv("OPTIMISEUR_HORIZON_NIVEAUX_SOC", "101"))
+HORIZON_CRENEAUX = int(os.getenv("OPTIMISEUR_HORIZON_CRENEAUX", "96"))  # 48 h
+BUDGET_MS = float(os.getenv("OPTIMISEUR_HORIZON_BUDGET_MS", "50"))
+# Measured deviation from the plan that triggers a repair of the remaining slots
+TOLERANCE_SOC = float(os.getenv("OPTIMISEUR_TOLERANCE_SOC", "5"))  # points de %
+TOLERANCE_PRODUCTION_W = float(os.getenv("OPTIMISEUR_TOLERANCE_PRODUCTION_W", "500"))
+PAS_H = 0.5  # Solcast PT30M
+
+# Value of 1 kWh served per priority, and costs, in the same (arbitrary) unit
+POIDS_PRIORITE = {"prioritaire": 100.0, "semi-prioritaire": 10.0, "non-prioritaire": 1.0}
+PRIX_RESEAU = float(os.getenv("OPTIMISEUR_PRIX_RESEAU", "20"))  # par kWh importé
+VALEUR_STOCKAGE = float(os.getenv("OPTIMISEUR_VALEUR_STOCKAGE", "5"))  # par kWh restant en fin d'horizon
+PENALITE_CRITIQUE = 50.0  # par kWh sous batterie_critique, à chaque créneau
+
+
+def _heure_locale(valeur: str) -> datetime:
+    """period_end Solcast (UTC, suffixe Z) en heure locale naïve, comme les mesures"""
+    return datetime.fromisoformat(valeur.replace("Z", "+00:00")).astimezone().replace(tzinfo=None)
+
+
+class OptimiseurHorizon:
+    """Planning par créneau sur l'horizon des prévisions"""
+
+    def __init__(self, seuils: Dict, capacite_kwh: float = CAPACITE_BATTERIE_KWH,
+                 niveaux_soc: int = NIVEAUX_SOC, budget_ms: float = BUDGET_MS,
+                 puissance_kw: float = PUISSANCE_BATTERIE_KW):
+        self.seuils = seuils
+        self.capacite_kwh = capacite_kwh
+        self.puissance_kw = puissance_kw
+        self.grille = np.linspace(0.0, capacite_kwh, niveaux_soc)  # énergie stockée (kWh)
+        self.budget_ms = budget_ms
+        self._plan: Optional[Dict] = None
+        self._cle = None
+        self._generation = 0  # bumped by invalider()
+        self._verrou = threading.Lock()
+        # Measurements waiting for suivre_mesure, handed over by signaler_mesure
+        self._condition_suivi = threading.Condition()
+        self._mesure_en_attente: Optional[Tuple[float, float, Optional[datetime]]] = None
+        self._thread_suivi: Optional[threading.Thread] = None
+        self.statistiques = {
+            "complets": {"nombre": 0, "total_ms": 0.0, "max_ms": 0.0, "dernier_ms": None},
+            "incrementaux": {"nombre": 0, "total_ms": 0.0, "max_ms": 0.0, "dernier_ms": None},
+            "mesures_suivies": 0,
+            "mesures_fusionnees": 0,
+            "ecarts_detectes": 0,
+        }
+
+    # --- Données d'entrée ---------------------------------------------------
+
+    def construire_creneaux(self, previsions: List[Dict], maintenant: datetime, production_actuelle: float,
+                            cle: str = "pv_estimate") -> Tuple[List[datetime], np.ndarray]:
+        """
+        Débuts des créneaux à partir du créneau courant et production prévue (W).
+        Les créneaux non couverts (aujourd'hui, quand seules les prévisions de demain
+        sont en cache) reprennent la prévision de la même heure le lendemain ; le
+        créneau courant reprend la production mesurée.
+        """
+        debut = maintenant.replace(minute=0 if maintenant.minute < 30 else 30, second=0, microsecond=0)
+        prevues = {}
+        for p in previsions:
+            fin = _heure_locale(p["period_end"])
+            prevues[fin - timedelta(hours=PAS_H)] = p.get(cle, p.get("pv_estimate", 0)) * 1000  # kW -> W
+        dernier = max(prevues) if prevues else debut
+        nb = max(1, min(HORIZON_CRENEAUX, int((dernier - debut).total_seconds() // 1800) + 1))
+        debuts = [debut + timedelta(minutes=30 * i) for i in range(nb)]
+        production = np.array([
+            prevues[d] if d in prevues else
+            production_actuelle if d == debut else
+            prevues.get(d + timedelta(days=1), 0.0)
+            for d in debuts
+        ], dtype=float)
+        return debuts, production
+
+    def poids_charges(self, charges: List, calendrier: List, debuts: List[datetime]) -> np.ndarray:
+        """Valeur du kWh servi par créneau et par charge (T, N), priorités temporaires du calendrier comprises"""
+        poids = np.tile([POIDS_PRIORITE.get(c.type, 1.0) for c in charges], (len(debuts), 1))
+        colonnes = {c.id: j for j, c in enumerate(charges)}
+        instants = np.array(debuts, dtype="datetime64[m]")
+        for e in calendrier:
+            j = colonnes.get(e.id_charge)
+            if j is None or e.priorite_temporaire not in POIDS_PRIORITE or not e.date:
+                continue
+            debut = np.datetime64(datetime.combine(e.date, e.heure_debut or time.min), "m")
+            fin = np.datetime64(datetime.combine(e.date, e.heure_fin or time.max), "m")
+            dans_evenement = (instants + np.timedelta64(30, "m") > debut) & (instants < fin)
+            poids[dans_evenement, j] = POIDS_PRIORITE[e.priorite_temporaire]
+        return poids
+
+    # --- Résolution ----------------------------------------------------------
+
+    def _transition(self, energie: np.ndarray, production_kwh: float, charge_kwh: np.ndarray):
+        """
+        Bilan d'un créneau pour chaque (état, action) : énergie suivante et import réseau (kWh).
+        energie : (S, 1) ou (1, 1) ; charge_kwh : (1, K+1)
+        """
+        plancher = self.capacite_kwh * self.seuils["batterie_securite"] / 100
+        limite = self.puissance_kw * PAS_H
+        net = production_kwh - charge_kwh
+        surplus = np.clip(net, 0.0, limite)
+        deficit = np.maximum(-net, 0.0)
+        disponible = np.maximum(energie - plancher, 0.0)
+        decharge = np.minimum(np.minimum(deficit, limite), disponible)
+        suivante = np.minimum(energie + surplus * RENDEMENT_BATTERIE, self.capacite_kwh) - decharge
+        return suivante, deficit - decharge
+
+    def _valeur_creneau(self, energie, production_kwh, charge_kwh, gain, valeur_suivante):
+        suivante, reseau = self._transition(energie, production_kwh, charge_kwh)
+        critique = self.capacite_kwh * self.seuils["batterie_critique"] / 100
+        q = (gain - PRIX_RESEAU * reseau - PENALITE_CRITIQUE * np.maximum(critique - suivante, 0.0)
+             + np.interp(suivante, self.grille, valeur_suivante))
+        return q, suivante, reseau
+
+    def resoudre(self, production_w: np.ndarray, puissances_w: np.ndarray, poids: np.ndarray,
+                 soc_initial: float) -> Dict:
+        """
+        Programmation dynamique arrière sur la grille d'énergie stockée, puis passe avant
+        depuis le SOC mesuré. Retourne le planning (T, N) et la fonction de valeur (T+1, S).
+        """
+        nb_creneaux, nb_charges = poids.shape
+        # Per-slot ranking: priority desc, then nominal power asc
+        ordre = np.lexsort((np.broadcast_to(puissances_w, poids.shape), -poids), axis=1)
+        zero = np.zeros((nb_creneaux, 1))
+        charge_kwh = np.hstack([zero, np.cumsum(puissances_w[ordre], axis=1)]) * PAS_H / 1000
+        gain = np.hstack([zero, np.cumsum((poids * puissances_w)[np.arange(nb_creneaux)[:, None], ordre], axis=1)]) * PAS_H / 1000
+        production_kwh = production_w * PAS_H / 1000
+
+        valeurs = np.empty((nb_creneaux + 1, len(self.grille)))
+        valeurs[-1] = VALEUR_STOCKAGE * self.grille
+        energie = self.grille[:, None]
+        for t in range(nb_creneaux - 1, -1, -1):
+            q, _, _ = self._valeur_creneau(energie, production_kwh[t], charge_kwh[t][None, :], gain[t][None, :], valeurs[t + 1])
+            valeurs[t] = q.max(axis=1)
+
+        return {
+            **self.derouler(valeurs, ordre, charge_kwh, gain, production_kwh, soc_initial, 0),
+            "valeurs": valeurs,
+            "ordre": ordre,
+            "charge_kwh": charge_kwh,
+            "gain": gain,
+            "production_kwh": production_kwh,
+        }
+
+    def derouler(self, valeurs, ordre, charge_kwh, gain, production_kwh, soc_initial: float, depuis: int) -> Dict:
+        """Passe avant à partir du créneau `depuis` : meilleure action pour l'état réellement atteint"""
+        nb_creneaux, nb_charges = ordre.shape
+        planning = np.zeros((nb_creneaux - depuis, nb_charges), dtype=bool)
+        soc = np.empty(nb_creneaux - depuis)
+        reseau = np.empty(nb_creneaux - depuis)
+        energie = np.array([[min(max(soc_initial, 0.0), 100.0) * self.capacite_kwh / 100]])
+        for i, t in enumerate(range(depuis, nb_creneaux)):
+            q, suivante, import_reseau = self._valeur_creneau(
+                energie, production_kwh[t], charge_kwh[t][None, :], gain[t][None, :], valeurs[t + 1]
+            )
+            k = int(q[0].argmax())
+            planning[i, ordre[t, :k]] = True
+            energie = suivante[:, [k]]
+            soc[i] = energie[0, 0] / self.capacite_kwh * 100
+            reseau[i] = import_reseau[0, k]
+        return {"planning": planning, "soc_prevu": soc, "reseau_kwh": reseau}
+
+    # --- Planning courant ----------------------------------------------------
+
+    def invalider(self):
+        """Charges ou calendrier modifiés"""
+        self._generation += 1
+
+    def preparer(self, db: Session, contexte: Dict, previsions: List[Dict], maintenant: datetime,
+                 cles: Tuple[str, ...] = ("pv_estimate",)) -> Dict:
+        """Créneaux, production prévue par clé Solcast (W), puissances (N) et poids (T, N) des charges"""
+        # Charges of the historical installation; fleet sites go through optimisation_flotte
+        charges = db.query(Charge).filter(Charge.site_id.is_(None)).order_by(Charge.id).all()
+        jours = {maintenant.date() + timedelta(days=i) for i in range(HORIZON_CRENEAUX // 48 + 2)}
+        calendrier = db.query(Calendrier).filter(Calendrier.date.in_(jours)).all() if charges else []
+        return self.assembler(charges, calendrier, contexte.get("production_actuelle", 0), previsions, maintenant, cles)
+
+    def assembler(self, charges: List, calendrier: List, production_actuelle: float, previsions: List[Dict],
+                  maintenant: datetime, cles: Tuple[str, ...] = ("pv_estimate",)) -> Dict:
+        """Partie de preparer() sans accès à la base (charges et calendrier déjà chargés)"""
+        production = {}
+        for cle in cles:
+            debuts, production[cle] = self.construire_creneaux(previsions, maintenant, production_actuelle, cle)
+        return {
+            "debuts": debuts,
+            "charges": charges,
+            "production": production,
+            "puissances": np.array([c.puissance_nominale or 0.0 for c in charges], dtype=float),
+            "poids": self.poids_charges(charges, calendrier, debuts),
+        }
+
+    def planifier(self, db: Session, contexte: Dict, previsions: List[Dict],
+                  version_previsions: Optional[str] = None) -> Dict:
+        debut_calcul = chrono.perf_counter()
+        maintenant = datetime.now()
+        donnees = self.preparer(db, contexte, previsions, maintenant)
+        debuts, charges = donnees["debuts"], donnees["charges"]
+        production_w = donnees["production"]["pv_estimate"]
+        solution = self.resoudre(production_w, donnees["puissances"], donnees["poids"], contexte.get("soc_batterie", 0))
+        duree_ms = (chrono.perf_counter() - debut_calcul) * 1000
+        self._chronometrer("complets", duree_ms)
+        if duree_ms > self.budget_ms:
+            logger.warning(f"Planning horizon: {duree_ms:.1f} ms pour {len(charges)} charges (budget {self.budget_ms} ms)")
+
+        return {
+            "debuts": debuts,
+            "charges": [c.id for c in charges],
+            "production_w": production_w,
+            "version_previsions": version_previsions,
+            "calcule_le": maintenant,
+            "duree_ms": duree_ms,
+            "creneau_courant": 0,
+            # Last known state (instant, SOC, slot) the expected trajectory starts from
+            "repere": (maintenant, contexte.get("soc_batterie", 0), 0),
+            **solution,
+        }
+
+    def _chronometrer(self, nature: str, duree_ms: float):
+        stats = self.statistiques[nature]
+        stats["nombre"] += 1
+        stats["total_ms"] += duree_ms
+        stats["max_ms"] = max(stats["max_ms"], duree_ms)
+        stats["dernier_ms"] = duree_ms
+
+    @staticmethod
+    def _creneau(plan: Dict, instant: datetime) -> int:
+        return int((instant - plan["debuts"][0]).total_seconds() // (PAS_H * 3600))
+
+    def replanifier(self, plan: Dict, creneau: int, soc: float, production_w: Optional[float] = None,
+                    instant: Optional[datetime] = None) -> Dict:
+        """
+        Réparation des créneaux restants (horizon glissant) : la fonction de valeur des
+        créneaux suivants ne dépend pas de l'état mesuré, seule la passe avant est refaite
+        depuis le créneau courant. Une production mesurée remplace la prévision du créneau courant.
+        Retourne un nouveau planning : `plan` n'est jamais modifié, un lecteur peut être en train de le formater.
+        """
+        debut_calcul = chrono.perf_counter()
+        nouveau = dict(plan)
+        if production_w is not None:
+            nouveau["production_w"] = plan["production_w"].copy()
+            nouveau["production_w"][creneau] = production_w
+            nouveau["production_kwh"] = plan["production_kwh"].copy()
+            nouveau["production_kwh"][creneau] = production_w * PAS_H / 1000
+        suite = self.derouler(plan["valeurs"], plan["ordre"], plan["charge_kwh"], plan["gain"],
+                              nouveau["production_kwh"], soc, creneau)
+        for cle in ("planning", "soc_prevu", "reseau_kwh"):
+            nouveau[cle] = plan[cle].copy()
+            nouveau[cle][creneau:] = suite[cle]
+        nouveau["creneau_courant"] = creneau
+        nouveau["repere"] = (instant or datetime.now(), soc, creneau)
+        self._chronometrer("incrementaux", (chrono.perf_counter() - debut_calcul) * 1000)
+        return nouveau
+
+    @staticmethod
+    def soc_attendu(plan: Dict, creneau: int, instant: datetime) -> float:
+        """SOC prévu à l'instant, interpolé entre le repère (ou le début du créneau) et la fin du créneau"""
+        repere_instant, repere_soc, repere_creneau = plan["repere"]
+        if repere_creneau != creneau:
+            repere_instant = plan["debuts"][creneau]
+            repere_soc = plan["soc_prevu"][creneau - 1] if creneau else repere_soc
+        fin = plan["debuts"][creneau] + timedelta(hours=PAS_H)
+        duree = (fin - repere_instant).total_seconds()
+        fraction = min(max((instant - repere_instant).total_seconds() / duree, 0.0), 1.0) if duree > 0 else 1.0
+        return repere_soc + fraction * (plan["soc_prevu"][creneau] - repere_soc)
+
+    def suivre_mesure(self, production_w: float, soc: float, instant: Optional[datetime] = None) -> bool:
+        """
+        Compare une mesure au planning ; répare les créneaux restants si le SOC ou la
+        production s'écartent au-delà des tolérances, ou si un nouveau créneau a commencé.
+        Retourne True si le planning a été réparé.
+        """
+        with self._verrou:
+            plan = self._plan
+            if plan is None:
+                return False
+            self.statistiques["mesures_suivies"] += 1
+            instant = instant or datetime.now()
+            creneau = self._creneau(plan, instant)
+            if creneau < plan["creneau_courant"] or creneau >= len(plan["debuts"]):
+                return False  # late sample, or horizon exhausted (full solve on next read)
+
+            ecart_soc = abs(soc - self.soc_attendu(plan, creneau, instant)) > TOLERANCE_SOC
+            ecart_production = abs(production_w - plan["production_w"][creneau]) > TOLERANCE_PRODUCTION_W
+            if creneau == plan["creneau_courant"] and not (ecart_soc or ecart_production):
+                return False
+            if ecart_soc or ecart_production:
+                self.statistiques["ecarts_detectes"] += 1
+            # Published under the lock; readers keep formatting the snapshot they already hold
+            self._plan = self.replanifier(plan, creneau, soc, production_w if ecart_production else None, instant)
+            return True
+
+    def signaler_mesure(self, production_w: float, soc: float, instant: Optional[datetime] = None):
+        """
+        Dépose une mesure pour suivre_mesure, exécuté par un thread dédié : l'ingestion (et la
+        boucle asyncio en DB_MODE=async) ne paie jamais une réparation. Les mesures arrivées
+        pendant une réparation sont fusionnées, seule la plus récente est comparée au planning.
+        """
+        with self._condition_suivi:
+            if self._mesure_en_attente is not None:
+                self.statistiques["mesures_fusionnees"] += 1
+            self._mesure_en_attente = (production_w, soc, instant or datetime.now())
+            if self._thread_suivi is None or not self._thread_suivi.is_alive():
+                self._thread_suivi = threading.Thread(target=self._boucle_suivi, name="suivi-horizon", daemon=True)
+                self._thread_suivi.start()
+            self._condition_suivi.notify()
+
+    def _boucle_suivi(self):
+        while True:
+            with self._condition_suivi:
+                while self._mesure_en_attente is None:
+                    self._condition_suivi.wait()
+                mesure, self._mesure_en_attente = self._mesure_en_attente, None
+            try:
+                self.suivre_mesure(*mesure)
+            except Exception as e:
+                logger.error(f"Erreur suivi du planning: {e}")
+
+    def get_statistiques(self) -> Dict:
+        with self._verrou:
+            resultat = {nature: dict(stats) for nature, stats in self.statistiques.items() if isinstance(stats, dict)}
+            for stats in resultat.values():
+                stats["moyenne_ms"] = round(stats["total_ms"] / stats["nombre"], 3) if stats["nombre"] else None
+            resultat["mesures_suivies"] = self.statistiques["mesures_suivies"]
+            resultat["mesures_fusionnees"] = self.statistiques["mesures_fusionnees"]
+            resultat["ecarts_detectes"] = self.statistiques["ecarts_detectes"]
+            resultat["tolerances"] = {"soc": TOLERANCE_SOC, "production_w": TOLERANCE_PRODUCTION_W}
+            return resultat
+
+    def obtenir_plan(self, db: Session, contexte: Dict, previsions: List[Dict],
+                     version_previsions: Optional[str] = None, forcer: bool = False) -> Dict:
+        """
+        Planning en cache : résolution complète à chaque nouvelle prévision ou modification
+        de charges, réparation incrémentale à chaque nouveau créneau.
+        Le planning retourné n'est plus jamais modifié : il peut être formaté hors du verrou.
+        """
+        with self._verrou:
+            cle = (version_previsions, self._generation)
+            plan = self._plan
+            maintenant = datetime.now()
+            if forcer or plan is None or self._cle != cle or self._creneau(plan, maintenant) >= len(plan["debuts"]):
+                plan = self.planifier(db, contexte, previsions, version_previsions)
+                self._plan, self._cle = plan, cle
+            elif self._creneau(plan, maintenant) > plan["creneau_courant"]:
+                # New slot, same inputs: roll the horizon forward
+                plan = self.replanifier(plan, self._creneau(plan, maintenant), contexte.get("soc_batterie", 0),
+                                        instant=maintenant)
+                self._plan = plan
+            return plan
+
+    @staticmethod
+    def formater(plan: Dict) -> Dict:
+        """Représentation JSON du planning"""
+        charges = plan["charges"]
+        courant = plan["creneau_courant"]
+        return {
+            "calcule_le": plan["calcule_le"].isoformat(),
+            "version_previsions": plan["version_previsions"],
+            "duree_ms": round(plan["duree_ms"], 2),
+            "pas_minutes": int(PAS_H * 60),
+            "creneaux": [{
+                "debut": debut.isoformat(),
+                "production_w": round(float(plan["production_w"][t]), 1),
+                "soc_prevu": round(float(plan["soc_prevu"][t]), 1),
+                "reseau_kwh": round(float(plan["reseau_kwh"][t]), 3),
+                "charges_actives": [charges[j] for j in np.flatnonzero(plan["planning"][t])]
+            } for t, debut in enumerate(plan["debuts"]) if t >= courant],
+            "planning": {charge_id: plan["planning"][courant:, j].astype(int).tolist() for j, charge_id in enumerate(charges)},
+            "commandes": [{"charge_id": charge_id, "etat": bool(plan["planning"][courant, j])} for j, charge_id in enumerate(charges)]
+        }
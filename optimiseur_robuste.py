@@ -2,7 +2,10 @@ from datetime import datetime, time, timedelta
 from typing import List, Dict, Tuple, Optional
 from sqlalchemy.orm import Session
 from models import Charge, Consommation, Production, Batterie, Calendrier, Decision
-from solcast_manager import GestionnaireSolcast
+from solcast_manager import get_gestionnaire_solcast
+from optimiseur_horizon import OptimiseurHorizon
+from optimiseur_scenarios import OptimiseurScenarios
+from metriques import OPTIMISEUR_PHASES
 import logging
 
 # Configuration du logging
@@ -21,9 +24,14 @@ class OptimiseurRobuste:
             "batterie_securite": 10       # %
         }
         
+        # Planning par créneau de 30 min sur l'horizon des prévisions
+        self.horizon = OptimiseurHorizon(self.seuils)
+        # Même planning évalué sur les quantiles P10 / P50 / P90
+        self.scenarios = OptimiseurScenarios(self.horizon)
+        
         # Initialiser le gestionnaire Solcast
         try:
-            self.solcast_manager = GestionnaireSolcast()
+            self.solcast_manager = get_gestionnaire_solcast()
         except Exception as e:
             logger.error(f"Erreur initialisation Solcast: {e}")
             self.solcast_manager = None
@@ -31,32 +39,41 @@ class OptimiseurRobuste:
     def optimiser_complet(self, db: Session, contexte_actuel: Dict) -> Dict:
         """
         Optimisation complète avec prévisions et contexte actuel
+        (contexte_actuel["maintenant"] : horloge virtuelle du rejeu, heure courante sinon)
         """
+        maintenant = contexte_actuel.get("maintenant") or datetime.now()
         try:
             # 1. Récupérer les prévisions Solcast
-            previsions_data = self._recuperer_previsions()
+            with OPTIMISEUR_PHASES.chronometrer(phase="previsions"):
+                previsions_data = self._recuperer_previsions()
             
             # 2. Analyser le contexte actuel
-            analyse_contexte = self._analyser_contexte_actuel(contexte_actuel)
+            with OPTIMISEUR_PHASES.chronometrer(phase="contexte"):
+                analyse_contexte = self._analyser_contexte_actuel(contexte_actuel)
             
             # 3. Analyser les prévisions
             analyse_previsions = previsions_data.get("analyse", {})
             
             # 4. Calculer la stratégie optimale
-            strategie = self._calculer_strategie_optimale(
-                contexte_actuel, 
-                analyse_contexte, 
-                analyse_previsions
-            )
+            with OPTIMISEUR_PHASES.chronometrer(phase="strategie"):
+                strategie = self._calculer_strategie_optimale(
+                    contexte_actuel, 
+                    analyse_contexte, 
+                    analyse_previsions
+                )
             
             # 5. Prendre les décisions
-            decisions = self._prendre_decisions(db, strategie)
+            with OPTIMISEUR_PHASES.chronometrer(phase="decisions"):
+                decisions = self._prendre_decisions(db, strategie)
             
             # 6. Générer l'alerte vocale
-            alerte = self._generer_alerte_avancee(strategie, decisions)
+            with OPTIMISEUR_PHASES.chronometrer(phase="alerte"):
+                alerte = self._generer_alerte_avancee(strategie, decisions)
             
-            # 7. Enregistrer la décision
-            self._enregistrer_decision(db, strategie, decisions)
+            # 7. Enregistrer la décision (uniquement si la stratégie change)
+            with OPTIMISEUR_PHASES.chronometrer(phase="enregistrement"):
+                if strategie["nom"] != self._derniere_strategie_enregistree(db):
+                    self._enregistrer_decision(db, strategie, decisions, maintenant)
             
             return {
                 "strategie": strategie,
@@ -64,7 +81,7 @@ class OptimiseurRobuste:
                 "alerte_vocale": alerte,
                 "contexte": contexte_actuel,
                 "analyse_previsions": analyse_previsions,
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": maintenant.isoformat(),
                 "source_previsions": previsions_data.get("source", "inconnue"),
                 "appels_restants": previsions_data.get("appels_restants", "inconnu")
             }
@@ -79,16 +96,32 @@ class OptimiseurRobuste:
             return {"analyse": {}, "source": "erreur"}
         
         try:
-            return self.solcast_manager.get_previsions_demain()
+            return self.solcast_manager.lire_previsions()
         except Exception as e:
             logger.error(f"Erreur récupération prévisions: {e}")
             return {"analyse": {}, "source": "erreur"}
     
+    def planifier_horizon(self, db: Session, contexte_actuel: Dict, forcer: bool = False) -> Dict:
+        """Planning marche/arrêt par charge et par créneau (recalculé à chaque nouvelle prévision)"""
+        previsions_data = self._recuperer_previsions()
+        plan = self.horizon.obtenir_plan(
+            db, contexte_actuel, previsions_data.get("previsions", []), self.version_previsions(), forcer=forcer
+        )
+        return {**self.horizon.formater(plan), "source_previsions": previsions_data.get("source", "inconnue")}
+    
+    def planifier_scenarios(self, db: Session, contexte_actuel: Dict, forcer: bool = False) -> Dict:
+        """Planning robuste aux quantiles de production, avec la probabilité de passer sous batterie_securite"""
+        previsions_data = self._recuperer_previsions()
+        resultat = self.scenarios.obtenir(
+            db, contexte_actuel, previsions_data.get("previsions", []), self.version_previsions(), forcer=forcer
+        )
+        return {**self.scenarios.formater(resultat), "source_previsions": previsions_data.get("source", "inconnue")}
+    
     def _analyser_contexte_actuel(self, contexte: Dict) -> Dict:
         """Analyse approfondie du contexte actuel"""
         production_actuelle = contexte.get("production_actuelle", 0)
         soc_batterie = contexte.get("soc_batterie", 0)
-        heure_actuelle = datetime.now().time()
+        heure_actuelle = (contexte.get("maintenant") or datetime.now()).time()
         
         # Analyser la production
         niveau_production = "forte" if production_actuelle > self.seuils["production_forte"] else \
@@ -228,7 +261,7 @@ class OptimiseurRobuste:
     
     def _prendre_decisions(self, db: Session, strategie: Dict) -> List[Dict]:
         """Prend les décisions concrètes pour chaque charge"""
-        charges = db.query(Charge).all()
+        charges = db.query(Charge).filter(Charge.site_id.is_(None)).all()
         decisions = []
         
         priorites = strategie["priorites"]
@@ -272,11 +305,25 @@ class OptimiseurRobuste:
         else:  # PRESERVATION
             return f"Mode préservation critique. Score: {score:.0f}. Charges prioritaires sur réseau, préservation batterie."
     
-    def _enregistrer_decision(self, db: Session, strategie: Dict, decisions: List[Dict]):
+    def _derniere_strategie_enregistree(self, db: Session) -> Optional[str]:
+        """Nom de la dernière stratégie enregistrée (requête indexée sur decisions.timestamp)"""
+        derniere = db.query(Decision).order_by(Decision.timestamp.desc()).first()
+        if not derniere or not derniere.action or not derniere.action.startswith("Stratégie: "):
+            return None
+        return derniere.action[len("Stratégie: "):]
+    
+    def version_previsions(self) -> Optional[str]:
+        """Version des prévisions utilisées (None si Solcast indisponible)"""
+        if not self.solcast_manager:
+            return None
+        return self.solcast_manager.version_previsions()
+    
+    def _enregistrer_decision(self, db: Session, strategie: Dict, decisions: List[Dict],
+                              maintenant: Optional[datetime] = None):
         """Enregistre la décision en base de données"""
         try:
             decision = Decision(
-                timestamp=datetime.now(),
+                timestamp=maintenant or datetime.now(),
                 action=f"Stratégie: {strategie['nom']}",
                 cible=f"Score: {strategie['score']:.1f}",
                 raison=f"Optimisation robuste avec {len(decisions)} charges",
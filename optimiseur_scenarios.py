@@ -0,0 +1,191 @@
+# optimiseur_scenarios.py
+# Planification probabiliste à partir des quantiles Solcast (pv_estimate10 / pv_estimate / pv_estimate90).
+#
+# Des plannings candidats (programmation dynamique d'optimiseur_horizon sur P10, P50 et P90,
+# plus un planning limité aux charges prioritaires) sont évalués en boucle ouverte sur des
+# scénarios de production tirés entre les quantiles. L'évaluation est vectorisée : tableaux
+# scénarios x créneaux x charges, simulation de la batterie pour tous les candidats et
+# scénarios à la fois. Le planning retenu maximise la valeur moyenne sous une probabilité
+# maximale que ses charges optionnelles fassent passer la batterie sous batterie_securite.
+
+import os
+import threading
+import time as chrono
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from optimiseur_horizon import (
+    OptimiseurHorizon, PAS_H, POIDS_PRIORITE, PRIX_RESEAU, VALEUR_STOCKAGE, RENDEMENT_BATTERIE
+)
+
+logger = logging.getLogger(__name__)
+
+NB_SCENARIOS = int(os.getenv("OPTIMISEUR_NB_SCENARIOS", "200"))
+RISQUE_MAX = float(os.getenv("OPTIMISEUR_RISQUE_MAX", "0.1"))  # probabilité de passer sous batterie_securite
+TOLERANCE_KWH = 1e-6  # écart d'énergie sous le plancher négligé face au planning de référence
+QUANTILES = {"p10": "pv_estimate10", "p50": "pv_estimate", "p90": "pv_estimate90"}
+
+
+def scenarios_production(p10: np.ndarray, p50: np.ndarray, p90: np.ndarray, nb: int = NB_SCENARIOS) -> np.ndarray:
+    """
+    Scénarios (nb, T) par interpolation linéaire de la fonction quantile entre P10, P50 et P90.
+    Quantiles stratifiés (déterministes) et communs à tous les créneaux d'un scénario :
+    l'incertitude d'une journée est surtout la couverture nuageuse, corrélée dans le temps.
+    """
+    p10, p50, p90 = np.sort(np.vstack([p10, p50, p90]), axis=0)
+    u = ((np.arange(nb) + 0.5) / nb)[:, None]
+    bas = p50 + (u - 0.5) / 0.4 * (p50 - p10)
+    haut = p50 + (u - 0.5) / 0.4 * (p90 - p50)
+    return np.maximum(np.where(u < 0.5, bas, haut), 0.0)
+
+
+class OptimiseurScenarios:
+    """Planning robuste aux quantiles de production, mis en cache par version de prévisions"""
+
+    def __init__(self, horizon: OptimiseurHorizon, nb_scenarios: int = NB_SCENARIOS, risque_max: float = RISQUE_MAX):
+        self.horizon = horizon
+        self.nb_scenarios = nb_scenarios
+        self.risque_max = risque_max
+        self._resultat: Optional[Dict] = None
+        self._cle = None
+        self._verrou = threading.Lock()
+
+    def candidats(self, production: Dict[str, np.ndarray], puissances: np.ndarray, poids: np.ndarray,
+                  soc_initial: float) -> Dict[str, np.ndarray]:
+        """Plannings (T, N) : un par quantile, plus le planning P10 restreint aux charges prioritaires"""
+        plannings = {
+            nom: self.horizon.resoudre(production[cle], puissances, poids, soc_initial)["planning"]
+            for nom, cle in QUANTILES.items()
+        }
+        plannings["prioritaires"] = plannings["p10"] & (poids >= POIDS_PRIORITE["prioritaire"])
+        return plannings
+
+    def evaluer(self, plannings: np.ndarray, scenarios: np.ndarray, puissances: np.ndarray,
+                poids: np.ndarray, soc_initial: float) -> Dict[str, np.ndarray]:
+        """
+        Simulation en boucle ouverte de C plannings (C, T, N) sur S scénarios (S, T).
+        Retourne par candidat la valeur moyenne, la probabilité de dépassement, la probabilité
+        d'atteindre le plancher (charges prioritaires comprises), l'import réseau moyen et les
+        trajectoires de SOC (C, S, T).
+
+        Un dépassement est imputé au planning : ses charges optionnelles demandent plus
+        d'énergie sous batterie_securite que le même planning réduit aux charges prioritaires,
+        sur le même scénario. Les charges prioritaires seules ne comptent pas comme dépassement
+        (leur déficit passe par le réseau, reporté à part).
+        """
+        capacite = self.horizon.capacite_kwh
+        plancher = capacite * self.horizon.seuils["batterie_securite"] / 100
+        limite = self.horizon.puissance_kw * PAS_H
+        # Reference of each candidate: the same schedule without its optional loads
+        references = plannings & (poids >= POIDS_PRIORITE["prioritaire"])[None]
+        nb_candidats = len(plannings)
+        tous = np.concatenate([plannings, references])
+        charge_kwh = np.einsum("ctn,n->ct", tous, puissances) * PAS_H / 1000
+        gain = np.einsum("ctn,tn,n->c", plannings, poids, puissances) * PAS_H / 1000
+        production_kwh = scenarios * PAS_H / 1000
+
+        nb_creneaux = charge_kwh.shape[1]
+        energie = np.full((len(tous), len(scenarios)), min(max(soc_initial, 0.0), 100.0) * capacite / 100)
+        reseau = np.zeros_like(energie)
+        sous_plancher = np.zeros_like(energie)  # energy the loads would need below batterie_securite
+        trajectoires = np.empty((nb_candidats, len(scenarios), nb_creneaux))
+        for t in range(nb_creneaux):
+            net = production_kwh[None, :, t] - charge_kwh[:, t, None]
+            deficit = np.maximum(-net, 0.0)
+            disponible = np.maximum(energie - plancher, 0.0)
+            decharge = np.minimum(np.minimum(deficit, limite), disponible)
+            sous_plancher += np.maximum(deficit - disponible, 0.0)
+            reseau += deficit - decharge
+            energie = np.minimum(energie + np.clip(net, 0.0, limite) * RENDEMENT_BATTERIE, capacite) - decharge
+            trajectoires[:, :, t] = energie[:nb_candidats] / capacite * 100
+
+        # Breach: the optional loads of the schedule take the battery below the floor
+        depassement = sous_plancher[:nb_candidats] > sous_plancher[nb_candidats:] + TOLERANCE_KWH
+        valeur = gain[:, None] - PRIX_RESEAU * reseau[:nb_candidats] + VALEUR_STOCKAGE * energie[:nb_candidats]
+        return {
+            "valeur_moyenne": valeur.mean(axis=1),
+            "probabilite_depassement": depassement.mean(axis=1),
+            "probabilite_plancher": (sous_plancher[:nb_candidats] > TOLERANCE_KWH).mean(axis=1),
+            "reseau_moyen_kwh": reseau[:nb_candidats].mean(axis=1),
+            "trajectoires_soc": trajectoires,
+        }
+
+    def planifier(self, db: Session, contexte: Dict, previsions: List[Dict],
+                  version_previsions: Optional[str] = None) -> Dict:
+        debut_calcul = chrono.perf_counter()
+        maintenant = contexte.get("maintenant") or datetime.now()
+        soc = contexte.get("soc_batterie", 0)
+        donnees = self.horizon.preparer(db, contexte, previsions, maintenant, cles=tuple(QUANTILES.values()))
+        production = donnees["production"]
+        scenarios = scenarios_production(
+            production["pv_estimate10"], production["pv_estimate"], production["pv_estimate90"], self.nb_scenarios
+        )
+        candidats = self.candidats(production, donnees["puissances"], donnees["poids"], soc)
+        noms = list(candidats)
+        evaluation = self.evaluer(np.stack([candidats[n] for n in noms]), scenarios,
+                                  donnees["puissances"], donnees["poids"], soc)
+
+        # Best expected value among the candidates within the risk budget, otherwise the safest one
+        risques = evaluation["probabilite_depassement"]
+        admissibles = np.flatnonzero(risques <= self.risque_max)
+        if len(admissibles):
+            retenu = int(admissibles[evaluation["valeur_moyenne"][admissibles].argmax()])
+        else:
+            retenu = int(risques.argmin())
+            logger.warning(f"Aucun planning sous le risque maximal ({self.risque_max:.0%}), "
+                           f"retenu: {noms[retenu]} ({risques[retenu]:.0%})")
+
+        return {
+            "debuts": donnees["debuts"],
+            "charges": [c.id for c in donnees["charges"]],
+            "production": production,
+            "noms": noms,
+            "retenu": retenu,
+            "planning": candidats[noms[retenu]],
+            "evaluation": evaluation,
+            "version_previsions": version_previsions,
+            "calcule_le": maintenant,
+            "duree_ms": (chrono.perf_counter() - debut_calcul) * 1000,
+        }
+
+    def obtenir(self, db: Session, contexte: Dict, previsions: List[Dict],
+                version_previsions: Optional[str] = None, forcer: bool = False) -> Dict:
+        """Résultat en cache, recalculé à chaque nouvelle prévision ou modification de charges"""
+        with self._verrou:
+            cle = (version_previsions, self.horizon._generation)
+            if forcer or self._resultat is None or self._cle != cle:
+                self._resultat, self._cle = self.planifier(db, contexte, previsions, version_previsions), cle
+            return self._resultat
+
+    def formater(self, resultat: Dict) -> Dict:
+        evaluation = resultat["evaluation"]
+        retenu = resultat["retenu"]
+        charges = resultat["charges"]
+        bandes = np.percentile(evaluation["trajectoires_soc"][retenu], [10, 50, 90], axis=0)
+        return {
+            "calcule_le": resultat["calcule_le"].isoformat(),
+            "version_previsions": resultat["version_previsions"],
+            "duree_ms": round(resultat["duree_ms"], 2),
+            "nb_scenarios": self.nb_scenarios,
+            "risque_max": self.risque_max,
+            "planning_retenu": resultat["noms"][retenu],
+            "probabilite_depassement_securite": round(float(evaluation["probabilite_depassement"][retenu]), 4),
+            "candidats": [{
+                "nom": nom,
+                "valeur_moyenne": round(float(evaluation["valeur_moyenne"][i]), 2),
+                "probabilite_depassement_securite": round(float(evaluation["probabilite_depassement"][i]), 4),
+                "probabilite_plancher": round(float(evaluation["probabilite_plancher"][i]), 4),
+                "reseau_moyen_kwh": round(float(evaluation["reseau_moyen_kwh"][i]), 3)
+            } for i, nom in enumerate(resultat["noms"])],
+            "creneaux": [{
+                "debut": debut.isoformat(),
+                "production_w": {q: round(float(resultat["production"][cle][t]), 1) for q, cle in QUANTILES.items()},
+                "soc_prevu": {"p10": round(float(bandes[0, t]), 1), "p50": round(float(bandes[1, t]), 1),
+                              "p90": round(float(bandes[2, t]), 1)},
+                "charges_actives": [charges[j] for j in np.flatnonzero(resultat["planning"][t])]
+            } for t, debut in enumerate(resultat["debuts"])]
+        }
@@ -0,0 +1,246 @@
+# partitionnement.py
+# Partitionnement natif PostgreSQL (RANGE sur timestamp, par jour ou par mois) des tables
+# de mesures et de décisions, activé par PARTITIONNEMENT=jour|mois à la création des tables.
+# Les requêtes filtrées sur timestamp ne parcourent que les partitions concernées et la
+# rétention devient un DROP de partition au lieu d'un DELETE massif.
+#
+# Maintenance manuelle : python partitionnement.py maintenir
+
+import os
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import inspect, text, Integer
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import Table
+
+from database import engine
+from models import Production, Batterie, Consommation, Decision
+
+logger = logging.getLogger(__name__)
+
+PARTITIONNEMENT = os.getenv("PARTITIONNEMENT", "")  # "", "jour" ou "mois"
+PARTITIONS_AVANCE = int(os.getenv("PARTITIONS_AVANCE", "7"))  # partitions futures créées à l'avance
+RETENTION_JOURS = int(os.getenv("PARTITION_RETENTION_JOURS", "0"))  # 0 : pas de suppression
+MAINTENANCE_S = int(os.getenv("PARTITION_MAINTENANCE_S", "3600"))
+
+TABLES_PARTITIONNEES = [Production.__table__, Batterie.__table__, Consommation.__table__, Decision.__table__]
+
+_tache: Optional[asyncio.Task] = None
+
+
+def actif(moteur: Engine = engine) -> bool:
+    return PARTITIONNEMENT in ("jour", "mois") and moteur.dialect.name == "postgresql"
+
+
+def debut_periode(jour: date) -> date:
+    return jour if PARTITIONNEMENT == "jour" else jour.replace(day=1)
+
+
+def periode_suivante(debut: date) -> date:
+    if PARTITIONNEMENT == "jour":
+        return debut + timedelta(days=1)
+    return (debut.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def nom_partition(table: str, debut: date) -> str:
+    return f"{table}_p{debut.strftime('%Y%m%d' if PARTITIONNEMENT == 'jour' else '%Y%m')}"
+
+
+def _debut_depuis_nom(table: str, nom: str) -> Optional[date]:
+    suffixe = nom[len(table) + 2:]
+    try:
+        return datetime.strptime(suffixe, "%Y%m%d" if len(suffixe) == 8 else "%Y%m").date()
+    except ValueError:
+        return None  # default partition
+
+
+def ddl_table_parente(table: Table, moteur: Engine) -> str:
+    """
+    CREATE TABLE ... PARTITION BY RANGE (timestamp). La clé primaire d'une table
+    partitionnée doit contenir la clé de partition : (id, timestamp) au lieu de id.
+    """
+    lignes = []
+    for c in table.columns:
+        if c.primary_key and isinstance(c.type, Integer):
+            lignes.append(f"{c.name} SERIAL")
+        else:
+            lignes.append(f"{c.name} {c.type.compile(dialect=moteur.dialect)}")
+    for c in table.columns:
+        for fk in c.foreign_keys:
+            lignes.append(f"FOREIGN KEY ({c.name}) REFERENCES {fk.column.table.name} ({fk.column.name})")
+    lignes.append("PRIMARY KEY (id, timestamp)")
+    return f"CREATE TABLE IF NOT EXISTS {table.name} ({', '.join(lignes)}) PARTITION BY RANGE (timestamp)"
+
+
+def tables_a_creer(moteur: Engine = engine) -> List[Table]:
+    """Tables partitionnables pas encore présentes en base (les tables existantes ne sont pas converties)"""
+    if not actif(moteur):
+        return []
+    existantes = set(inspect(moteur).get_table_names())
+    deja_creees = [t.name for t in TABLES_PARTITIONNEES if t.name in existantes]
+    if deja_creees:
+        logger.warning(f"Tables déjà créées, non partitionnées par cette migration: {deja_creees}")
+    return [t for t in TABLES_PARTITIONNEES if t.name not in existantes]
+
+
+def creer_tables(moteur: Engine, tables: List[Table]):
+    """Tables parentes, index (propagés aux partitions), partition par défaut et partitions à venir"""
+    for table in tables:
+        with moteur.begin() as conn:
+            conn.execute(text(ddl_table_parente(table, moteur)))
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table.name}_defaut PARTITION OF {table.name} DEFAULT"))
+        for index in table.indexes:
+            index.create(bind=moteur, checkfirst=True)
+        logger.info(f"Table partitionnée créée: {table.name} (par {PARTITIONNEMENT})")
+    creer_partitions(moteur, tables)
+
+
+def est_partitionnee(moteur: Engine, nom_table: str) -> bool:
+    if moteur.dialect.name != "postgresql":
+        return False
+    with moteur.connect() as conn:
+        return conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :nom"
+        ), {"nom": nom_table}).first() is not None
+
+
+def partitions(moteur: Engine, nom_table: str) -> List[str]:
+    with moteur.connect() as conn:
+        return list(conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :nom ORDER BY c.relname"
+        ), {"nom": nom_table}).scalars())
+
+
+def creer_partition(moteur: Engine, nom_table: str, debut: date) -> int:
+    """
+    Crée la partition [debut, période suivante) dans une seule transaction. Les lignes de
+    cette période déjà tombées dans la partition par défaut y sont déplacées : DETACH de la
+    partition par défaut, CREATE, INSERT des lignes, DELETE, puis ATTACH. Renvoie le nombre
+    de lignes déplacées.
+    """
+    nom = nom_partition(nom_table, debut)
+    defaut = f"{nom_table}_defaut"
+    bornes = {"debut": debut, "fin": periode_suivante(debut)}
+    creation = (f"CREATE TABLE IF NOT EXISTS {nom} PARTITION OF {nom_table} "
+                f"FOR VALUES FROM ('{debut.isoformat()}') TO ('{bornes['fin'].isoformat()}')")
+    dans_periode = "timestamp >= :debut AND timestamp < :fin"
+    with moteur.begin() as conn:
+        # Same lock as DETACH, taken first: nothing can land in the default partition after the check
+        conn.execute(text(f"LOCK TABLE {nom_table} IN ACCESS EXCLUSIVE MODE"))
+        if conn.execute(text(f"SELECT 1 FROM {defaut} WHERE {dans_periode} LIMIT 1"), bornes).first() is None:
+            conn.execute(text(creation))
+            return 0
+        conn.execute(text(f"ALTER TABLE {nom_table} DETACH PARTITION {defaut}"))
+        conn.execute(text(creation))
+        # Both are partitions of the same parent: identical column order
+        deplacees = conn.execute(text(
+            f"INSERT INTO {nom} SELECT * FROM {defaut} WHERE {dans_periode}"), bornes).rowcount
+        conn.execute(text(f"DELETE FROM {defaut} WHERE {dans_periode}"), bornes)
+        conn.execute(text(f"ALTER TABLE {nom_table} ATTACH PARTITION {defaut} DEFAULT"))
+    logger.warning(f"Partition {nom}: {deplacees} ligne(s) déplacée(s) depuis {defaut}")
+    return deplacees
+
+
+def creer_partitions(moteur: Engine = engine, tables: Optional[List[Table]] = None,
+                     aujourd_hui: Optional[date] = None) -> List[str]:
+    """Crée la partition courante et les PARTITIONS_AVANCE suivantes (idempotent)"""
+    tables = [t for t in (tables or TABLES_PARTITIONNEES) if est_partitionnee(moteur, t.name)]
+    creees = []
+    for table in tables:
+        existantes = set(partitions(moteur, table.name))
+        debut = debut_periode(aujourd_hui or date.today())
+        for _ in range(PARTITIONS_AVANCE + 1):
+            nom = nom_partition(table.name, debut)
+            if nom not in existantes:
+                # A failure rolls the whole move back and stops the maintenance run
+                creer_partition(moteur, table.name, debut)
+                creees.append(nom)
+            debut = periode_suivante(debut)
+    return creees
+
+
+def supprimer_partition(moteur: Engine, nom_table: str, debut: date,
+                        attendu: Optional[Tuple[int, int]] = None) -> bool:
+    """
+    DETACH puis DROP de la partition commençant à `debut` ; False si elle n'existe pas.
+    Avec attendu=(nombre de lignes, id max), la partition n'est supprimée que si elle
+    contient encore exactement ces lignes (False sinon, rien n'est supprimé).
+    """
+    nom = nom_partition(nom_table, debut)
+    if nom not in partitions(moteur, nom_table):
+        return False
+    with moteur.begin() as conn:
+        if attendu is not None:
+            # Same lock as DETACH, taken first: no insert can land between the check and the drop,
+            # and in-flight inserts must commit before it is granted, so the count includes them
+            conn.execute(text(f"LOCK TABLE {nom_table} IN ACCESS EXCLUSIVE MODE"))
+            nombre, id_max = conn.execute(text(f"SELECT count(*), max(id) FROM {nom}")).one()
+            if (nombre, id_max) != attendu:
+                logger.info(f"Partition {nom} conservée: lignes arrivées pendant l'archivage")
+                return False
+        conn.execute(text(f"ALTER TABLE {nom_table} DETACH PARTITION {nom}"))
+        conn.execute(text(f"DROP TABLE {nom}"))
+    logger.info(f"Partition supprimée: {nom}")
+    return True
+
+
+def supprimer_avant(moteur: Engine, limite: date, tables: Optional[List[Table]] = None) -> List[str]:
+    """Supprime les partitions entièrement antérieures à `limite` : O(1) par partition"""
+    supprimees = []
+    for table in tables or TABLES_PARTITIONNEES:
+        if not est_partitionnee(moteur, table.name):
+            continue
+        for nom in partitions(moteur, table.name):
+            debut = _debut_depuis_nom(table.name, nom)
+            if debut and periode_suivante(debut) <= limite and supprimer_partition(moteur, table.name, debut):
+                supprimees.append(nom)
+    return supprimees
+
+
+def maintenir(moteur: Engine = engine) -> dict:
+    """Partitions à venir, puis rétention si PARTITION_RETENTION_JOURS est défini"""
+    bilan = {"creees": creer_partitions(moteur), "supprimees": []}
+    if RETENTION_JOURS > 0:
+        bilan["supprimees"] = supprimer_avant(moteur, date.today() - timedelta(days=RETENTION_JOURS))
+    return bilan
+
+
+async def boucle_maintenance():
+    while True:
+        try:
+            await asyncio.to_thread(maintenir)
+        except Exception as e:
+            logger.error(f"Erreur maintenance des partitions: {e}")
+        await asyncio.sleep(MAINTENANCE_S)
+
+
+def demarrer():
+    """Démarre la tâche de fond (idempotent)"""
+    global _tache
+    if not actif() or (_tache and not _tache.done()):
+        return
+    _tache = asyncio.get_running_loop().create_task(boucle_maintenance())
+
+
+async def arreter():
+    global _tache
+    if _tache:
+        _tache.cancel()
+        try:
+            await _tache
+        except asyncio.CancelledError:
+            pass
+        _tache = None
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["maintenir"]:
+        print(maintenir())
+    else:
+        print("Usage : python partitionnement.py maintenir")
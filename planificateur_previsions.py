@@ -0,0 +1,197 @@
+# planificateur_previsions.py
+# Rafraîchissement des prévisions Solcast en tâche de fond, réparti sur le quota quotidien
+
+import os
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, time, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from database import SessionLocal
+from models import Site
+from solcast_manager import get_gestionnaire_solcast
+from client_solcast import PARALLELISME
+
+logger = logging.getLogger(__name__)
+
+HEURE_LEVER = float(os.getenv("SOLCAST_HEURE_LEVER", "6"))
+HEURE_COUCHER = float(os.getenv("SOLCAST_HEURE_COUCHER", "19"))
+APPELS_RESERVE = int(os.getenv("SOLCAST_APPELS_RESERVE", "1"))  # gardés pour /forcer_prevision/
+RAFRAICHISSEMENT_AUTO = os.getenv("SOLCAST_RAFRAICHISSEMENT_AUTO", "1") == "1"
+RAFRAICHISSEMENT_SITES = os.getenv("SOLCAST_RAFRAICHISSEMENT_SITES", "1") == "1"  # sites de la flotte
+
+_tache: Optional[asyncio.Task] = None
+
+
+def calculer_horaires(nb_appels: int, heure_lever: float = HEURE_LEVER, heure_coucher: float = HEURE_COUCHER) -> List[time]:
+    """
+    Répartit les appels du jour : un juste après minuit (la journée de "demain" change),
+    la moitié du reste autour du lever du soleil, le solde sur la journée.
+    """
+    if nb_appels <= 0:
+        return []
+
+    heures = []
+    restants = nb_appels
+    if nb_appels >= 3:
+        heures.append(0.1)
+        restants -= 1
+
+    # Densify around sunrise: from one hour before to two hours after
+    debut_lever, fin_lever = heure_lever - 1, heure_lever + 2
+    nb_lever = (restants + 1) // 2
+    pas = (fin_lever - debut_lever) / nb_lever
+    heures += [debut_lever + pas * (i + 0.5) for i in range(nb_lever)]
+
+    nb_jour = restants - nb_lever
+    if nb_jour:
+        pas = (heure_coucher - fin_lever) / nb_jour
+        heures += [fin_lever + pas * (i + 0.5) for i in range(nb_jour)]
+
+    return sorted(time(int(h), int(h * 60) % 60) for h in heures)
+
+
+def sites_flotte() -> List[str]:
+    """Sites Solcast distincts de la flotte (rafraîchis en plus de l'installation historique)"""
+    if not RAFRAICHISSEMENT_SITES:
+        return []
+    with SessionLocal() as db:
+        return [s for (s,) in db.query(Site.solcast_site_id).filter(Site.solcast_site_id.isnot(None)).distinct()]
+
+
+def calculer_budgets(sites: List[str]) -> Dict[Optional[str], int]:
+    """
+    Appels planifiés par jour pour chaque gestionnaire (None : installation historique).
+    Le quota appartient à la clé : chaque clé est partagée à parts égales entre les
+    gestionnaires qui l'utilisent, et SOLCAST_APPELS_RESERVE est retiré de la part
+    de l'installation historique pour /forcer_prevision/.
+    """
+    gestionnaires = {None: get_gestionnaire_solcast()}
+    for site in sites:
+        gestionnaires[site] = get_gestionnaire_solcast(site)
+    partage = Counter(cle for g in gestionnaires.values() for cle in g.cles)
+    budgets = {}
+    for site, g in gestionnaires.items():
+        part = sum(g.limite_appels_par_cle / partage[cle] for cle in g.cles)
+        # Epsilon: 10/3 + 10/3 + 10/3 must give 10, not 9
+        budgets[site] = max(0, int(part + 1e-9) - (APPELS_RESERVE if site is None else 0))
+    return budgets
+
+
+def _horaires_du_jour(jour, budget: Optional[int] = None) -> List[datetime]:
+    if budget is None:
+        budget = calculer_budgets([])[None]
+    return [datetime.combine(jour, h) for h in calculer_horaires(budget)]
+
+
+def prochain_rafraichissement(maintenant: Optional[datetime] = None,
+                              budgets: Optional[Dict[Optional[str], int]] = None) -> datetime:
+    """Prochain créneau planifié après maintenant, tous gestionnaires confondus"""
+    maintenant = maintenant or datetime.now()
+    budgets = budgets if budgets is not None else calculer_budgets([])
+    for jour in (maintenant.date(), maintenant.date() + timedelta(days=1)):
+        suivants = [h for budget in set(budgets.values()) for h in _horaires_du_jour(jour, budget) if h > maintenant]
+        if suivants:
+            return min(suivants)
+    return datetime.combine(maintenant.date() + timedelta(days=1), time(0, 0))
+
+
+def dernier_creneau(maintenant: Optional[datetime] = None, budget: Optional[int] = None) -> datetime:
+    """Dernier créneau planifié déjà passé (celui de la veille avant le premier du jour, minuit si aucun)"""
+    maintenant = maintenant or datetime.now()
+    passes = [h for h in _horaires_du_jour(maintenant.date(), budget) if h <= maintenant]
+    if not passes:
+        # Not midnight: a site without a slot yet today must not spend an extra call
+        passes = _horaires_du_jour(maintenant.date() - timedelta(days=1), budget)
+    return passes[-1] if passes else datetime.combine(maintenant.date(), time(0, 0))
+
+
+def rafraichir_si_necessaire(creneau: datetime, solcast_site_id: Optional[str] = None) -> bool:
+    """
+    Rafraîchit les prévisions si aucun worker ne l'a déjà fait pour ce créneau.
+    Retourne True si l'API a été appelée.
+    """
+    gestionnaire = get_gestionnaire_solcast(solcast_site_id)
+    with gestionnaire.stockage.verrou_rafraichissement(gestionnaire.espace):
+        derniere = gestionnaire.derniere_mise_a_jour
+        if derniere and derniere >= creneau:
+            return False
+        if not gestionnaire.peut_appeler_api():
+            logger.warning("Quota Solcast atteint, rafraîchissement planifié ignoré")
+            return False
+        gestionnaire.rafraichir_previsions()
+        logger.info(f"Prévisions Solcast rafraîchies (créneau {creneau.time().isoformat()}, "
+                    f"site {solcast_site_id or 'défaut'})")
+        return True
+
+
+def _rafraichir_site(creneau: datetime, solcast_site_id: str) -> bool:
+    try:
+        return rafraichir_si_necessaire(creneau, solcast_site_id)
+    except Exception as e:
+        logger.error(f"Erreur rafraîchissement Solcast du site {solcast_site_id}: {e}")
+        return False
+
+
+def rafraichir_sites(maintenant: datetime, budgets: Dict[Optional[str], int]) -> int:
+    """
+    Chaque site de la flotte suit ses propres créneaux (sa part du quota de ses clés),
+    SOLCAST_PARALLELISME sites à la fois sur la session HTTP partagée ; retourne le nombre d'appels API
+    """
+    creneaux = {site: dernier_creneau(maintenant, budget) for site, budget in budgets.items()
+                if site is not None and budget > 0}
+    if not creneaux:
+        return 0
+    with ThreadPoolExecutor(max_workers=max(1, min(PARALLELISME, len(creneaux))),
+                            thread_name_prefix="solcast") as executeur:
+        return sum(executeur.map(lambda site: _rafraichir_site(creneaux[site], site), creneaux))
+
+
+async def boucle_rafraichissement():
+    """Boucle de fond : rattrape le créneau manqué au démarrage puis suit le planning"""
+    maintenant = datetime.now()
+    while True:
+        try:
+            # Sites added to the fleet change every key's share: re-read at each slot
+            budgets = calculer_budgets(await asyncio.to_thread(sites_flotte))
+        except Exception as e:
+            logger.error(f"Erreur lecture des sites Solcast de la flotte: {e}")
+            budgets = calculer_budgets([])
+        if budgets[None] > 0:
+            try:
+                await asyncio.to_thread(rafraichir_si_necessaire, dernier_creneau(maintenant, budgets[None]))
+            except Exception as e:
+                logger.error(f"Erreur rafraîchissement planifié Solcast: {e}")
+        try:
+            await asyncio.to_thread(rafraichir_sites, maintenant, budgets)
+        except Exception as e:
+            logger.error(f"Erreur rafraîchissement Solcast de la flotte: {e}")
+
+        maintenant = prochain_rafraichissement(budgets=budgets)
+        await asyncio.sleep(max(0.0, (maintenant - datetime.now()).total_seconds()))
+
+
+def demarrer():
+    """Démarre la tâche de fond (idempotent)"""
+    global _tache
+    if not RAFRAICHISSEMENT_AUTO or (_tache and not _tache.done()):
+        return
+    try:
+        get_gestionnaire_solcast()
+    except ValueError as e:
+        logger.error(f"Planificateur Solcast désactivé: {e}")
+        return
+    _tache = asyncio.get_running_loop().create_task(boucle_rafraichissement())
+
+
+async def arreter():
+    global _tache
+    if _tache:
+        _tache.cancel()
+        try:
+            await _tache
+        except asyncio.CancelledError:
+            pass
+        _tache = None
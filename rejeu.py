@@ -0,0 +1,247 @@
+# rejeu.py
+# Rejeu déterministe de prévisions et de mesures historiques à travers optimiser_complet,
+# sur une horloge virtuelle, plus vite que le temps réel : bancs de charge et tests de
+# non-régression des stratégies, sans réseau ni quota Solcast.
+#
+# Usage :
+#   python rejeu.py --debut 2024-06-01 --fin 2024-06-08 [--pas 300] [--mesures DOSSIER]
+#                   [--previsions instantanes.ndjson] [--charges charges.json] [--vitesse 0]
+#                   [--sortie etapes.ndjson] [--reference etapes.ndjson]
+#
+# Mesures : production.ndjson et batterie.ndjson de DOSSIER (format de GET /export/{table}/),
+#           sinon lues dans la base configurée sur [debut, fin).
+# Prévisions : instantanés {"recu_le": ..., "forecasts": [...]} (une ligne chacun), sinon
+#              fournisseur local (SOLCAST_LOCAL_FICHIER ou synthétique) appelé chaque jour
+#              virtuel à 00:06 pour le lendemain, comme le planificateur.
+# Décisions : base SQLite en mémoire, charges de --charges ou copiées de la base configurée.
+# Avec --reference, le code de sortie vaut 1 si une stratégie diffère.
+
+import os
+import sys
+import json
+import time as chrono
+import logging
+import argparse
+import tempfile
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base, SessionLocal
+from models import Charge, Production, Batterie, Decision
+from export import pages, colonnes
+from stockage_previsions import StockagePrevisions
+from fournisseur_local import FournisseurLocal
+from solcast_manager import GestionnaireSolcast
+from optimiseur_robuste import OptimiseurRobuste
+
+logger = logging.getLogger(__name__)
+
+HEURE_PUBLICATION = time(0, 6)  # first scheduled refresh of the day (planificateur_previsions)
+
+
+# --- Entrées -------------------------------------------------------------------
+
+def _lire_ndjson(chemin: str) -> Iterator[Dict]:
+    with open(chemin, "r", encoding="utf-8") as f:
+        for ligne in f:
+            if ligne.strip():
+                yield json.loads(ligne)
+
+
+def charger_mesures(modele, champ: str, debut: datetime, fin: datetime, dossier: Optional[str] = None,
+                    site_id: Optional[int] = None) -> Tuple[List[datetime], List[float]]:
+    """Série (instants triés, valeurs) d'une table, depuis un export NDJSON ou la base"""
+    if dossier:
+        lignes = _lire_ndjson(os.path.join(dossier, f"{modele.__tablename__}.ndjson"))
+    else:
+        noms = colonnes(modele)
+        lignes = (dict(zip(noms, ligne)) for page in pages(modele, debut=debut, fin=fin) for ligne in page)
+    points = []
+    for ligne in lignes:
+        instant = ligne["timestamp"]
+        if isinstance(instant, str):
+            instant = datetime.fromisoformat(instant)
+        if debut <= instant < fin and ligne.get("site_id") == site_id and ligne.get(champ) is not None:
+            points.append((instant, float(ligne[champ])))
+    points.sort(key=lambda p: p[0])
+    return [p[0] for p in points], [p[1] for p in points]
+
+
+def charger_instantanes(chemin: str) -> List[Tuple[datetime, List[Dict]]]:
+    return sorted(
+        ((datetime.fromisoformat(l["recu_le"]), l["forecasts"]) for l in _lire_ndjson(chemin)),
+        key=lambda s: s[0]
+    )
+
+
+def instantanes_fournisseur(fournisseur: FournisseurLocal, debut: datetime, fin: datetime,
+                            site_id: str = "rejeu") -> List[Tuple[datetime, List[Dict]]]:
+    """Un instantané par jour virtuel : prévisions du lendemain publiées à HEURE_PUBLICATION"""
+    instantanes = []
+    jour = debut.date() - timedelta(days=1)  # forecasts already known at the start
+    while jour <= fin.date():
+        demain = jour + timedelta(days=1)
+        publication = max(datetime.combine(jour, HEURE_PUBLICATION), debut - timedelta(seconds=1))
+        instantanes.append((publication, fournisseur.previsions(
+            "local", site_id, f"{demain}T00:00:00Z", f"{demain}T23:59:59Z"
+        )))
+        jour = demain
+    return instantanes
+
+
+def base_rejeu(charges: Optional[List[Dict]] = None):
+    """Base SQLite en mémoire avec les charges de l'installation historique"""
+    moteur = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=moteur)
+    Session = sessionmaker(bind=moteur)
+    if charges is None:
+        with SessionLocal() as source:
+            charges = [
+                {"id": c.id, "nom": c.nom, "type": c.type, "puissance_nominale": c.puissance_nominale}
+                for c in source.query(Charge).filter(Charge.site_id.is_(None)).all()
+            ]
+    with Session() as db:
+        db.add_all(Charge(**c) for c in charges)
+        db.commit()
+    return Session
+
+
+# --- Rejeu ---------------------------------------------------------------------
+
+def _valeur_a(instants: List[datetime], valeurs: List[float], instant: datetime, defaut: float = 0.0) -> float:
+    """Dernière valeur connue à `instant` (mesure la plus récente antérieure)"""
+    i = bisect_right(instants, instant)
+    return valeurs[i - 1] if i else defaut
+
+
+def rejouer(debut: datetime, fin: datetime, pas_s: int, production: Tuple[List, List], batterie: Tuple[List, List],
+            instantanes: List[Tuple[datetime, List[Dict]]], Session, vitesse: float = 0.0) -> Dict:
+    """
+    Appelle optimiser_complet tous les `pas_s` secondes virtuelles. vitesse=0 : aussi vite que
+    possible ; vitesse=60 : une minute virtuelle par seconde réelle (bancs de charge).
+    """
+    with tempfile.TemporaryDirectory() as dossier:
+        gestionnaire = GestionnaireSolcast(
+            StockagePrevisions(os.path.join(dossier, "cache_rejeu.json")), espace="rejeu",
+            fournisseur=FournisseurLocal()
+        )
+        optimiseur = OptimiseurRobuste()
+        optimiseur.solcast_manager = gestionnaire
+
+        etapes, durees = [], []
+        prochain_instantane = 0
+        debut_reel = chrono.perf_counter()
+        instant = debut
+        with Session() as db:
+            while instant < fin:
+                # Publish every snapshot received up to the virtual clock
+                while prochain_instantane < len(instantanes) and instantanes[prochain_instantane][0] <= instant:
+                    recu_le, previsions = instantanes[prochain_instantane]
+                    with gestionnaire.stockage.modifier(gestionnaire.espace) as entree:
+                        entree["previsions"] = previsions
+                        entree["derniere_mise_a_jour"] = recu_le.isoformat()
+                    prochain_instantane += 1
+
+                contexte = {
+                    "production_actuelle": _valeur_a(*production, instant),
+                    "soc_batterie": _valeur_a(*batterie, instant),
+                    "evenement_special": False,
+                    "maintenant": instant,
+                }
+                debut_appel = chrono.perf_counter()
+                resultat = optimiseur.optimiser_complet(db, contexte)
+                durees.append((chrono.perf_counter() - debut_appel) * 1000)
+                etapes.append({
+                    "instant": instant.isoformat(),
+                    "production_w": contexte["production_actuelle"],
+                    "soc": contexte["soc_batterie"],
+                    "strategie": resultat["strategie"]["nom"],
+                    "score": round(resultat["strategie"]["score"], 3),
+                })
+
+                instant += timedelta(seconds=pas_s)
+                if vitesse > 0:
+                    attente = (instant - debut).total_seconds() / vitesse - (chrono.perf_counter() - debut_reel)
+                    if attente > 0:
+                        chrono.sleep(attente)
+            nb_decisions = db.query(Decision).count()
+
+    duree_reelle = chrono.perf_counter() - debut_reel
+    strategies = [e["strategie"] for e in etapes]
+    p50, p99 = np.percentile(durees, [50, 99]) if durees else (0.0, 0.0)
+    return {
+        "bilan": {
+            "nb_etapes": len(etapes),
+            "duree_virtuelle_s": (fin - debut).total_seconds(),
+            "duree_reelle_s": round(duree_reelle, 3),
+            "acceleration": round((fin - debut).total_seconds() / duree_reelle, 1) if duree_reelle else None,
+            "optimisation_p50_ms": round(float(p50), 3),
+            "optimisation_p99_ms": round(float(p99), 3),
+            "strategies": {nom: strategies.count(nom) for nom in sorted(set(strategies))},
+            "changements_strategie": sum(a != b for a, b in zip(strategies, strategies[1:])),
+            "decisions_enregistrees": nb_decisions,
+            "nb_instantanes_previsions": prochain_instantane,
+        },
+        "etapes": etapes,
+    }
+
+
+def comparer(etapes: List[Dict], reference: List[Dict]) -> List[Dict]:
+    """Étapes dont la stratégie diffère de la référence (même instant)"""
+    attendues = {e["instant"]: e["strategie"] for e in reference}
+    return [
+        {"instant": e["instant"], "attendu": attendues[e["instant"]], "obtenu": e["strategie"]}
+        for e in etapes if e["instant"] in attendues and attendues[e["instant"]] != e["strategie"]
+    ]
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parseur = argparse.ArgumentParser(description="Rejeu des prévisions et mesures dans optimiser_complet")
+    parseur.add_argument("--debut", required=True, type=datetime.fromisoformat)
+    parseur.add_argument("--fin", required=True, type=datetime.fromisoformat)
+    parseur.add_argument("--pas", type=int, default=300, help="secondes virtuelles entre deux optimisations")
+    parseur.add_argument("--mesures", help="dossier de production.ndjson et batterie.ndjson")
+    parseur.add_argument("--previsions", help="instantanés NDJSON {recu_le, forecasts}")
+    parseur.add_argument("--charges", help="charges JSON [{id, nom, type, puissance_nominale}]")
+    parseur.add_argument("--site", type=int, help="site de la flotte (installation historique par défaut)")
+    parseur.add_argument("--vitesse", type=float, default=0.0, help="facteur d'accélération, 0 : sans limite")
+    parseur.add_argument("--sortie", help="étapes en NDJSON")
+    parseur.add_argument("--reference", help="étapes NDJSON d'un rejeu précédent à comparer")
+    options = parseur.parse_args(arguments)
+
+    production = charger_mesures(Production, "production", options.debut, options.fin, options.mesures, options.site)
+    batterie = charger_mesures(Batterie, "soc", options.debut, options.fin, options.mesures, options.site)
+    if options.previsions:
+        instantanes = charger_instantanes(options.previsions)
+    else:
+        instantanes = instantanes_fournisseur(FournisseurLocal(), options.debut, options.fin)
+    charges = None
+    if options.charges:
+        with open(options.charges, "r", encoding="utf-8") as f:
+            charges = json.load(f)
+
+    resultat = rejouer(options.debut, options.fin, options.pas, production, batterie, instantanes,
+                       base_rejeu(charges), options.vitesse)
+    if options.sortie:
+        with open(options.sortie, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(e) + "\n" for e in resultat["etapes"])
+
+    code = 0
+    if options.reference:
+        differences = comparer(resultat["etapes"], list(_lire_ndjson(options.reference)))
+        resultat["bilan"]["differences"] = len(differences)
+        resultat["bilan"]["premieres_differences"] = differences[:20]
+        code = 1 if differences else 0
+    print(json.dumps(resultat["bilan"], indent=2, ensure_ascii=False))
+    return code
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,338 @@
+# requetes.py
+# Requêtes d'historique partagées par les routes sync (api.py) et async (api_async.py) :
+# chaque endpoint = un dictionnaire de SELECT + une fonction de mise en forme
+
+import os
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func, and_, or_, Integer
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Production, Batterie, Consommation, AgregatConsommation
+from agregats import (
+    debut_creneau, combiner_statistiques, site_agregat, AGREGATS_ACTIFS, PAS_AGREGATS, MODELES_AGREGATS
+)
+import archivage
+
+# Response size bound for the down-sampled series (pas is enlarged beyond it)
+NB_CRENEAUX_MAX = int(os.getenv("SERIE_NB_CRENEAUX_MAX", "500"))
+PAS_USUELS = (5, 15, 30, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400)
+INTERVALLE_MESURES_S = 5  # Arduino sampling period, energy estimate without rollups
+
+SOURCES_BRUTES = {
+    "production": (Production, Production.production),
+    "batterie": (Batterie, Batterie.soc),
+    "consommation": (Consommation, Consommation.consommation),
+}
+EPOCH = datetime(1970, 1, 1)
+
+
+def _lignes(resultat, requete: Select) -> List:
+    """Entités ou valeurs pour un SELECT à une colonne, tuples sinon"""
+    return resultat.scalars().all() if len(requete.selected_columns) == 1 else resultat.all()
+
+
+def executer(db: Session, requetes: Dict[str, Select]) -> Dict[str, List]:
+    return {nom: _lignes(db.execute(requete), requete) for nom, requete in requetes.items()}
+
+
+async def executer_async(db: AsyncSession, requetes: Dict[str, Select]) -> Dict[str, List]:
+    return {nom: _lignes(await db.execute(requete), requete) for nom, requete in requetes.items()}
+
+
+# --- Séries agrégées côté SQL ------------------------------------------------
+
+class creneau_epoch(FunctionElement):
+    """
+    Début du créneau de `pas` secondes contenant la colonne, en secondes depuis 1970
+    (horodatages naïfs, créneaux alignés sur minuit pour les pas diviseurs d'un jour)
+    """
+    type = Integer()
+    inherit_cache = True
+    name = "creneau_epoch"
+
+
+def _pas_litteral(element) -> Tuple:
+    colonne, pas = element.clauses
+    return colonne, int(pas.value)  # inlined: GROUP BY must repeat the exact SELECT expression
+
+
+@compiles(creneau_epoch, "postgresql")
+def _creneau_postgresql(element, compiler, **kw):
+    colonne, pas = _pas_litteral(element)
+    return f"(floor(extract(epoch from {compiler.process(colonne, **kw)}) / {pas}) * {pas})::bigint"
+
+
+@compiles(creneau_epoch, "sqlite")
+def _creneau_sqlite(element, compiler, **kw):
+    colonne, pas = _pas_litteral(element)
+    return f"(CAST(strftime('%s', {compiler.process(colonne, **kw)}) AS INTEGER) / {pas} * {pas})"
+
+
+def fenetre_serie(debut: Optional[datetime], fin: Optional[datetime], pas: Optional[int],
+                  debut_defaut: datetime) -> Tuple[datetime, datetime, int]:
+    """Valide la fenêtre [debut, fin) et choisit un pas donnant au plus NB_CRENEAUX_MAX créneaux"""
+    fin = fin or datetime.now()
+    debut = debut or debut_defaut
+    if debut >= fin:
+        raise ValueError("debut doit précéder fin")
+    if pas is not None and pas <= 0:
+        raise ValueError("pas doit être positif")
+
+    minimum = (fin - debut).total_seconds() / NB_CRENEAUX_MAX
+    if pas and pas >= minimum:
+        return debut, fin, pas
+    pas = next((p for p in PAS_USUELS if p >= minimum), math.ceil(minimum / 86400) * 86400)
+    return debut, fin, pas
+
+
+def pas_agregat(pas: int) -> Optional[int]:
+    """Pas d'agrégat divisant `pas` (le plus grand), None si la série se lit sur les mesures brutes"""
+    return next((p for p in reversed(PAS_AGREGATS) if pas % p == 0), None) if AGREGATS_ACTIFS else None
+
+
+def filtre_site(modele, site_id: Optional[int]):
+    """Mesures brutes d'un site de la flotte, ou de l'installation historique (site_id NULL)"""
+    return modele.site_id.is_(None) if site_id is None else modele.site_id == site_id
+
+
+def requete_serie(nom: str, debut: datetime, fin: datetime, pas: int, id_charge: Optional[int] = None,
+                  site_id: Optional[int] = None) -> Select:
+    """
+    (créneau, nombre, somme, minimum, maximum) par créneau de `pas` secondes, GROUP BY en base.
+    Lit les agrégats quand l'un de leurs pas divise `pas` (bords arrondis à ce pas),
+    les mesures brutes sinon. site_id : installation historique par défaut ; ignoré pour
+    une charge, qui n'appartient qu'à un site.
+    """
+    pas_source = pas_agregat(pas)
+    if pas_source:
+        modele = MODELES_AGREGATS[nom]
+        creneau = creneau_epoch(modele.debut, pas).label("creneau")
+        colonnes = (func.sum(modele.nombre), func.sum(modele.somme), func.min(modele.minimum), func.max(modele.maximum))
+        filtres = [modele.pas == pas_source, modele.debut >= debut_creneau(debut, pas_source), modele.debut < fin]
+        if id_charge is None:
+            filtres.append(modele.site_id == site_agregat(site_id))
+    else:
+        modele, valeur = SOURCES_BRUTES[nom]
+        creneau = creneau_epoch(modele.timestamp, pas).label("creneau")
+        colonnes = (func.count(valeur), func.sum(valeur), func.min(valeur), func.max(valeur))
+        filtres = [modele.timestamp >= debut, modele.timestamp < fin]
+        if id_charge is None:
+            filtres.append(filtre_site(modele, site_id))
+    if id_charge is not None:
+        filtres.append(modele.id_charge == id_charge)
+    return select(creneau, *colonnes).where(*filtres).group_by(creneau).order_by(creneau)
+
+
+def formater_serie(lignes: List) -> List[Dict]:
+    return [{
+        "debut": (EPOCH + timedelta(seconds=int(creneau))).isoformat(),
+        "nombre": nombre,
+        "moyenne": round(somme / nombre, 2) if nombre else 0,
+        "minimum": minimum,
+        "maximum": maximum
+    } for creneau, nombre, somme, minimum, maximum in lignes]
+
+
+def fusionner_series(*series: List) -> List[tuple]:
+    """Fusionne des séries (créneau, nombre, somme, minimum, maximum) créneau par créneau"""
+    fusion: Dict[int, list] = {}
+    for serie in series:
+        for creneau, nombre, somme, minimum, maximum in serie:
+            cumul = fusion.get(int(creneau))
+            if cumul is None:
+                fusion[int(creneau)] = [nombre, somme, minimum, maximum]
+            else:
+                cumul[0] += nombre
+                cumul[1] += somme
+                cumul[2] = min(cumul[2], minimum)
+                cumul[3] = max(cumul[3], maximum)
+    return [(creneau, *cumul) for creneau, cumul in sorted(fusion.items())]
+
+
+def completer_serie(resultats: Dict[str, List], cle: str, nom: str, debut: datetime, fin: datetime,
+                    pas: int, id_charge: Optional[int] = None, site_id: Optional[int] = None):
+    """
+    Ajoute à une série lue sur les mesures brutes les partitions archivées (archivage.py).
+    Les agrégats ne sont pas archivés : une série lue sur les agrégats est déjà complète.
+    """
+    if pas_agregat(pas) or not archivage.couvre(nom, debut, fin):
+        return
+    valeur = SOURCES_BRUTES[nom][1].key
+    resultats[cle] = fusionner_series(
+        resultats[cle], archivage.serie_archivee(nom, valeur, debut, fin, pas, id_charge, site_id)
+    )
+
+
+def totaux_serie(lignes: List) -> Dict:
+    """Statistiques de la fenêtre à partir de ses créneaux (sans énergie)"""
+    return combiner_statistiques([(nombre, somme, minimum, maximum, None)
+                                  for _, nombre, somme, minimum, maximum in lignes])
+
+
+def requetes_statistiques_fenetre(modele, debut: datetime, fin: datetime, *filtres) -> Dict[str, Select]:
+    """
+    Statistiques d'une fenêtre quelconque à partir des agrégats : créneaux horaires
+    pour les heures pleines, créneaux d'une minute pour les bords.
+    """
+    colonnes = (func.sum(modele.nombre), func.sum(modele.somme), func.min(modele.minimum),
+                func.max(modele.maximum), func.sum(modele.energie_wh))
+    debut_minute = debut_creneau(debut, 60)
+    premiere_heure = debut_creneau(debut, 3600)
+    if premiere_heure < debut_minute:
+        premiere_heure += timedelta(hours=1)
+    derniere_heure = debut_creneau(fin, 3600)
+    if premiere_heure > derniere_heure:
+        # Less than one full hour: minutes only
+        premiere_heure = derniere_heure = debut_minute
+
+    return {
+        "stats_heures": select(*colonnes).where(
+            modele.pas == 3600, modele.debut >= premiere_heure, modele.debut < derniere_heure, *filtres
+        ),
+        "stats_minutes": select(*colonnes).where(
+            modele.pas == 60,
+            or_(and_(modele.debut >= debut_minute, modele.debut < premiere_heure),
+                and_(modele.debut >= derniere_heure, modele.debut <= fin)),
+            *filtres
+        ),
+    }
+
+
+# --- /mesures/dernieres/ -------------------------------------------------
+
+def requetes_dernieres_mesures(limit: int, site_id: Optional[int] = None) -> Dict[str, Select]:
+    return {
+        "productions": select(Production).where(filtre_site(Production, site_id))
+        .order_by(Production.timestamp.desc()).limit(limit),
+        "batteries": select(Batterie).where(filtre_site(Batterie, site_id))
+        .order_by(Batterie.timestamp.desc()).limit(limit),
+        "consommations": select(Consommation).where(filtre_site(Consommation, site_id))
+        .order_by(Consommation.timestamp.desc()).limit(limit),
+    }
+
+
+def formater_dernieres_mesures(resultats: Dict[str, List]) -> Dict:
+    return {
+        "productions": [{
+            "id": p.id,
+            "production": p.production,
+            "timestamp": p.timestamp.isoformat()
+        } for p in resultats["productions"]],
+        "batteries": [{
+            "id": b.id,
+            "soc": b.soc,
+            "tension": b.tension,
+            "courant": b.courant,
+            "timestamp": b.timestamp.isoformat()
+        } for b in resultats["batteries"]],
+        "consommations": [{
+            "id": c.id,
+            "charge_id": c.id_charge,
+            "consommation": c.consommation,
+            "timestamp": c.timestamp.isoformat()
+        } for c in resultats["consommations"]]
+    }
+
+
+# --- /tendances/ ---------------------------------------------------------
+
+def requetes_tendances(debut: datetime, fin: datetime, pas: int, site_id: Optional[int] = None) -> Dict[str, Select]:
+    return {
+        "productions": requete_serie("production", debut, fin, pas, site_id=site_id),
+        "consommations": requete_serie("consommation", debut, fin, pas, site_id=site_id),
+    }
+
+
+def completer_tendances(resultats: Dict[str, List], debut: datetime, fin: datetime, pas: int,
+                        site_id: Optional[int] = None) -> Dict[str, List]:
+    """Lecture des archives Parquet (bloquante : hors de la boucle en mode async)"""
+    completer_serie(resultats, "productions", "production", debut, fin, pas, site_id=site_id)
+    completer_serie(resultats, "consommations", "consommation", debut, fin, pas, site_id=site_id)
+    return resultats
+
+
+def formater_tendances(resultats: Dict[str, List], debut: datetime, fin: datetime, pas: int) -> Dict:
+    # Window totals are the sum of the buckets: no second scan
+    productions = totaux_serie(resultats["productions"])
+    consommations = totaux_serie(resultats["consommations"])
+    prod_moyenne = productions["moyenne"]
+    conso_moyenne = consommations["moyenne"]
+
+    return {
+        "production_moyenne_24h": prod_moyenne,
+        "consommation_moyenne_24h": conso_moyenne,
+        "efficacite": (prod_moyenne / conso_moyenne * 100) if conso_moyenne > 0 else 0,
+        "nombre_mesures_production": productions["nombre"],
+        "nombre_mesures_consommation": consommations["nombre"],
+        "periode": {"debut": debut.isoformat(), "fin": fin.isoformat(), "pas_secondes": pas},
+        "serie": {
+            "production": formater_serie(resultats["productions"]),
+            "consommation": formater_serie(resultats["consommations"])
+        }
+    }
+
+
+# --- /mesures/charge/{charge_id}/ ------------------------------------------
+
+def requetes_historique_charge(charge_id: int, debut: datetime, fin: datetime, pas: int) -> Dict[str, Select]:
+    requetes = {
+        "serie": requete_serie("consommation", debut, fin, pas, id_charge=charge_id),
+        # Only the 100 most recent raw measurements are displayed
+        "consommations": select(Consommation).where(
+            Consommation.id_charge == charge_id,
+            Consommation.timestamp >= debut,
+            Consommation.timestamp < fin
+        ).order_by(Consommation.timestamp.desc()).limit(100),
+    }
+    if AGREGATS_ACTIFS:
+        # Exact window statistics (and integrated energy) from the rollups
+        requetes.update(requetes_statistiques_fenetre(
+            AgregatConsommation, debut, fin, AgregatConsommation.id_charge == charge_id
+        ))
+    return requetes
+
+
+def completer_historique_charge(resultats: Dict[str, List], charge_id: int, debut: datetime, fin: datetime,
+                                pas: int) -> Dict[str, List]:
+    """Lecture des archives Parquet (bloquante : hors de la boucle en mode async)"""
+    completer_serie(resultats, "serie", "consommation", debut, fin, pas, id_charge=charge_id)
+    manquantes = 100 - len(resultats["consommations"])
+    if manquantes > 0 and archivage.couvre("consommation", debut, fin):
+        resultats["consommations"] = list(resultats["consommations"]) + archivage.dernieres_archivees(
+            "consommation", debut, fin, manquantes, id_charge=charge_id
+        )
+    return resultats
+
+
+def formater_historique_charge(charge_id: int, debut: datetime, fin: datetime, pas: int,
+                               resultats: Dict[str, List]) -> Dict:
+    if "stats_heures" in resultats:
+        statistiques = combiner_statistiques(resultats["stats_heures"] + resultats["stats_minutes"])
+    else:
+        statistiques = totaux_serie(resultats["serie"])
+        statistiques["energie_wh"] = statistiques["moyenne"] * statistiques["nombre"] * INTERVALLE_MESURES_S / 3600
+
+    return {
+        "charge_id": charge_id,
+        "periode_heures": round((fin - debut).total_seconds() / 3600, 2),
+        "periode": {"debut": debut.isoformat(), "fin": fin.isoformat(), "pas_secondes": pas},
+        "statistiques": {
+            "moyenne_watts": round(statistiques["moyenne"], 2),
+            "maximum_watts": statistiques["maximum"],
+            "minimum_watts": statistiques["minimum"],
+            "energie_totale_wh": round(statistiques["energie_wh"], 2),  # integrated over real sample spacing
+            "nombre_mesures": statistiques["nombre"]
+        },
+        "serie": formater_serie(resultats["serie"]),
+        "historique": [{
+            "consommation": c.consommation,
+            "timestamp": c.timestamp.isoformat()
+        } for c in resultats["consommations"]]
+    }
@@ -0,0 +1,23 @@
+# schemas.py
+# Modèles Pydantic partagés par les routes sync (api.py) et async (api_async.py)
+
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class ConsommationData(BaseModel):
+    charge_id: int
+    consommation: float
+
+class MesuresData(BaseModel):
+    production: float
+    soc_batterie: float
+    tension_batterie: float
+    courant_batterie: float
+    consommations: List[ConsommationData]
+    timestamp: Optional[datetime] = None  # Device-side timestamp, server time if missing
+    site_id: Optional[int] = None  # None: historical single installation
+
+class LotMesures(BaseModel):
+    echantillons: List[MesuresData]
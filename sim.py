@@ -1,76 +1,249 @@
-import requests
-import random
-from datetime import datetime
+# sim.py
+# Load generator: thousands of simulated devices on asyncio sharing one pooled HTTP client.
+#
+# Each device follows its own diurnal profile (PV peak, cloud cover random walk, battery SOC
+# integrated from production and consumption, charges switching on and off) and sends its
+# measurements at a fixed rate; devices also poll /commandes/, and dashboard readers hit the
+# read endpoints. Requests are scheduled open-loop (a slow server does not slow the offered
+# load down) and the report gives throughput and p50/p95/p99 latency per endpoint.
+#
+# Usage: python sim.py [--appareils 1000] [--duree 60] [--intervalle 5] [--lot 1]
+#                      [--poll-commandes 10] [--lecteurs 20] [--intervalle-lecture 2]
+#                      [--acceleration 1] [--json resultat.json]
+# The API is expected at SIM_URL (default http://localhost:8000/api, the app.py mount).
+
+import os
+import sys
+import json
+import math
 import time
-from typing import List
-from pydantic import BaseModel
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 
-# Configuration
-API_URL = "http://localhost:8000/api/mesures"
+import httpx
+
+API_URL = os.getenv("SIM_URL", "http://localhost:8000/api")
 CHARGE_IDS = [1, 2, 3, 4, 5]  # IDs of charges from create_initial_charges
-INTERVAL_SECONDS = 5  # Send data every 5 seconds
-NUM_ITERATIONS = 10  # Number of data points to send (adjust as needed)
-
-class ConsommationData(BaseModel):
-    charge_id: int
-    consommation: float
-
-class MesuresData(BaseModel):
-    production: float
-    soc_batterie: float
-    tension_batterie: float
-    courant_batterie: float
-    consommations: List[ConsommationData]
-
-def generate_mock_data() -> MesuresData:
-    """Generate realistic mock data for measurements."""
-    # Simulate solar production (0-1000 W, varies with time of day)
-    hour = datetime.now().hour
-    production = max(0, random.gauss(500, 200) * (1 - abs(12 - hour) / 12))  # Peak at noon
-
-    # Simulate battery state
-    soc_batterie = random.uniform(20.0, 100.0)  # Battery state of charge (20-100%)
-    tension_batterie = random.uniform(48.0, 54.0)  # Battery voltage (48-54V for a typical 48V system)
-    courant_batterie = random.uniform(-50.0, 50.0)  # Battery current (-50A to +50A)
-
-    # Simulate consumption for each charge
-    consommations = []
-    for charge_id in CHARGE_IDS:
-        # Random consumption based on typical load patterns
-        consommation = random.gauss(50, 20) if random.random() > 0.3 else 0  # 70% chance of being ON
-        consommations.append(ConsommationData(charge_id=charge_id, consommation=max(0, consommation)))
-
-    return MesuresData(
-        production=production,
-        soc_batterie=soc_batterie,
-        tension_batterie=tension_batterie,
-        courant_batterie=courant_batterie,
-        consommations=consommations
-    )
-
-def send_measurements():
-    """Send mock measurements to the /mesures endpoint."""
-    for i in range(NUM_ITERATIONS):
+HEURE_LEVER, HEURE_COUCHER = 6.0, 19.0
+
+
+class Statistiques:
+    """Latencies and errors per endpoint"""
+
+    def __init__(self):
+        self.latences: Dict[str, List[float]] = {}
+        self.erreurs: Dict[str, int] = {}
+        self.retards = 0  # ticks started late because the event loop was saturated
+
+    def noter(self, endpoint: str, duree_s: float, erreur: bool):
+        self.latences.setdefault(endpoint, []).append(duree_s)
+        if erreur:
+            self.erreurs[endpoint] = self.erreurs.get(endpoint, 0) + 1
+
+    def rapport(self, duree_s: float) -> Dict:
+        def centile(valeurs: List[float], q: float) -> Optional[float]:
+            return round(valeurs[min(len(valeurs) - 1, int(len(valeurs) * q))] * 1000, 2) if valeurs else None
+
+        endpoints = {}
+        for endpoint, latences in sorted(self.latences.items()):
+            latences = sorted(latences)
+            endpoints[endpoint] = {
+                "requetes": len(latences),
+                "requetes_par_s": round(len(latences) / duree_s, 1),
+                "erreurs": self.erreurs.get(endpoint, 0),
+                "p50_ms": centile(latences, 0.50),
+                "p95_ms": centile(latences, 0.95),
+                "p99_ms": centile(latences, 0.99),
+                "max_ms": round(latences[-1] * 1000, 2),
+            }
+        total = sum(len(l) for l in self.latences.values())
+        return {
+            "duree_s": round(duree_s, 1),
+            "requetes": total,
+            "requetes_par_s": round(total / duree_s, 1),
+            "erreurs": sum(self.erreurs.values()),
+            "ticks_en_retard": self.retards,
+            "endpoints": endpoints,
+        }
+
+
+class Appareil:
+    """One simulated installation: state evolves between two samples"""
+
+    def __init__(self, numero: int, tirage: random.Random, site_id: Optional[int] = None):
+        self.numero = numero
+        self.tirage = tirage
+        self.site_id = site_id
+        self.crete_w = tirage.uniform(1500, 6000)
+        self.capacite_wh = tirage.uniform(5000, 15000)
+        self.soc = tirage.uniform(30, 90)
+        self.nuages = tirage.uniform(0, 0.8)
+        self.charges = {i: tirage.random() < 0.5 for i in CHARGE_IDS}
+        self.puissances = {i: tirage.uniform(30, 300) for i in CHARGE_IDS}
+
+    def echantillon(self, instant: datetime, pas_s: float) -> Dict:
+        """Next measurement at virtual time `instant`, `pas_s` virtual seconds after the previous one"""
+        t = self.tirage
+        heure = instant.hour + instant.minute / 60
+        soleil = math.sin(math.pi * (heure - HEURE_LEVER) / (HEURE_COUCHER - HEURE_LEVER)) \
+            if HEURE_LEVER < heure < HEURE_COUCHER else 0.0
+        # Cloud cover drifts slowly; production follows it with some noise
+        self.nuages = min(max(self.nuages + t.gauss(0, 0.02 * math.sqrt(max(pas_s, 1) / 5)), 0.0), 1.0)
+        production = max(0.0, self.crete_w * soleil * (1 - 0.75 * self.nuages) * t.gauss(1, 0.03))
+
+        for i in CHARGE_IDS:
+            # Evening peak: loads are more likely to be switched on after sunset
+            probabilite = 0.02 if 17 <= heure <= 22 else 0.01
+            if t.random() < probabilite * pas_s / 5:
+                self.charges[i] = not self.charges[i]
+        consommations = [
+            {"charge_id": i, "consommation": round(self.puissances[i] * t.gauss(1, 0.05), 1) if actif else 0.0}
+            for i, actif in self.charges.items()
+        ]
+        consommation = sum(c["consommation"] for c in consommations)
+
+        puissance = production - consommation
+        self.soc = min(max(self.soc + puissance * pas_s / 3600 / self.capacite_wh * 100, 5.0), 100.0)
+        tension = 48 + 6 * self.soc / 100
+        echantillon = {
+            "production": round(production, 1),
+            "soc_batterie": round(self.soc, 2),
+            "tension_batterie": round(tension, 2),
+            "courant_batterie": round(puissance / tension, 2),
+            "consommations": consommations,
+            "timestamp": instant.isoformat(),
+        }
+        if self.site_id is not None:
+            echantillon["site_id"] = self.site_id
+        return echantillon
+
+
+class Simulation:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.stats = Statistiques()
+        self.debut_reel = 0.0
+        self.debut_virtuel = datetime.now()
+        self.fin = 0.0
+
+    def maintenant_virtuel(self) -> datetime:
+        ecoule = time.perf_counter() - self.debut_reel
+        return self.debut_virtuel + timedelta(seconds=ecoule * self.options.acceleration)
+
+    async def requete(self, http: httpx.AsyncClient, methode: str, endpoint: str, **kwargs):
+        debut = time.perf_counter()
+        erreur = False
         try:
-            # Generate mock data
-            data = generate_mock_data()
-            
-            # Send POST request to the API
-            response = requests.post(API_URL, json=data.dict())
-            
-            # Check response
-            if response.status_code == 200:
-                print(f"[{datetime.now().isoformat()}] Data sent successfully: {response.json()}")
+            reponse = await http.request(methode, endpoint, **kwargs)
+            erreur = reponse.status_code >= 400
+        except httpx.HTTPError:
+            erreur = True
+        self.stats.noter(endpoint, time.perf_counter() - debut, erreur)
+
+    async def cadence(self, intervalle_s: float, action):
+        """Open-loop schedule: ticks every intervalle_s from a random phase, whatever the latency"""
+        prochain = time.perf_counter() + random.uniform(0, intervalle_s)
+        en_cours = set()
+        while prochain < self.fin:
+            attente = prochain - time.perf_counter()
+            if attente > 0:
+                await asyncio.sleep(attente)
+            elif attente < -intervalle_s:
+                self.stats.retards += 1
+            tache = asyncio.create_task(action())
+            en_cours.add(tache)
+            tache.add_done_callback(en_cours.discard)
+            prochain += intervalle_s
+        if en_cours:
+            await asyncio.gather(*en_cours)
+
+    async def appareil(self, http: httpx.AsyncClient, appareil: Appareil):
+        options = self.options
+        lot: List[Dict] = []
+
+        async def envoyer():
+            lot.append(appareil.echantillon(self.maintenant_virtuel(), options.intervalle * options.acceleration))
+            if len(lot) < options.lot:
+                return
+            echantillons = lot[:]
+            lot.clear()
+            if options.lot == 1:
+                await self.requete(http, "POST", "/mesures/", json=echantillons[0])
             else:
-                print(f"[{datetime.now().isoformat()}] Error sending data: {response.status_code} - {response.text}")
-                
-        except requests.RequestException as e:
-            print(f"[{datetime.now().isoformat()}] Network error: {str(e)}")
-        
-        # Wait for the specified interval
-        time.sleep(INTERVAL_SECONDS)
+                await self.requete(http, "POST", "/mesures/lot/", json={"echantillons": echantillons})
+
+        async def interroger():
+            await self.requete(http, "GET", "/commandes/")
+
+        taches = [self.cadence(options.intervalle, envoyer)]
+        if options.poll_commandes > 0:
+            taches.append(self.cadence(options.poll_commandes, interroger))
+        await asyncio.gather(*taches)
+
+    async def lecteur(self, http: httpx.AsyncClient):
+        endpoints = ["/dashboard/", "/dashboard/", "/mesures/temps_reel/", "/mesures/dernieres/"]
+
+        async def lire():
+            await self.requete(http, "GET", random.choice(endpoints))
+
+        await self.cadence(self.options.intervalle_lecture, lire)
+
+    async def lancer(self) -> Dict:
+        options = self.options
+        tirage = random.Random(options.graine)
+        appareils = [
+            Appareil(i, random.Random(tirage.random()), 1 + i % options.sites if options.sites else None)
+            for i in range(options.appareils)
+        ]
+        limites = httpx.Limits(max_connections=options.connexions, max_keepalive_connections=options.connexions)
+        async with httpx.AsyncClient(base_url=options.url, limits=limites, timeout=options.timeout) as http:
+            self.debut_reel = time.perf_counter()
+            self.fin = self.debut_reel + options.duree
+            await asyncio.gather(
+                *(self.appareil(http, a) for a in appareils),
+                *(self.lecteur(http) for _ in range(options.lecteurs))
+            )
+        rapport = self.stats.rapport(time.perf_counter() - self.debut_reel)
+        rapport["parametres"] = {k: v for k, v in vars(options).items() if k != "json"}
+        return rapport
+
+
+def analyser_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+    parseur = argparse.ArgumentParser(description="Load generator (simulated devices)")
+    parseur.add_argument("--url", default=API_URL)
+    parseur.add_argument("--appareils", type=int, default=1000)
+    parseur.add_argument("--duree", type=float, default=60, help="test duration (s)")
+    parseur.add_argument("--intervalle", type=float, default=5, help="seconds between two measurements of a device")
+    parseur.add_argument("--lot", type=int, default=1, help="measurements per request (>1: /mesures/lot/)")
+    parseur.add_argument("--poll-commandes", type=float, default=10, help="seconds between two /commandes/ polls, 0: never")
+    parseur.add_argument("--lecteurs", type=int, default=20, help="dashboard readers")
+    parseur.add_argument("--intervalle-lecture", type=float, default=2)
+    parseur.add_argument("--sites", type=int, default=0, help="spread devices over N sites (site_id 1..N)")
+    parseur.add_argument("--acceleration", type=float, default=1, help="speed of the profile clock (86400 / duration: one day)")
+    parseur.add_argument("--connexions", type=int, default=500, help="HTTP connection pool size")
+    parseur.add_argument("--timeout", type=float, default=30)
+    parseur.add_argument("--graine", type=int, default=0)
+    parseur.add_argument("--json", help="write the JSON report to this file")
+    return parseur.parse_args(arguments)
+
+
+def afficher(rapport: Dict):
+    print(f"{rapport['requetes']} requests in {rapport['duree_s']} s: {rapport['requetes_par_s']} req/s, "
+          f"{rapport['erreurs']} errors, {rapport['ticks_en_retard']} late ticks")
+    print(f"{'endpoint':<24}{'req':>9}{'req/s':>9}{'err':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, s in rapport["endpoints"].items():
+        print(f"{endpoint:<24}{s['requetes']:>9}{s['requetes_par_s']:>9}{s['erreurs']:>7}"
+              f"{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}{s['max_ms']:>9}")
+
 
 if __name__ == "__main__":
-    print("Starting simulation of measurement data...")
-    send_measurements()
-    print("Simulation completed.")
\ No newline at end of file
+    options = analyser_arguments()
+    rapport = asyncio.run(Simulation(options).lancer())
+    afficher(rapport)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(rapport, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if rapport["requetes"] == 0 else 0)
@@ -1,12 +1,17 @@
 # solcast_manager.py
 import os
-import requests
-from datetime import datetime, timedelta, date
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta, date, timezone
+from typing import Dict, List, Optional, Tuple
 import json
+import time
+import threading
 from dataclasses import dataclass
+import numpy as np
 from fastapi import HTTPException
 from database import charger_cles_solcast
+from stockage_previsions import StockagePrevisions, appels_du_jour, identifiant_cle, ESPACE_QUOTA
+from client_solcast import fournisseur_par_defaut, FournisseurPrevisions, ErreurSolcast, CleIndisponible, FOURNISSEUR
+from metriques import SOLCAST_APPELS
 
 @dataclass
 class PrevisionSolcast:
@@ -22,29 +27,104 @@ class PrevisionSolcast:
     dhi: float
     dni: float
 
+@dataclass(frozen=True, slots=True)
+class SeriePrevisions:
+    """Prévisions en colonnes typées, analysées en une passe vectorisée"""
+    period_end: np.ndarray     # datetime64[s], UTC
+    pv_estimate: np.ndarray    # kWh par créneau de 30 min
+    pv_estimate10: np.ndarray
+    pv_estimate90: np.ndarray
+    cloud_opacity: np.ndarray
+    
+    @classmethod
+    def depuis_previsions(cls, previsions: List[Dict]) -> "SeriePrevisions":
+        """Un seul parcours des dicts JSON ; les horodatages "…Z" sont lus à la seconde"""
+        colonnes = np.array([
+            (p.get("pv_estimate", 0), p.get("pv_estimate10", 0), p.get("pv_estimate90", 0), p.get("cloud_opacity", 0))
+            for p in previsions
+        ], dtype=float).reshape(-1, 4)
+        return cls(
+            period_end=np.array([p["period_end"][:19] for p in previsions], dtype="datetime64[s]"),
+            pv_estimate=colonnes[:, 0],
+            pv_estimate10=colonnes[:, 1],
+            pv_estimate90=colonnes[:, 2],
+            cloud_opacity=colonnes[:, 3],
+        )
+
 class GestionnaireSolcast:
     """Gestionnaire intelligent pour l'API Solcast"""
     
-    def __init__(self):
+    def __init__(self, stockage: Optional[StockagePrevisions] = None, espace: str = "defaut",
+                 solcast_site_id: Optional[str] = None, fournisseur: Optional[FournisseurPrevisions] = None):
         self.api_keys_sites = charger_cles_solcast()
+        if not self.api_keys_sites and (fournisseur is not None or FOURNISSEUR == "local"):
+            # Offline provider: no .env key needed
+            self.api_keys_sites = [("local", solcast_site_id or "local")]
         if not self.api_keys_sites:
             raise ValueError("Aucune clé/site_id Solcast trouvée dans .env (SOLCAST_API_KEY1, SOLCAST_SITE_ID1, ...)")
-        self.limite_appels_quotidien = 10 * len(self.api_keys_sites)
-        self.appels_aujourd_hui = 0
-        self.derniere_mise_a_jour = None
-        self.cache_previsions = None
+        if solcast_site_id:
+            # Site of the fleet: its own keys if declared in .env, otherwise every key on that site
+            cles_site = [(cle, site) for cle, site in self.api_keys_sites if site == solcast_site_id]
+            self.api_keys_sites = cles_site or [(cle, solcast_site_id) for cle in dict.fromkeys(c for c, _ in self.api_keys_sites)]
+            espace = f"site:{solcast_site_id}"
+        self.solcast_site_id = solcast_site_id
+        self.fournisseur = fournisseur or fournisseur_par_defaut()
+        self.limite_appels_par_cle = 10
+        # The quota belongs to the API key, whichever site it is used for
+        self.cles = list(dict.fromkeys(cle for cle, _ in self.api_keys_sites))
+        self.limite_appels_quotidien = self.limite_appels_par_cle * len(self.cles)
         self.duree_validite_cache = 3600  # 1 heure
         self.api_key_index = 0
+        # Cache et compteurs partagés (fichier local) entre requêtes, workers et redémarrages
+        self.stockage = stockage or StockagePrevisions()
+        self.espace = espace
+        # Analysis of the last forecast version: cached reads do not recompute it
+        self._analyse: Tuple[Optional[str], Optional[Dict]] = (None, None)
+        self._verrou_analyse = threading.Lock()
+    
+    @property
+    def cache_previsions(self) -> Optional[List[Dict]]:
+        return self.stockage.lire(self.espace).get("previsions")
+    
+    @property
+    def derniere_mise_a_jour(self) -> Optional[datetime]:
+        valeur = self.stockage.lire(self.espace).get("derniere_mise_a_jour")
+        return datetime.fromisoformat(valeur) if valeur else None
+    
+    @property
+    def appels_par_cle(self) -> Dict[str, int]:
+        """Appels du jour de chacune de nos clés, tous sites confondus"""
+        appels = appels_du_jour(self.stockage.lire(ESPACE_QUOTA))
+        return {identifiant_cle(cle): appels.get(identifiant_cle(cle), 0) for cle in self.cles}
+    
+    @property
+    def appels_aujourd_hui(self) -> int:
+        return sum(self.appels_par_cle.values())
     
     def peut_appeler_api(self) -> bool:
         """Vérifie si on peut encore appeler l'API aujourd'hui"""
-        aujourd_hui = datetime.now().date()
-        
-        # Reset du compteur si nouveau jour
-        if self.derniere_mise_a_jour and self.derniere_mise_a_jour.date() != aujourd_hui:
-            self.appels_aujourd_hui = 0
-        
-        return self.appels_aujourd_hui < self.limite_appels_quotidien
+        # Les compteurs sont remis à zéro automatiquement à chaque nouveau jour
+        return any(n < self.limite_appels_par_cle for n in self.appels_par_cle.values())
+    
+    def _reserver_appel(self, api_key: str) -> bool:
+        """Compte un appel sur la clé avant de l'envoyer, si son quota du jour le permet"""
+        with self.stockage.modifier(ESPACE_QUOTA) as entree:
+            appels = appels_du_jour(entree)
+            cle = identifiant_cle(api_key)
+            if appels.get(cle, 0) >= self.limite_appels_par_cle:
+                return False
+            appels[cle] = appels.get(cle, 0) + 1
+            entree["appels"] = {"jour": datetime.now().date().isoformat(), "par_cle": appels}
+            return True
+    
+    def _annuler_appel(self, api_key: str):
+        """Rend l'appel réservé quand Solcast n'a pas répondu (les échecs ne sont pas décomptés)"""
+        with self.stockage.modifier(ESPACE_QUOTA) as entree:
+            appels = appels_du_jour(entree)
+            cle = identifiant_cle(api_key)
+            if appels.get(cle, 0) > 0:
+                appels[cle] -= 1
+            entree["appels"] = {"jour": datetime.now().date().isoformat(), "par_cle": appels}
     
     def get_previsions_demain(self) -> Dict:
         """
@@ -70,89 +150,128 @@ class GestionnaireSolcast:
                     detail="Limite API atteinte et pas de cache disponible"
                 )
         
-        # Call API for tomorrow
-        try:
-            previsions = self._appel_api_demain()
-            self._mettre_a_jour_cache(previsions)
-            self.appels_aujourd_hui += 1
-            
-            return {
-                "previsions": previsions,
-                "source": "api",
-                "appels_restants": self.limite_appels_quotidien - self.appels_aujourd_hui,
-                "analyse": self.analyser_previsions(previsions)
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erreur API Solcast: {str(e)}")
+        # Call API for tomorrow (one worker at a time, the others reuse its result)
+        with self.stockage.verrou_rafraichissement(self.espace):
+            if self.cache_valide():
+                return self.analyser_previsions_cachees()
+            try:
+                previsions = self.rafraichir_previsions()
+                
+                return {
+                    "previsions": previsions,
+                    "source": "api",
+                    "appels_restants": self.limite_appels_quotidien - self.appels_aujourd_hui,
+                    "analyse": self.analyse_memorisee(self.version_previsions(), previsions)
+                }
+                
+            except HTTPException:
+                raise  # 429 (quota) and 503 (Solcast unavailable) keep their status
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Erreur API Solcast: {str(e)}")
+    
+    def rafraichir_previsions(self) -> List[Dict]:
+        """Appelle l'API (l'appel est compté sur la clé utilisée) et met à jour le cache partagé"""
+        previsions = self._appel_api_demain()
+        self._mettre_a_jour_cache(previsions)
+        return previsions
+    
+    def version_previsions(self) -> Optional[str]:
+        """Identifiant du dernier instantané (change à chaque rafraîchissement)"""
+        return self.stockage.lire(self.espace).get("derniere_mise_a_jour")
+    
+    def lire_previsions(self) -> Dict:
+        """
+        Dernières prévisions connues, sans jamais appeler l'API.
+        Le rafraîchissement est assuré par la tâche de fond (planificateur_previsions).
+        """
+        if not self.cache_previsions:
+            raise HTTPException(status_code=503, detail="Prévisions Solcast pas encore disponibles")
+        resultat = self.analyser_previsions_cachees()
+        resultat["appels_restants"] = self.limite_appels_quotidien - self.appels_aujourd_hui
+        return resultat
     
     def _appel_api_demain(self) -> List[Dict]:
-        """Appel API pour les prévisions de demain avec rotation clé/site_id si quota ou 404"""
+        """Appel API pour les prévisions de demain avec rotation clé/site_id si quota, 404 ou panne"""
         demain = datetime.now().date() + timedelta(days=1)
+        # Start with the least used key today (counted across every site sharing it)
+        appels = self.appels_par_cle
+        self.api_key_index = min(
+            range(len(self.api_keys_sites)),
+            key=lambda i: appels[identifiant_cle(self.api_keys_sites[i][0])]
+        )
+        quota_atteint = True
+        derniere_erreur = None
         for i in range(len(self.api_keys_sites)):
             api_key, site_id = self.api_keys_sites[self.api_key_index]
-            url = f"https://api.solcast.com.au/rooftop_sites/{site_id}/forecasts"
-            params = {
-                "format": "json",
-                "api_key": api_key,
-                "start": f"{demain}T00:00:00Z",
-                "end": f"{demain}T23:59:59Z"
-            }
+            if not self._reserver_appel(api_key):
+                # Quota of this key already spent today, possibly by another site
+                self.api_key_index = (self.api_key_index + 1) % len(self.api_keys_sites)
+                continue
+            debut_appel = time.perf_counter()
+            resultat = "erreur"
             try:
-                response = requests.get(url, params=params)
-                if response.status_code in (429, 404):
-                    # Quota reached or site not found, try next key
-                    self.api_key_index = (self.api_key_index + 1) % len(self.api_keys_sites)
-                    continue
-                response.raise_for_status()
-                data = response.json()
-                return data.get("forecasts", [])
-            except requests.HTTPError as e:
-                if response.status_code in (429, 404):
-                    self.api_key_index = (self.api_key_index + 1) % len(self.api_keys_sites)
-                    continue
-                else:
-                    raise
-        raise HTTPException(status_code=429, detail="Toutes les clés API Solcast ont atteint leur quota journalier ou aucun site_id valide.")
+                # HTTP client: bounded by timeouts, retries and the per-key circuit breaker
+                previsions = self.fournisseur.previsions(api_key, site_id, f"{demain}T00:00:00Z", f"{demain}T23:59:59Z")
+                resultat = "ok"
+                return previsions
+            except CleIndisponible:
+                resultat = "indisponible"  # Quota reached or site not found
+            except ErreurSolcast as e:
+                quota_atteint = False
+                derniere_erreur = e
+            finally:
+                SOLCAST_APPELS.observe(time.perf_counter() - debut_appel,
+                                       fournisseur=type(self.fournisseur).__name__, resultat=resultat)
+                if resultat != "ok":
+                    self._annuler_appel(api_key)
+            self.api_key_index = (self.api_key_index + 1) % len(self.api_keys_sites)
+        if quota_atteint:
+            raise HTTPException(status_code=429, detail="Toutes les clés API Solcast ont atteint leur quota journalier ou aucun site_id valide.")
+        raise HTTPException(status_code=503, detail=f"API Solcast indisponible: {derniere_erreur}")
     
     def cache_valide(self) -> bool:
         """Vérifie si le cache est encore valide"""
-        if not self.cache_previsions or not self.derniere_mise_a_jour:
+        entree = self.stockage.lire(self.espace)
+        if not entree.get("previsions") or not entree.get("derniere_mise_a_jour"):
             return False
         
-        age_cache = (datetime.now() - self.derniere_mise_a_jour).seconds
+        age_cache = (datetime.now() - datetime.fromisoformat(entree["derniere_mise_a_jour"])).total_seconds()
         return age_cache < self.duree_validite_cache
     
     def _mettre_a_jour_cache(self, previsions: List[Dict]):
-        """Met à jour le cache avec les nouvelles prévisions"""
-        self.cache_previsions = previsions
-        self.derniere_mise_a_jour = datetime.now()
+        """Met à jour le cache partagé (l'appel est déjà compté sur sa clé)"""
+        with self.stockage.modifier(self.espace) as entree:
+            entree["previsions"] = previsions
+            entree["derniere_mise_a_jour"] = datetime.now().isoformat()
     
     def analyser_previsions(self, previsions: List[Dict]) -> Dict:
         """Analyse approfondie des prévisions Solcast"""
         if not previsions or len(previsions) == 0:
             raise HTTPException(status_code=500, detail=f"Prévisions IA invalides ou vides. Réponse brute: {previsions}")
         
+        serie = SeriePrevisions.depuis_previsions(previsions)
+        productions = serie.pv_estimate
+        nb = len(productions)
+        
         # Calculate key metrics
-        production_totale = sum(p.get("pv_estimate", 0) for p in previsions)
-        production_max = max(p.get("pv_estimate", 0) for p in previsions)
-        production_min = min(p.get("pv_estimate", 0) for p in previsions)
+        production_totale = float(productions.sum())
+        production_max = float(productions.max())
+        production_min = float(productions.min())
         
-        # Analyze by periods
-        heures_pointe = [p for p in previsions if p.get("pv_estimate", 0) > 2.0]  # > 2 kWh/30min
-        heures_faible = [p for p in previsions if p.get("pv_estimate", 0) < 0.5]  # < 0.5 kWh/30min
-        heures_normales = [p for p in previsions if 0.5 <= p.get("pv_estimate", 0) <= 2.0]
+        # Analyze by periods: > 2 kWh/30min, < 0.5 kWh/30min, in between
+        heures_pointe = int(np.count_nonzero(productions > 2.0))
+        heures_faible = int(np.count_nonzero(productions < 0.5))
+        heures_normales = nb - heures_pointe - heures_faible
         
         # Calculate variability
-        productions = [p.get("pv_estimate", 0) for p in previsions]
-        variabilite = (max(productions) - min(productions)) / max(productions) if max(productions) > 0 else 0
+        variabilite = (production_max - production_min) / production_max if production_max > 0 else 0
         
         # Analyze clouds
-        opacite_moyenne = sum(p.get("cloud_opacity", 0) for p in previsions) / len(previsions)
+        opacite_moyenne = float(serie.cloud_opacity.mean())
         
         # Identify critical periods
-        periode_debut = datetime.fromisoformat(previsions[0]["period_end"].replace("Z", "+00:00"))
-        periode_fin = datetime.fromisoformat(previsions[-1]["period_end"].replace("Z", "+00:00"))
+        periode_debut = serie.period_end[0].item().replace(tzinfo=timezone.utc)
+        periode_fin = serie.period_end[-1].item().replace(tzinfo=timezone.utc)
         
         return {
             "periode": {
@@ -162,24 +281,33 @@ class GestionnaireSolcast:
             },
             "production": {
                 "totale_kwh": production_totale,
-                "moyenne_kwh_par_30min": production_totale / len(previsions),
+                "moyenne_kwh_par_30min": production_totale / nb,
                 "max_kwh_par_30min": production_max,
                 "min_kwh_par_30min": production_min,
                 "variabilite": variabilite
             },
             "repartition": {
-                "heures_pointe": len(heures_pointe),
-                "heures_normales": len(heures_normales),
-                "heures_faible": len(heures_faible)
+                "heures_pointe": heures_pointe,
+                "heures_normales": heures_normales,
+                "heures_faible": heures_faible
             },
             "meteo": {
                 "opacite_nuages_moyenne": opacite_moyenne,
                 "qualite_ensoleillement": "excellent" if opacite_moyenne < 0.3 else "bon" if opacite_moyenne < 0.6 else "mauvais"
             },
-            "risque": self._calculer_niveau_risque(production_totale, variabilite, len(heures_faible)),
+            "risque": self._calculer_niveau_risque(production_totale, variabilite, heures_faible),
             "recommandations": self._generer_recommandations(production_totale, variabilite, heures_faible)
         }
     
+    def analyse_memorisee(self, version: Optional[str], previsions: List[Dict]) -> Dict:
+        """Analyse calculée une fois par version de prévisions (O(1) ensuite)"""
+        with self._verrou_analyse:
+            version_analysee, analyse = self._analyse
+            if analyse is None or version is None or version != version_analysee:
+                analyse = self.analyser_previsions(previsions)
+                self._analyse = (version, analyse)
+            return analyse
+    
     def _calculer_niveau_risque(self, production_totale: float, variabilite: float, heures_faible: int) -> str:
         """Calcule le niveau de risque selon les prévisions"""
         if production_totale < 10:  # Very low production
@@ -191,7 +319,7 @@ class GestionnaireSolcast:
         else:
             return "FAIBLE"
     
-    def _generer_recommandations(self, production_totale: float, variabilite: float, heures_faible: List) -> List[str]:
+    def _generer_recommandations(self, production_totale: float, variabilite: float, heures_faible: int) -> List[str]:
         """Génère des recommandations basées sur l'analyse"""
         recommandations = []
         
@@ -199,8 +327,8 @@ class GestionnaireSolcast:
             recommandations.append("Charger la batterie à 100% aujourd'hui")
             recommandations.append("Préparer le basculement sur réseau")
         
-        if len(heures_faible) > 8:
-            recommandations.append(f"Prévoir {len(heures_faible)}h de faible production")
+        if heures_faible > 8:
+            recommandations.append(f"Prévoir {heures_faible}h de faible production")
             recommandations.append("Optimiser la charge de la batterie")
         
         if variabilite > 0.8:
@@ -213,22 +341,49 @@ class GestionnaireSolcast:
     
     def analyser_previsions_cachees(self) -> Dict:
         """Analyse les prévisions du cache"""
-        if not self.cache_previsions:
+        entree = self.stockage.lire(self.espace)
+        if not entree.get("previsions"):
             return {"erreur": "Pas de cache disponible"}
         
+        derniere_mise_a_jour = datetime.fromisoformat(entree["derniere_mise_a_jour"])
         return {
-            "previsions": self.cache_previsions,
+            "previsions": entree["previsions"],
             "source": "cache",
-            "age_cache_minutes": int((datetime.now() - self.derniere_mise_a_jour).seconds / 60),
-            "analyse": self.analyser_previsions(self.cache_previsions)
+            "age_cache_minutes": int((datetime.now() - derniere_mise_a_jour).total_seconds() / 60),
+            "analyse": self.analyse_memorisee(entree["derniere_mise_a_jour"], entree["previsions"])
         }
     
     def get_statistiques_utilisation(self) -> Dict:
         """Retourne les statistiques d'utilisation de l'API"""
+        entree = self.stockage.lire(self.espace)
+        appels_par_cle = self.appels_par_cle
+        appels_aujourd_hui = sum(appels_par_cle.values())
         return {
-            "appels_aujourd_hui": self.appels_aujourd_hui,
+            "appels_aujourd_hui": appels_aujourd_hui,
+            "appels_par_cle": appels_par_cle,
             "limite_quotidien": self.limite_appels_quotidien,
-            "appels_restants": self.limite_appels_quotidien - self.appels_aujourd_hui,
-            "derniere_mise_a_jour": self.derniere_mise_a_jour.isoformat() if self.derniere_mise_a_jour else None,
-            "cache_valide": self.cache_valide()
-        }
\ No newline at end of file
+            "appels_restants": self.limite_appels_quotidien - appels_aujourd_hui,
+            "derniere_mise_a_jour": entree.get("derniere_mise_a_jour"),
+            "cache_valide": self.cache_valide(),
+            "fournisseur": type(self.fournisseur).__name__,
+            "client_http": {
+                cle: stats for cle, stats in self.fournisseur.statistiques().items()
+                if cle.split("/")[0] in {site for _, site in self.api_keys_sites}
+            }
+        }
+
+
+_gestionnaires: Dict[Optional[str], GestionnaireSolcast] = {}
+_verrou_gestionnaires = threading.Lock()  # fleet sites are refreshed from several threads
+
+def get_gestionnaire_solcast(solcast_site_id: Optional[str] = None) -> GestionnaireSolcast:
+    """
+    Gestionnaire Solcast unique par processus et par site (le cache est partagé via le fichier).
+    Sans solcast_site_id : installation historique, rotation sur toutes les clés du .env.
+    """
+    with _verrou_gestionnaires:
+        if solcast_site_id not in _gestionnaires:
+            # One storage object for every site: the file is parsed once per change, not once per site
+            stockage = next(iter(_gestionnaires.values())).stockage if _gestionnaires else None
+            _gestionnaires[solcast_site_id] = GestionnaireSolcast(stockage, solcast_site_id=solcast_site_id)
+        return _gestionnaires[solcast_site_id]
\ No newline at end of file
@@ -0,0 +1,111 @@
+# stockage_previsions.py
+# Stockage partagé des prévisions Solcast entre requêtes, workers et redémarrages
+
+import os
+import re
+import json
+import hashlib
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+CHEMIN_PAR_DEFAUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_solcast.json")
+# Solcast counts its quota per API key: one namespace shared by every site that uses the key
+ESPACE_QUOTA = "quota_cles"
+
+
+class StockagePrevisions:
+    """
+    Cache des prévisions persisté dans un fichier JSON local.
+    Les accès sont sérialisés par un verrou fcntl, ce qui garantit le même
+    contenu (prévisions et compteurs d'appels par clé) pour tous les workers uvicorn.
+    """
+
+    def __init__(self, chemin: Optional[str] = None):
+        self.chemin = chemin or os.getenv("SOLCAST_CACHE_FICHIER", CHEMIN_PAR_DEFAUT)
+        self.chemin_verrou = self.chemin + ".lock"
+        self.chemin_verrou_rafraichissement = self.chemin + ".refresh.lock"
+        self._signature = None  # (mtime_ns, taille) du fichier déjà chargé
+        self._donnees = {}
+
+    @contextmanager
+    def _verrou(self, chemin: str, exclusif: bool):
+        with open(chemin, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusif else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _charger(self) -> Dict:
+        """Relit le fichier uniquement s'il a changé depuis la dernière lecture"""
+        try:
+            stat = os.stat(self.chemin)
+        except FileNotFoundError:
+            self._signature = None
+            self._donnees = {}
+            return self._donnees
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            try:
+                with open(self.chemin, "r", encoding="utf-8") as f:
+                    self._donnees = json.load(f)
+            except (ValueError, OSError):
+                # Fichier corrompu : on repart d'un cache vide
+                self._donnees = {}
+            self._signature = signature
+        return self._donnees
+
+    def _ecrire(self, donnees: Dict):
+        """Écriture atomique (fichier temporaire + rename)"""
+        dossier = os.path.dirname(os.path.abspath(self.chemin))
+        fd, chemin_tmp = tempfile.mkstemp(dir=dossier, prefix=".cache_solcast_")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(donnees, f)
+            os.replace(chemin_tmp, self.chemin)
+        except Exception:
+            if os.path.exists(chemin_tmp):
+                os.remove(chemin_tmp)
+            raise
+
+    def lire(self, espace: str = "defaut") -> Dict:
+        """Retourne l'entrée d'un espace (prévisions, date de mise à jour, appels)"""
+        with self._verrou(self.chemin_verrou, exclusif=False):
+            return dict(self._charger().get(espace, {}))
+
+    @contextmanager
+    def modifier(self, espace: str = "defaut"):
+        """Lecture-modification-écriture atomique d'un espace"""
+        with self._verrou(self.chemin_verrou, exclusif=True):
+            donnees = dict(self._charger())
+            entree = dict(donnees.get(espace, {}))
+            yield entree
+            donnees[espace] = entree
+            self._ecrire(donnees)
+            self._signature = None
+
+    @contextmanager
+    def verrou_rafraichissement(self, espace: str = "defaut"):
+        """Un seul worker à la fois interroge l'API Solcast pour un espace (les sites se rafraîchissent en parallèle)"""
+        chemin = self.chemin_verrou_rafraichissement
+        if espace != "defaut":
+            chemin = f"{self.chemin}.refresh.{re.sub(r'[^A-Za-z0-9_-]', '_', espace)}.lock"
+        with self._verrou(chemin, exclusif=True):
+            yield
+
+
+def identifiant_cle(cle: str) -> str:
+    """Identifiant stable d'une clé API, sans écrire la clé elle-même dans le cache"""
+    return hashlib.sha256(cle.encode("utf-8")).hexdigest()[:12]
+
+
+def appels_du_jour(entree: Dict) -> Dict[str, int]:
+    """Compteurs d'appels par clé API (identifiant_cle), remis à zéro à chaque nouveau jour"""
+    appels = entree.get("appels", {})
+    if appels.get("jour") != datetime.now().date().isoformat():
+        return {}
+    return dict(appels.get("par_cle", {}))
@@ -0,0 +1,27 @@
+# Fixtures communes : base SQLite en mémoire (aucun PostgreSQL requis)
+
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Base  # noqa: E402
+
+
+@pytest.fixture
+def moteur():
+    """Une base par test, partagée entre threads (tampon d'ingestion)"""
+    moteur = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(moteur)
+    yield moteur
+    moteur.dispose()
+
+
+@pytest.fixture
+def Session(moteur):
+    return sessionmaker(bind=moteur, autoflush=False)
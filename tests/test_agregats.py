@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select, delete
+
+import agregats
+from agregats import debut_creneau, mettre_a_jour, combiner_statistiques, SITE_HISTORIQUE
+from models import AgregatProduction, AgregatBatterie, AgregatConsommation, AgregatDernierPoint
+
+DEBUT = datetime(2024, 6, 1, 10, 0, 0)
+
+
+def production(valeurs, pas_s: int = 60, debut: datetime = DEBUT, site_id=None) -> dict:
+    return {"production": [{"timestamp": debut + timedelta(seconds=pas_s * i), "production": v, "site_id": site_id}
+                           for i, v in enumerate(valeurs)]}
+
+
+def creneaux(db, modele, pas: int) -> list:
+    return db.execute(select(modele).where(modele.pas == pas).order_by(modele.site_id, modele.debut)).scalars().all()
+
+
+def test_debut_creneau():
+    instant = datetime(2024, 6, 1, 10, 47, 31, 500)
+    assert debut_creneau(instant, 60) == datetime(2024, 6, 1, 10, 47)
+    assert debut_creneau(instant, 900) == datetime(2024, 6, 1, 10, 45)
+    assert debut_creneau(instant, 3600) == datetime(2024, 6, 1, 10, 0)
+
+
+def test_statistiques_par_creneau(Session):
+    with Session() as db:
+        mettre_a_jour(db, production([100.0, 300.0, 200.0], pas_s=20))
+        db.commit()
+        minute, = creneaux(db, AgregatProduction, 60)
+        assert (minute.debut, minute.nombre, minute.somme, minute.minimum, minute.maximum) == (DEBUT, 3, 600, 100, 300)
+        assert len(creneaux(db, AgregatProduction, 900)) == len(creneaux(db, AgregatProduction, 3600)) == 1
+
+
+def test_energie_integree_avec_la_puissance_precedente(Session):
+    with Session() as db:
+        mettre_a_jour(db, production([3600.0] * 10))  # 9 intervalles de 60 s à 3600 W
+        db.commit()
+        heure, = creneaux(db, AgregatProduction, 3600)
+        assert heure.energie_wh == pytest.approx(9 * 60)
+        minutes = creneaux(db, AgregatProduction, 60)
+        assert minutes[0].energie_wh == 0  # premier point : pas d'intervalle à intégrer
+        assert all(m.energie_wh == pytest.approx(60) for m in minutes[1:])
+
+
+def test_lots_successifs_equivalents_a_un_seul_lot(Session):
+    valeurs = [1000.0, 2000.0, 1500.0, 500.0, 2500.0, 3000.0]
+    with Session() as db:
+        mettre_a_jour(db, production(valeurs))
+        db.commit()
+        attendu = [(c.debut, c.nombre, c.somme, c.minimum, c.maximum, round(c.energie_wh, 6))
+                   for c in creneaux(db, AgregatProduction, 900)]
+        for modele in (AgregatProduction, AgregatDernierPoint):
+            db.execute(delete(modele))
+        db.commit()
+    with Session() as db:
+        for i in range(len(valeurs)):
+            # One sample per batch: the upsert merges buckets, the last point links the intervals
+            mettre_a_jour(db, production(valeurs[i:i + 1], debut=DEBUT + timedelta(seconds=60 * i)))
+            db.commit()
+        obtenu = [(c.debut, c.nombre, c.somme, c.minimum, c.maximum, round(c.energie_wh, 6))
+                  for c in creneaux(db, AgregatProduction, 900)]
+    assert obtenu == attendu
+
+
+def test_pas_d_energie_au_dela_de_l_ecart_max(Session):
+    ecart = agregats.ECART_MAX_S + 60
+    with Session() as db:
+        mettre_a_jour(db, production([1000.0, 1000.0], pas_s=ecart))
+        db.commit()
+        assert sum(c.energie_wh for c in creneaux(db, AgregatProduction, 3600)) == 0
+
+
+def test_echantillon_en_retard_ne_recule_pas_le_dernier_point(Session):
+    with Session() as db:
+        mettre_a_jour(db, production([1000.0, 2000.0]))
+        mettre_a_jour(db, production([5000.0], debut=DEBUT - timedelta(minutes=5)))
+        db.commit()
+        dernier = db.get(AgregatDernierPoint, (SITE_HISTORIQUE, "production"))
+        assert (dernier.timestamp, dernier.valeur) == (DEBUT + timedelta(seconds=60), 2000.0)
+
+
+def test_batterie_et_consommation_par_charge(Session):
+    lignes = {
+        "batterie": [{"timestamp": DEBUT + timedelta(seconds=60 * i), "soc": 50.0 + i, "tension": 50.0,
+                      "courant": 2.0, "site_id": None} for i in range(3)],
+        "consommation": [{"timestamp": DEBUT + timedelta(seconds=60 * i), "id_charge": charge, "consommation": 100.0,
+                          "site_id": None} for i in range(3) for charge in (1, 2)],
+    }
+    with Session() as db:
+        mettre_a_jour(db, lignes)
+        db.commit()
+        heure, = creneaux(db, AgregatBatterie, 3600)
+        assert (heure.somme, heure.minimum, heure.maximum) == (153.0, 50.0, 52.0)
+        assert heure.energie_wh == pytest.approx(2 * 100 * 60 / 3600)  # tension x courant = 100 W
+        par_charge = db.execute(select(AgregatConsommation).where(AgregatConsommation.pas == 3600)
+                                .order_by(AgregatConsommation.id_charge)).scalars().all()
+        assert [(c.id_charge, c.nombre) for c in par_charge] == [(1, 3), (2, 3)]
+
+
+def test_combiner_statistiques():
+    resultat = combiner_statistiques([(2, 10.0, 4.0, 6.0, 1.0), None, (0, 0, 0, 0, 0), (3, 30.0, 2.0, 15.0, None)])
+    assert resultat == {"nombre": 5, "moyenne": 8.0, "minimum": 2.0, "maximum": 15.0, "energie_wh": 1.0}
+    assert combiner_statistiques([])["moyenne"] == 0
+
+
+def test_nouvelle_serie_inseree_par_un_autre_worker(Session, monkeypatch):
+    """Les deux workers voient une série nouvelle : le second n'insère pas, il reprend la ligne du premier"""
+    with Session() as db:
+        mettre_a_jour(db, production([3600.0]))
+        db.commit()
+
+    verrouiller = agregats._verrouiller_derniers_points
+    appels = []
+
+    def lecture_avant_l_insertion_concurrente(db, cles):
+        appels.append(cles)
+        return {} if len(appels) == 1 else verrouiller(db, cles)
+    monkeypatch.setattr(agregats, "_verrouiller_derniers_points", lecture_avant_l_insertion_concurrente)
+    with Session() as db:
+        mettre_a_jour(db, production([3600.0], debut=DEBUT + timedelta(seconds=60)))
+        db.commit()
+        assert len(appels) == 2
+        dernier, = db.execute(select(AgregatDernierPoint)).scalars().all()
+        assert dernier.timestamp == DEBUT + timedelta(seconds=60)
+        heure, = creneaux(db, AgregatProduction, 3600)
+        assert heure.energie_wh == pytest.approx(60)  # the first worker's point was kept
+
+
+def test_dialecte_non_supporte_refuse_au_demarrage(monkeypatch):
+    moteur = SimpleNamespace(dialect=SimpleNamespace(name="mssql"))
+    monkeypatch.setattr(agregats, "AGREGATS_ACTIFS", True)
+    with pytest.raises(ValueError, match="AGREGATS_ACTIFS=0"):
+        agregats.verifier_dialecte(moteur)
+    monkeypatch.setattr(agregats, "AGREGATS_ACTIFS", False)
+    agregats.verifier_dialecte(moteur)
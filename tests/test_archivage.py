@@ -0,0 +1,128 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+pytest.importorskip("pyarrow")
+
+import archivage
+import export
+import partitionnement
+from models import Production
+from requetes import requete_serie, EPOCH
+
+JOUR = date(2024, 6, 1)
+DEBUT = datetime(2024, 6, 1, 10, 0)
+
+
+@pytest.fixture
+def archives(Session, tmp_path, monkeypatch):
+    """Archivage vers un répertoire temporaire, sur la base SQLite du test"""
+    monkeypatch.setattr(archivage, "ARCHIVE_REPERTOIRE", str(tmp_path))
+    monkeypatch.setattr(archivage, "SessionLocal", Session)
+    monkeypatch.setattr(export, "SessionLocal", Session)
+    monkeypatch.setattr(export, "TAILLE_PAGE", 7)  # several pages per day
+    return tmp_path
+
+
+def ajouter(Session, instants, valeur: float = 100.0):
+    with Session() as db:
+        db.add_all(Production(timestamp=t, production=valeur + i) for i, t in enumerate(instants))
+        db.commit()
+
+
+def productions(Session) -> list:
+    with Session() as db:
+        return db.execute(select(Production.timestamp).order_by(Production.timestamp)).scalars().all()
+
+
+def test_archiver_jour_ecrit_puis_supprime_le_jour(Session, archives):
+    du_jour = [DEBUT + timedelta(minutes=i) for i in range(20)]
+    lendemain = [DEBUT + timedelta(days=1)]
+    ajouter(Session, du_jour + lendemain)
+
+    assert archivage.archiver_jour("production", JOUR) == 20
+    assert productions(Session) == lendemain
+    assert archivage.dates_archivees("production") == [JOUR]
+    assert archivage.couvre("production", DEBUT, DEBUT + timedelta(hours=1))
+    assert not archivage.couvre("production", DEBUT + timedelta(days=3), DEBUT + timedelta(days=4))
+
+
+def test_archiver_jour_complete_une_partition_existante(Session, archives):
+    ajouter(Session, [DEBUT + timedelta(minutes=i) for i in range(5)])
+    archivage.archiver_jour("production", JOUR)
+    with Session() as db:
+        # Late sample for the same day; explicit id as a PostgreSQL sequence would give (SQLite reuses rowids)
+        db.add(Production(id=100, timestamp=DEBUT + timedelta(hours=5), production=1.0))
+        db.commit()
+    assert archivage.archiver_jour("production", JOUR) == 1
+    donnees = archivage._jeu("production").to_table(filter=archivage._filtre(DEBUT, DEBUT + timedelta(days=1), None))
+    assert donnees.num_rows == 6
+    assert len(set(donnees["id"].to_pylist())) == 6
+
+
+def test_serie_archivee_identique_a_la_serie_en_base(Session, archives):
+    ajouter(Session, [DEBUT + timedelta(seconds=5 * i) for i in range(240)])
+    fin = DEBUT + timedelta(minutes=20)
+    with Session() as db:
+        en_base = [tuple(l) for l in db.execute(requete_serie("production", DEBUT, fin, 30))]
+    archivage.archiver_jour("production", JOUR)
+    archivee = archivage.serie_archivee("production", "production", DEBUT, fin, 30)
+    assert [(int(c), n, s, mi, ma) for c, n, s, mi, ma in archivee] == en_base
+    assert archivage.serie_archivee("production", "production", DEBUT, fin, 30, site_id=3) == []
+
+
+def test_dernieres_archivees(Session, archives):
+    instants = [DEBUT + timedelta(minutes=i) for i in range(10)]
+    ajouter(Session, instants)
+    archivage.archiver_jour("production", JOUR)
+    dernieres = archivage.dernieres_archivees("production", DEBUT, DEBUT + timedelta(days=1), 3)
+    assert [p.timestamp for p in dernieres] == instants[:-4:-1]
+
+
+def test_partition_conservee_si_des_lignes_arrivent_pendant_l_archivage(Session, archives, monkeypatch):
+    ajouter(Session, [DEBUT + timedelta(minutes=i) for i in range(10)])
+    demandes = []
+
+    def supprimer_partition(moteur, table, jour, attendu=None):
+        # A sample lands in the day's partition after the Parquet file was written
+        demandes.append((table, jour, attendu))
+        ajouter(Session, [DEBUT + timedelta(hours=3)], valeur=999.0)
+        return False  # partition changed: no DROP
+
+    monkeypatch.setattr(partitionnement, "PARTITIONNEMENT", "jour")
+    monkeypatch.setattr(partitionnement, "est_partitionnee", lambda moteur, table: True)
+    monkeypatch.setattr(partitionnement, "supprimer_partition", supprimer_partition)
+
+    assert archivage.archiver_jour("production", JOUR) == 10
+    assert demandes == [("production", JOUR, (10, 10))]  # (rows read, max archived id)
+    # The guarded DELETE removed the archived rows only
+    with Session() as db:
+        assert db.execute(select(Production.production)).scalars().all() == [999.0]
+
+
+def test_suppression_annulee_si_un_id_inferieur_est_valide_apres_la_lecture(Session, archives, monkeypatch):
+    """Un id tiré avant la lecture mais validé après : rien n'est supprimé, le passage suivant l'archive"""
+    with Session() as db:
+        db.add_all(Production(id=i, timestamp=DEBUT + timedelta(minutes=i), production=1.0)
+                   for i in range(1, 11) if i != 3)
+        db.commit()
+
+    def supprimer_partition(moteur, table, jour, attendu=None):
+        # The transaction holding id 3 commits once the Parquet file is written
+        with Session() as db:
+            db.add(Production(id=3, timestamp=DEBUT + timedelta(minutes=3), production=3.0))
+            db.commit()
+        return False
+
+    monkeypatch.setattr(partitionnement, "PARTITIONNEMENT", "jour")
+    monkeypatch.setattr(partitionnement, "est_partitionnee", lambda moteur, table: True)
+    monkeypatch.setattr(partitionnement, "supprimer_partition", supprimer_partition)
+    assert archivage.archiver_jour("production", JOUR) == 9
+    assert len(productions(Session)) == 10  # the DELETE matched 10 rows for 9 read: rolled back
+
+    monkeypatch.setattr(partitionnement, "PARTITIONNEMENT", "")
+    assert archivage.archiver_jour("production", JOUR) == 1
+    assert productions(Session) == []
+    donnees = archivage._jeu("production").to_table()
+    assert sorted(donnees["id"].to_pylist()) == list(range(1, 11))
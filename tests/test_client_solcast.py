@@ -0,0 +1,152 @@
+import pytest
+import requests
+
+import client_solcast
+from client_solcast import ClientSolcast, ErreurSolcast, CleIndisponible, DisjoncteurOuvert
+
+CLE = "cle-secrete-1234"
+LIBELLE = "site-a/…1234"
+
+
+class Reponse:
+    def __init__(self, status_code, forecasts=None):
+        self.status_code = status_code
+        self._forecasts = forecasts or []
+
+    def json(self):
+        return {"forecasts": self._forecasts}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}")
+
+
+class SessionFactice:
+    """Rejoue une suite de réponses ou d'exceptions, une par appel"""
+
+    def __init__(self, suite):
+        self.suite = list(suite)
+        self.appels = []
+
+    def get(self, url, params=None, timeout=None):
+        self.appels.append((url, params, timeout))
+        suivant = self.suite.pop(0)
+        if isinstance(suivant, Exception):
+            raise suivant
+        return suivant
+
+
+@pytest.fixture(autouse=True)
+def sans_attente(monkeypatch):
+    monkeypatch.setattr(client_solcast.time, "sleep", lambda s: None)
+    monkeypatch.setattr(client_solcast, "DISJONCTEUR_SEUIL", 5)
+    monkeypatch.setattr(client_solcast, "DISJONCTEUR_PAUSE_S", 300.0)
+
+
+def client_avec(suite, tentatives=3):
+    client = ClientSolcast(url_api="https://solcast.test/", tentatives=tentatives, attente_base_s=0.0)
+    client.session = SessionFactice(suite)
+    return client
+
+
+def test_succes_renvoie_les_previsions_et_les_parametres():
+    client = client_avec([Reponse(200, [{"pv_estimate": 1.2}])])
+    assert client.previsions(CLE, "site-a", "debut", "fin") == [{"pv_estimate": 1.2}]
+    url, params, timeout = client.session.appels[0]
+    assert url == "https://solcast.test/rooftop_sites/site-a/forecasts"
+    assert params == {"format": "json", "api_key": CLE, "start": "debut", "end": "fin"}
+    assert timeout == client.timeout
+
+
+def test_reessaie_sur_5xx_et_timeout_puis_reussit():
+    client = client_avec([Reponse(503), requests.Timeout("lent"), Reponse(200, [{"pv_estimate": 0.5}])])
+    assert client.previsions(CLE, "site-a", "d", "f") == [{"pv_estimate": 0.5}]
+    stats = client.statistiques()[LIBELLE]
+    assert stats["appels"] == 3
+    assert stats["erreurs"] == 2
+    assert stats["timeouts"] == 1
+    assert stats["disjoncteur"] == "ferme"
+    assert client._cles[LIBELLE].echecs_consecutifs == 0
+
+
+def test_echec_apres_toutes_les_tentatives():
+    client = client_avec([Reponse(500), requests.ConnectionError("coupé"), Reponse(502)])
+    with pytest.raises(ErreurSolcast, match="après 3 tentative"):
+        client.previsions(CLE, "site-a", "d", "f")
+    assert len(client.session.appels) == 3
+    assert client.statistiques()[LIBELLE]["derniere_erreur"] == "HTTP 502"
+
+
+@pytest.mark.parametrize("code", [429, 404])
+def test_quota_ou_site_inconnu_sans_nouvelle_tentative(code):
+    client = client_avec([Reponse(code)])
+    with pytest.raises(CleIndisponible):
+        client.previsions(CLE, "site-a", "d", "f")
+    assert len(client.session.appels) == 1
+    stats = client.statistiques()[LIBELLE]
+    assert stats["quota_ou_introuvable"] == 1
+    assert stats["erreurs"] == 0
+
+
+def test_erreur_4xx_non_reessayee():
+    client = client_avec([Reponse(401)])
+    with pytest.raises(ErreurSolcast) as exc:
+        client.previsions(CLE, "site-a", "d", "f")
+    assert not isinstance(exc.value, CleIndisponible)
+    assert len(client.session.appels) == 1
+
+
+def test_disjoncteur_s_ouvre_et_reste_ouvert_pendant_la_pause(monkeypatch):
+    horloge = [1000.0]
+    monkeypatch.setattr(client_solcast.time, "monotonic", lambda: horloge[0])
+    client = client_avec([Reponse(503)] * 3 + [Reponse(503)] * 3 + [Reponse(200, [])])
+
+    with pytest.raises(ErreurSolcast):
+        client.previsions(CLE, "site-a", "d", "f")
+    # The fifth consecutive failure opens the breaker and stops the retries early
+    with pytest.raises(ErreurSolcast, match="après 2 tentative"):
+        client.previsions(CLE, "site-a", "d", "f")
+    assert len(client.session.appels) == 5
+    assert client.statistiques()[LIBELLE]["disjoncteur"] == "ouvert"
+
+    horloge[0] += 299.0
+    with pytest.raises(DisjoncteurOuvert):
+        client.previsions(CLE, "site-a", "d", "f")
+    assert len(client.session.appels) == 5
+
+    horloge[0] += 2.0
+    assert client.statistiques()[LIBELLE]["disjoncteur"] == "ferme"
+    client.session.suite = [Reponse(200, [{"pv_estimate": 1.0}])]
+    assert client.previsions(CLE, "site-a", "d", "f") == [{"pv_estimate": 1.0}]
+
+
+def test_disjoncteur_par_cle():
+    client = client_avec([Reponse(503)] * 5 + [Reponse(200, [])])
+    for _ in range(2):
+        with pytest.raises(ErreurSolcast):
+            client.previsions(CLE, "site-a", "d", "f")
+    assert client.previsions("autre-cle-9999", "site-a", "d", "f") == []
+    stats = client.statistiques()
+    assert stats[LIBELLE]["disjoncteur"] == "ouvert"
+    assert stats["site-a/…9999"]["disjoncteur"] == "ferme"
+
+
+def test_reponses_429_ne_comptent_pas_comme_echecs():
+    client = client_avec([Reponse(503)] * 3 + [Reponse(429)] + [Reponse(503)] * 3)
+    with pytest.raises(ErreurSolcast):
+        client.previsions(CLE, "site-a", "d", "f")
+    with pytest.raises(CleIndisponible):
+        client.previsions(CLE, "site-a", "d", "f")
+    with pytest.raises(ErreurSolcast, match="après 3 tentative"):
+        client.previsions(CLE, "site-a", "d", "f")
+    assert client.statistiques()[LIBELLE]["disjoncteur"] == "ferme"
+
+
+def test_statistiques_latences_et_libelle_masque():
+    client = client_avec([Reponse(200, [])])
+    client.previsions(CLE, "site-a", "d", "f")
+    stats = client.statistiques()
+    assert list(stats) == [LIBELLE]
+    assert CLE not in str(stats)
+    assert stats[LIBELLE]["latence_p50_ms"] is not None
+    assert stats[LIBELLE]["latence_max_ms"] >= stats[LIBELLE]["latence_p50_ms"]
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from database import suivre_pool, etat_pool
+
+
+def moteur_pool(taille: int = 1):
+    moteur = create_engine("sqlite://", poolclass=QueuePool, pool_size=taille, max_overflow=0, pool_timeout=0.05)
+    suivre_pool(moteur)
+    return moteur
+
+
+def test_statistiques_propres_a_chaque_moteur():
+    premier, second = moteur_pool(), moteur_pool()
+    for _ in range(3):
+        with premier.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    assert etat_pool(premier)["acquisitions"] == 3
+    assert etat_pool(premier)["connexions_ouvertes"] == 1
+    assert etat_pool(second)["acquisitions"] == 0
+
+
+def test_timeout_compte_et_statistiques_conservees_apres_dispose():
+    moteur = moteur_pool()
+    with moteur.connect():
+        with pytest.raises(PoolTimeoutError):
+            moteur.connect()
+    assert moteur.statistiques_pool.timeouts == 1
+
+    moteur.dispose()
+    with moteur.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    etat = etat_pool(moteur)
+    assert (etat["acquisitions"], etat["timeouts"], etat["connexions_ouvertes"]) == (3, 1, 2)
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import Charge, EtatCourantMiroir
+from schemas import MesuresData, ConsommationData
+from ingestion import enregistrer_mesures
+from etat_courant import EtatCourant
+
+INSTANT = datetime(2024, 6, 1, 12, 0, 0)
+
+
+def echantillon(timestamp, soc=60.0, site_id=None) -> MesuresData:
+    return MesuresData(production=1500.0, soc_batterie=soc, tension_batterie=52.0, courant_batterie=2.0,
+                       consommations=[ConsommationData(charge_id=1, consommation=80.0)],
+                       timestamp=timestamp, site_id=site_id)
+
+
+@pytest.fixture
+def etat(Session):
+    with Session() as db:
+        db.add(Charge(id=1, nom="frigo", type="prioritaire", puissance_nominale=150, etat=False))
+        db.commit()
+    return EtatCourant(fabrique_session=Session, miroir=True)
+
+
+def test_miroir_ecrit_dans_la_transaction_instantane_apres_commit(etat, Session):
+    lot = [echantillon(INSTANT + timedelta(seconds=5)), echantillon(INSTANT, soc=10.0),
+           echantillon(INSTANT + timedelta(seconds=10), soc=99.0, site_id=3)]
+    with Session() as db:
+        enregistrer_mesures(db, lot, avant_commit=etat.avant_commit_mesures(lot))
+    assert etat.batterie is None  # not moved by the transaction itself
+    with Session() as db:
+        miroir = db.get(EtatCourantMiroir, 1)
+        # Latest sample of the historical installation; fleet samples are ignored
+        assert (miroir.timestamp, miroir.soc) == (INSTANT + timedelta(seconds=5), 60.0)
+
+
+def test_commit_en_echec_n_avance_pas_l_instantane(etat, Session):
+    lot = [echantillon(INSTANT)]
+    avant_commit = etat.avant_commit_mesures(lot)
+
+    def echec(db):
+        avant_commit(db)
+        raise RuntimeError("commit refusé")
+    with Session() as db, pytest.raises(RuntimeError):
+        enregistrer_mesures(db, lot, avant_commit=echec)
+    assert etat.batterie is None and etat.production is None
+    with Session() as db:
+        assert db.get(EtatCourantMiroir, 1) is None
+
+
+def test_miroir_ne_recule_pas(etat, Session):
+    for instant, soc in ((INSTANT, 50.0), (INSTANT - timedelta(minutes=1), 20.0)):
+        lot = [echantillon(instant, soc)]
+        with Session() as db:
+            enregistrer_mesures(db, lot, avant_commit=etat.avant_commit_mesures(lot))
+    with Session() as db:
+        assert db.get(EtatCourantMiroir, 1).soc == 50.0
+
+
+def test_etat_des_charges_relu_periodiquement_sans_miroir(Session, monkeypatch):
+    with Session() as db:
+        db.add(Charge(id=1, nom="frigo", type="prioritaire", puissance_nominale=150, etat=False))
+        db.commit()
+    etat = EtatCourant(fabrique_session=Session, miroir=False)
+    horloge = [100.0]
+    monkeypatch.setattr("etat_courant.chrono.monotonic", lambda: horloge[0])
+    assert etat.instantane()["charges"][0]["etat"] is False
+
+    # Another worker switches the charge on
+    with Session() as db:
+        db.get(Charge, 1).etat = True
+        db.commit()
+    assert etat.instantane()["charges"][0]["etat"] is False
+    horloge[0] += etat.periode_synchro_s + 1
+    assert etat.instantane()["charges"][0]["etat"] is True
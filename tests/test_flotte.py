@@ -0,0 +1,167 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+import optimisation_flotte
+import solcast_manager
+from optimisation_flotte import _dernieres_valeurs, charger_entrees, optimiser_site, optimiser_flotte, plan_site
+from models import Site, Charge, Calendrier, Batterie, Production, AgregatProduction
+from client_solcast import ErreurSolcast
+from fournisseur_local import FournisseurLocal
+from stockage_previsions import StockagePrevisions
+from solcast_manager import GestionnaireSolcast
+from requetes import requete_serie
+from ingestion import enregistrer_mesures
+from schemas import MesuresData, ConsommationData
+
+SEUILS = {"batterie_securite": 10, "batterie_critique": 20, "batterie_optimale": 80}
+MAINTENANT = datetime(2024, 6, 1, 12, 0)
+
+
+@pytest.fixture
+def flotte(Session):
+    """Deux sites de la flotte et l'installation historique (site_id NULL)"""
+    with Session() as db:
+        db.add_all([Site(id=1, nom="A", capacite_batterie_kwh=20.0), Site(id=2, nom="B")])
+        db.add_all([
+            Charge(id=1, nom="pompe", type="prioritaire", puissance_nominale=800.0, site_id=1),
+            Charge(id=2, nom="chauffe-eau", type="non-prioritaire", puissance_nominale=2000.0, site_id=1),
+            Charge(id=3, nom="historique", type="prioritaire", puissance_nominale=500.0, site_id=None),
+        ])
+        db.add(Calendrier(id_charge=2, date=MAINTENANT.date(), priorite_temporaire="prioritaire"))
+        db.add_all([
+            Batterie(timestamp=MAINTENANT - timedelta(minutes=10), soc=40.0, site_id=1),
+            Batterie(timestamp=MAINTENANT - timedelta(minutes=1), soc=55.0, site_id=1),
+            Batterie(timestamp=MAINTENANT - timedelta(minutes=1), soc=56.0, site_id=1),  # same instant, later id
+            Batterie(timestamp=MAINTENANT - timedelta(days=2), soc=90.0, site_id=2),     # outside the window
+            Batterie(timestamp=MAINTENANT, soc=10.0, site_id=None),
+            Production(timestamp=MAINTENANT - timedelta(minutes=1), production=1500.0, site_id=1),
+        ])
+        db.commit()
+    return Session
+
+
+# --- Chargement groupé --------------------------------------------------------------
+
+def test_dernieres_valeurs_par_site(flotte):
+    with flotte() as db:
+        socs = _dernieres_valeurs(db, Batterie, Batterie.soc, [1, 2], MAINTENANT - timedelta(hours=24))
+    assert socs == {1: 56.0}
+
+
+def test_charger_entrees(flotte):
+    with flotte() as db:
+        entrees = {e.site_id: e for e in charger_entrees(db, SEUILS, maintenant=MAINTENANT)}
+    assert set(entrees) == {1, 2}
+    a, b = entrees[1], entrees[2]
+    assert (a.soc, a.production_actuelle, a.capacite_kwh) == (56.0, 1500.0, 20.0)
+    assert [c.id for c in a.charges] == [1, 2]
+    assert [e.id_charge for e in a.calendrier] == [2]
+    assert (b.soc, b.charges, b.capacite_kwh) == (0.0, (), optimisation_flotte.CAPACITE_BATTERIE_KWH)
+    assert a.previsions == [] and a.version_previsions is None
+
+
+def test_optimiser_site_fonction_pure(flotte):
+    with flotte() as db:
+        entree, = charger_entrees(db, SEUILS, site_ids=[1], maintenant=MAINTENANT)
+    plan = optimiser_site(entree)
+    assert plan["site_id"] == 1 and "erreur" not in plan
+    assert plan["planning"].shape == (len(plan["debuts"]), 2)
+    erreur = optimiser_site(entree._replace(charges=(None,)))
+    assert erreur["site_id"] == 1 and "erreur" in erreur
+
+
+def test_optimiser_flotte_dans_le_processus(flotte, tmp_path, monkeypatch):
+    monkeypatch.setattr(optimisation_flotte, "stockage", StockagePrevisions(str(tmp_path / "plans.json")))
+    assert optimisation_flotte.dernier_bilan() is None
+    with flotte() as db:
+        bilan = optimiser_flotte(db, SEUILS)
+    assert (bilan["nb_sites"], bilan["nb_erreurs"]) == (2, 0)
+    assert plan_site(1)["creneaux"]
+    assert plan_site(99) is None
+
+    # Another uvicorn worker: its own storage object on the same file
+    monkeypatch.setattr(optimisation_flotte, "stockage", StockagePrevisions(str(tmp_path / "plans.json")))
+    assert [c["charge_id"] for c in plan_site(1)["commandes"]] == [1, 2]
+    assert plan_site(2)["commandes"] == []
+    assert optimisation_flotte.dernier_bilan()["calcule_le"] == bilan["calcule_le"]
+
+
+# --- Agrégats et séries par site ------------------------------------------------
+
+def mesures(site_id, production: float, nombre: int = 12) -> list:
+    return [MesuresData(production=production, soc_batterie=50.0, tension_batterie=52.0, courant_batterie=1.0,
+                        consommations=[ConsommationData(charge_id=1, consommation=100.0)],
+                        timestamp=MAINTENANT + timedelta(seconds=5 * i), site_id=site_id) for i in range(nombre)]
+
+
+@pytest.mark.parametrize("pas", [60, 30])  # rollups, raw measurements
+def test_series_separees_par_site(Session, pas):
+    with Session() as db:
+        enregistrer_mesures(db, mesures(None, 1000.0) + mesures(1, 3000.0) + mesures(2, 5000.0))
+        fin = MAINTENANT + timedelta(minutes=1)
+        series = {site_id: db.execute(requete_serie("production", MAINTENANT, fin, pas, site_id=site_id)).all()
+                  for site_id in (None, 1, 2)}
+    for site_id, attendu in ((None, 1000.0), (1, 3000.0), (2, 5000.0)):
+        assert sum(l[1] for l in series[site_id]) == 12
+        assert {l[3] for l in series[site_id]} == {l[4] for l in series[site_id]} == {attendu}
+
+
+def test_energie_jamais_integree_entre_deux_sites(Session):
+    entrelacees = [e for paire in zip(mesures(1, 3600.0), mesures(2, 0.0)) for e in paire]
+    with Session() as db:
+        enregistrer_mesures(db, entrelacees)
+        energies = dict(db.execute(select(AgregatProduction.site_id, AgregatProduction.energie_wh)
+                                   .where(AgregatProduction.pas == 3600)).all())
+    assert energies[1] == pytest.approx(11 * 5)  # 11 intervals of 5 s at 3600 W
+    assert energies[2] == 0
+
+
+# --- Quota Solcast par clé API ----------------------------------------------------
+
+class FournisseurEnPanne(FournisseurLocal):
+    def previsions(self, api_key, site_id, debut, fin):
+        raise ErreurSolcast("HTTP 503")
+
+
+@pytest.fixture
+def gestionnaires(tmp_path, monkeypatch):
+    """Trois sites Solcast : s1 et s2 partagent la clé A, s3 a la clé B"""
+    monkeypatch.setattr(solcast_manager, "charger_cles_solcast",
+                        lambda: [("cle-A", "s1"), ("cle-A", "s2"), ("cle-B", "s3")])
+    stockage = StockagePrevisions(str(tmp_path / "cache.json"))
+    fournisseur = FournisseurLocal()
+    return {site: GestionnaireSolcast(stockage, solcast_site_id=site, fournisseur=fournisseur)
+            for site in ("s1", "s2", "s3")}
+
+
+def test_quota_compte_par_cle_entre_sites(gestionnaires):
+    s1, s2, s3 = gestionnaires["s1"], gestionnaires["s2"], gestionnaires["s3"]
+    reussis = 0
+    for i in range(30):
+        try:
+            (s1 if i % 2 else s2).rafraichir_previsions()
+            reussis += 1
+        except solcast_manager.HTTPException as e:
+            assert e.status_code == 429
+    assert reussis == s1.limite_appels_par_cle
+    assert not s1.peut_appeler_api() and not s2.peut_appeler_api()
+    assert s1.appels_par_cle == s2.appels_par_cle
+    assert s3.peut_appeler_api() and s3.appels_aujourd_hui == 0
+    s3.rafraichir_previsions()
+    assert s3.get_statistiques_utilisation()["appels_restants"] == s3.limite_appels_par_cle - 1
+
+
+def test_appel_en_echec_rendu_au_quota(gestionnaires):
+    s1 = gestionnaires["s1"]
+    s1.fournisseur = FournisseurEnPanne()
+    with pytest.raises(solcast_manager.HTTPException) as erreur:
+        s1.rafraichir_previsions()
+    assert erreur.value.status_code == 503
+    assert s1.appels_aujourd_hui == 0
+
+
+def test_la_cle_n_est_pas_ecrite_dans_le_cache(gestionnaires, tmp_path):
+    gestionnaires["s1"].rafraichir_previsions()
+    assert "cle-A" not in (tmp_path / "cache.json").read_text()
@@ -0,0 +1,237 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+
+from models import Production, Batterie, Consommation, Charge, Site
+from schemas import MesuresData, ConsommationData
+from ingestion import (
+    construire_lignes, inserer_lignes, enregistrer_mesures, TamponIngestion, TamponPlein,
+    ReferencesConnues, ReferenceInconnue
+)
+
+RECU_LE = datetime(2024, 6, 1, 12, 0, 0)
+
+
+def echantillon(timestamp=None, site_id=None, charges=(1, 2)) -> MesuresData:
+    return MesuresData(
+        production=2500.0, soc_batterie=65.0, tension_batterie=52.0, courant_batterie=-3.5,
+        consommations=[ConsommationData(charge_id=i, consommation=100.0 * i) for i in charges],
+        timestamp=timestamp, site_id=site_id,
+    )
+
+
+def compter(db, modele) -> int:
+    return db.execute(select(func.count()).select_from(modele)).scalar()
+
+
+# --- construire_lignes --------------------------------------------------------
+
+def test_construire_lignes_une_ligne_par_table_et_par_consommation():
+    lignes = construire_lignes([echantillon(), echantillon(charges=(3,))], recu_le=RECU_LE)
+    assert len(lignes["production"]) == 2
+    assert len(lignes["batterie"]) == 2
+    assert [l["id_charge"] for l in lignes["consommation"]] == [1, 2, 3]
+
+
+def test_construire_lignes_memes_cles_pour_un_insert_multi_lignes():
+    lignes = construire_lignes([echantillon(), echantillon(site_id=4)], recu_le=RECU_LE)
+    for valeurs in lignes.values():
+        assert len({frozenset(l) for l in valeurs}) == 1
+    assert [l["site_id"] for l in lignes["batterie"]] == [None, 4]
+
+
+def test_construire_lignes_horodatage_appareil_ou_reception():
+    instant = datetime(2024, 6, 1, 10, 0, 5)
+    lignes = construire_lignes([echantillon(), echantillon(timestamp=instant)], recu_le=RECU_LE)
+    assert [l["timestamp"] for l in lignes["production"]] == [RECU_LE, instant]
+
+
+def test_construire_lignes_horodatage_avec_fuseau_en_heure_locale_naive():
+    instant = datetime(2024, 6, 1, 10, 0, tzinfo=timezone.utc)
+    ligne = construire_lignes([echantillon(timestamp=instant)], recu_le=RECU_LE)["production"][0]
+    assert ligne["timestamp"].tzinfo is None
+    assert ligne["timestamp"] == instant.astimezone().replace(tzinfo=None)
+
+
+# --- inserer_lignes / enregistrer_mesures --------------------------------------
+
+def test_inserer_lignes_ecrit_toutes_les_tables(Session):
+    lignes = construire_lignes([echantillon(RECU_LE + timedelta(seconds=5 * i)) for i in range(10)])
+    with Session() as db:
+        assert inserer_lignes(db, lignes) == 10 + 10 + 20
+        db.commit()
+        assert (compter(db, Production), compter(db, Batterie), compter(db, Consommation)) == (10, 10, 20)
+
+
+def test_inserer_lignes_ignore_les_tables_vides(Session):
+    lignes = construire_lignes([echantillon(charges=())], recu_le=RECU_LE)
+    with Session() as db:
+        assert inserer_lignes(db, lignes) == 2
+        assert compter(db, Consommation) == 0
+
+
+def test_enregistrer_mesures_bilan_et_avant_commit(Session):
+    appels = []
+    with Session() as db:
+        bilan = enregistrer_mesures(db, [echantillon(RECU_LE), echantillon(RECU_LE + timedelta(seconds=5))],
+                                    avant_commit=appels.append)
+    assert appels and bilan["echantillons"] == 2
+    assert bilan["lignes"] == {"production": 2, "batterie": 2, "consommation": 4}
+    assert bilan["lignes_total"] == 8
+    with Session() as db:
+        assert compter(db, Consommation) == 4
+
+
+# --- TamponIngestion ------------------------------------------------------------
+
+def lignes_de(n: int, debut: int = 0) -> dict:
+    return construire_lignes([echantillon(RECU_LE + timedelta(seconds=5 * (debut + i)), charges=())
+                              for i in range(n)])
+
+
+def test_tampon_refuse_au_dela_de_la_capacite(Session):
+    tampon = TamponIngestion(fabrique_session=Session, capacite=10)
+    assert tampon.ajouter(lignes_de(4)) == 8
+    with pytest.raises(TamponPlein):
+        tampon.ajouter(lignes_de(2), attente_max_s=0)
+    assert tampon.stats["refus"] == 1
+    assert tampon.get_statistiques()["en_attente"] == 8
+
+
+def test_tampon_producteur_debloque_quand_la_place_se_libere(Session):
+    tampon = TamponIngestion(fabrique_session=Session, capacite=10)
+    tampon.ajouter(lignes_de(5))
+    resultat = []
+    producteur = threading.Thread(target=lambda: resultat.append(tampon.ajouter(lignes_de(1), attente_max_s=5)))
+    producteur.start()
+    with tampon._condition:
+        lot = tampon._extraire()
+    producteur.join(5)
+    assert resultat == [2]
+    assert len(lot["production"]) == 5
+
+
+def test_tampon_remet_le_lot_en_tete_apres_un_echec(Session):
+    tampon = TamponIngestion(fabrique_session=Session, capacite=100)
+    tampon.ajouter(lignes_de(3))
+    with tampon._condition:
+        lot = tampon._extraire()
+    tampon.ajouter(lignes_de(1, debut=3))
+
+    def echec(db):
+        raise OperationalError("COMMIT", {}, Exception("base indisponible"))
+    tampon.avant_commit = echec
+    assert not tampon._ecrire(lot)
+    assert tampon.stats["echecs"] == 1
+    # Order kept: the failed batch goes back ahead of the rows added meanwhile
+    attendus = [RECU_LE + timedelta(seconds=5 * i) for i in range(4)]
+    assert [l["timestamp"] for l in tampon._lignes["production"]] == attendus
+    assert tampon.get_statistiques()["en_attente"] == 8
+    with Session() as db:
+        assert compter(db, Production) == 0
+
+
+def test_tampon_commits_groupes_et_vidage_a_l_arret(Session):
+    tampon = TamponIngestion(fabrique_session=Session, capacite=1000, intervalle_ms=50, lignes_max=10_000)
+    tampon.demarrer()
+    try:
+        for i in range(20):
+            tampon.ajouter(lignes_de(1, debut=i))
+    finally:
+        tampon.arreter()
+    assert not tampon.actif
+    assert tampon.stats["lignes_ecrites"] == 40
+    assert 1 <= tampon.stats["commits"] < 20
+    with Session() as db:
+        assert (compter(db, Production), compter(db, Batterie)) == (20, 20)
+
+
+@pytest.fixture
+def Session_cles_etrangeres(moteur, Session):
+    """SQLite ne vérifie les clés étrangères qu'avec PRAGMA foreign_keys (PostgreSQL toujours)"""
+    with moteur.connect() as connexion:  # StaticPool: the same connection for every session
+        connexion.exec_driver_sql("PRAGMA foreign_keys=ON")
+    with Session() as db:
+        db.add(Charge(id=1, nom="frigo", type="prioritaire", puissance_nominale=150))
+        db.commit()
+    return Session
+
+
+def test_tampon_isole_une_ligne_invalide_sans_bloquer_le_lot(Session_cles_etrangeres):
+    Session = Session_cles_etrangeres
+    tampon = TamponIngestion(fabrique_session=Session, capacite=100, tentatives_max=3)
+    tampon.ajouter(construire_lignes([echantillon(RECU_LE, charges=(1,)), echantillon(RECU_LE, charges=(99,))]))
+    with tampon._condition:
+        lot = tampon._extraire()
+    assert tampon._ecrire(lot)
+    with Session() as db:
+        assert (compter(db, Production), compter(db, Batterie), compter(db, Consommation)) == (2, 2, 1)
+    assert [(nom, ligne["id_charge"], echecs) for nom, ligne, echecs in tampon._a_reessayer] == [
+        ("consommation", 99, 1)]
+    assert tampon.get_statistiques()["a_reessayer"] == 1
+
+    # Retried alone, then dropped after tentatives_max failures
+    for _ in range(2):
+        with tampon._condition:
+            entrees, tampon._a_reessayer = tampon._a_reessayer, []
+        tampon._ecrire_une_a_une(entrees)
+    assert tampon._a_reessayer == []
+    assert tampon.stats["lignes_rejetees"] == 1
+    assert tampon.stats["lignes_ecrites"] == 5
+
+
+def test_tampon_une_ligne_invalide_ne_bloque_pas_le_thread(Session_cles_etrangeres):
+    Session = Session_cles_etrangeres
+    tampon = TamponIngestion(fabrique_session=Session, capacite=100, intervalle_ms=20, tentatives_max=2)
+    tampon.demarrer()
+    try:
+        tampon.ajouter(construire_lignes([echantillon(RECU_LE, charges=(99,))]))
+        for i in range(1, 6):
+            tampon.ajouter(construire_lignes([echantillon(RECU_LE + timedelta(seconds=5 * i), charges=(1,))]))
+    finally:
+        tampon.arreter(timeout=5)
+    assert not tampon.actif
+    assert tampon.stats["lignes_rejetees"] == 1
+    with Session() as db:
+        assert (compter(db, Production), compter(db, Consommation)) == (6, 5)
+
+
+def test_tampon_erreur_transitoire_ligne_par_ligne_sans_compter_d_echec(Session):
+    tampon = TamponIngestion(fabrique_session=Session, capacite=100, tentatives_max=1)
+
+    def echec(db):
+        raise OperationalError("COMMIT", {}, Exception("base indisponible"))
+    tampon.avant_commit = echec
+    ligne = construire_lignes([echantillon(RECU_LE, charges=())])["production"][0]
+    assert not tampon._ecrire_une_a_une([("production", ligne, 0)])
+    assert tampon._a_reessayer == [("production", ligne, 0)]
+    assert tampon.stats["lignes_rejetees"] == 0
+
+
+# --- ReferencesConnues ----------------------------------------------------------
+
+def test_references_refuse_charge_ou_site_inconnu(Session):
+    with Session() as db:
+        db.add_all([Site(id=1, nom="s1"), Charge(id=1, nom="frigo", type="prioritaire", puissance_nominale=150)])
+        db.commit()
+    references = ReferencesConnues(fabrique_session=Session)
+    assert not references.connues([echantillon(charges=(1,))])
+    references.verifier([echantillon(site_id=1, charges=(1,))])
+    assert references.connues([echantillon(site_id=1, charges=(1,))])
+    with pytest.raises(ReferenceInconnue, match="Charge"):
+        references.verifier([echantillon(charges=(1, 2))])
+    with pytest.raises(ReferenceInconnue, match="Site"):
+        references.verifier([echantillon(site_id=7, charges=(1,))])
+
+
+def test_references_relues_pour_une_charge_creee_ailleurs(Session):
+    references = ReferencesConnues(fabrique_session=Session)
+    with pytest.raises(ReferenceInconnue):
+        references.verifier([echantillon(charges=(3,))])
+    with Session() as db:
+        db.add(Charge(id=3, nom="pompe", type="semi-prioritaire", puissance_nominale=500))
+        db.commit()
+    references.verifier([echantillon(charges=(3,))])
@@ -0,0 +1,41 @@
+import logging
+
+from sqlalchemy import create_engine, inspect, text
+
+import migrations
+
+
+def index_de(moteur, table: str) -> set:
+    return {i["name"] for i in inspect(moteur).get_indexes(table)}
+
+
+def test_base_neuve_sans_migration_en_attente():
+    moteur = create_engine("sqlite://")
+    assert migrations.preparer_base(moteur) == []
+    assert "ix_production_timestamp_id" in index_de(moteur, "production")
+
+
+def test_demarrage_signale_sans_construire_les_index(moteur, caplog):
+    with moteur.begin() as conn:
+        conn.execute(text("DROP INDEX ix_production_timestamp_id"))
+    with caplog.at_level(logging.WARNING, logger="migrations"):
+        assert migrations.preparer_base(moteur) == ["ix_production_timestamp_id"]
+    assert "python migrations.py" in caplog.text
+    assert "ix_production_timestamp_id" not in index_de(moteur, "production")
+
+    assert migrations.appliquer_migrations(moteur) == ["ix_production_timestamp_id"]
+    assert migrations.migrations_en_attente(moteur) == []
+
+
+def test_colonne_manquante_en_attente(moteur):
+    with moteur.begin() as conn:
+        conn.execute(text("ALTER TABLE decisions DROP COLUMN raison"))
+    assert migrations.migrations_en_attente(moteur) == ["decisions.raison"]
+    assert migrations.ajouter_colonnes_manquantes(moteur) == ["decisions.raison"]
+
+
+def test_index_invalide_supprime_puis_reconstruit(moteur, monkeypatch):
+    monkeypatch.setattr(migrations, "index_invalides", lambda m: {"ix_batterie_site_timestamp"})
+    assert migrations.migrations_en_attente(moteur) == ["ix_batterie_site_timestamp (invalide)"]
+    assert migrations.creer_index_manquants(moteur) == ["ix_batterie_site_timestamp"]
+    assert "ix_batterie_site_timestamp" in index_de(moteur, "batterie")
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from optimiseur_horizon import OptimiseurHorizon, POIDS_PRIORITE, PAS_H
+
+SEUILS = {"batterie_securite": 10, "batterie_critique": 20, "batterie_optimale": 80}
+DEBUT = datetime(2024, 6, 1, 0, 0)
+NB_CRENEAUX = 48
+PUISSANCES = np.array([1000.0, 800.0, 1500.0])  # prioritaire, semi-prioritaire, non-prioritaire
+TYPES = ["prioritaire", "semi-prioritaire", "non-prioritaire"]
+
+
+@pytest.fixture
+def horizon():
+    return OptimiseurHorizon(SEUILS, capacite_kwh=10.0, puissance_kw=5.0)
+
+
+def poids_constants(nb_creneaux: int = NB_CRENEAUX) -> np.ndarray:
+    return np.tile([POIDS_PRIORITE[t] for t in TYPES], (nb_creneaux, 1))
+
+
+def production_journee(crete_w: float = 4000.0) -> np.ndarray:
+    """Cloche entre 6 h et 19 h sur des créneaux de 30 min à partir de minuit"""
+    heures = np.arange(NB_CRENEAUX) * PAS_H + PAS_H / 2
+    return np.where((heures > 6) & (heures < 19), crete_w * np.sin(np.pi * (heures - 6) / 13), 0.0)
+
+
+# --- resoudre ---------------------------------------------------------------------
+
+def test_resoudre_formes(horizon):
+    solution = horizon.resoudre(production_journee(), PUISSANCES, poids_constants(), 50.0)
+    assert solution["planning"].shape == (NB_CRENEAUX, len(PUISSANCES))
+    assert solution["planning"].dtype == bool
+    assert solution["valeurs"].shape == (NB_CRENEAUX + 1, len(horizon.grille))
+    assert solution["soc_prevu"].shape == solution["reseau_kwh"].shape == (NB_CRENEAUX,)
+
+
+def test_resoudre_respecte_l_ordre_de_priorite(horizon):
+    planning = horizon.resoudre(production_journee(), PUISSANCES, poids_constants(), 50.0)["planning"]
+    # Action = "the k first loads of the ranking": a lower priority never runs without the higher ones
+    assert np.all(planning[:, 0] >= planning[:, 1])
+    assert np.all(planning[:, 1] >= planning[:, 2])
+
+
+def test_resoudre_ne_descend_jamais_sous_batterie_securite(horizon):
+    solution = horizon.resoudre(np.zeros(NB_CRENEAUX), PUISSANCES, poids_constants(), 30.0)
+    assert solution["soc_prevu"].min() >= SEUILS["batterie_securite"] - 1e-9
+
+
+def test_resoudre_nuit_batterie_vide(horizon):
+    """Sans production ni réserve : le réseau ne paie que les charges qui valent plus que son prix"""
+    solution = horizon.resoudre(np.zeros(4), PUISSANCES, poids_constants(4), SEUILS["batterie_securite"])
+    assert solution["planning"][:, 0].all()      # prioritaire : 100 > PRIX_RESEAU
+    assert not solution["planning"][:, 2].any()  # non-prioritaire : 1 < PRIX_RESEAU
+    assert solution["reseau_kwh"].sum() > 0
+
+
+def test_resoudre_plein_soleil_tout_alimenter(horizon):
+    solution = horizon.resoudre(np.full(4, 5000.0), PUISSANCES, poids_constants(4), 90.0)
+    assert solution["planning"].all()
+    assert solution["reseau_kwh"].sum() == pytest.approx(0.0)
+
+
+def test_resoudre_priorite_temporaire(horizon):
+    poids = poids_constants(4)
+    poids[:, 2] = POIDS_PRIORITE["prioritaire"]  # event of the calendar raises the last load
+    solution = horizon.resoudre(np.zeros(4), PUISSANCES, poids, SEUILS["batterie_securite"])
+    assert solution["planning"][:, 2].all()
+    assert not solution["planning"][:, 1].any()
+
+
+# --- Données d'entrée ----------------------------------------------------------
+
+def period_end(instant_local: datetime) -> str:
+    """period_end Solcast (UTC, suffixe Z) d'un instant local naïf"""
+    return instant_local.astimezone().astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def test_construire_creneaux(horizon):
+    demain = DEBUT + timedelta(days=1)
+    previsions = [{"period_end": period_end(demain + timedelta(minutes=30 * (i + 1))), "pv_estimate": 0.5 * i,
+                   "pv_estimate10": 0.1 * i} for i in range(48)]
+    maintenant = DEBUT + timedelta(hours=10, minutes=40)
+    debuts, production = horizon.construire_creneaux(previsions, maintenant, production_actuelle=1234.0)
+    assert debuts[0] == DEBUT + timedelta(hours=10, minutes=30)
+    assert debuts[-1] == demain + timedelta(hours=23, minutes=30)
+    assert production[0] == 1234.0  # current slot: measured production
+    # Today's slots reuse the forecast of the same hour tomorrow (kW -> W)
+    assert production[1] == 0.5 * 22 * 1000
+    assert production[debuts.index(demain)] == 0.0
+    _, p10 = horizon.construire_creneaux(previsions, maintenant, 0.0, cle="pv_estimate10")
+    assert p10[debuts.index(demain + timedelta(hours=1))] == pytest.approx(0.1 * 2 * 1000)
+
+
+def test_poids_charges_calendrier(horizon):
+    charges = [SimpleNamespace(id=1, type="prioritaire"), SimpleNamespace(id=2, type="non-prioritaire")]
+    debuts = [DEBUT + timedelta(minutes=30 * i) for i in range(6)]
+    evenement = SimpleNamespace(id_charge=2, date=DEBUT.date(), heure_debut=(DEBUT + timedelta(hours=1)).time(),
+                                heure_fin=(DEBUT + timedelta(hours=2)).time(), priorite_temporaire="semi-prioritaire")
+    inconnu = SimpleNamespace(id_charge=99, date=DEBUT.date(), heure_debut=None, heure_fin=None,
+                              priorite_temporaire="prioritaire")
+    poids = horizon.poids_charges(charges, [evenement, inconnu], debuts)
+    assert poids[:, 0].tolist() == [100.0] * 6
+    assert poids[:, 1].tolist() == [1.0, 1.0, 10.0, 10.0, 1.0, 1.0]
+
+
+# --- Replanification incrémentale ---------------------------------------------
+
+@pytest.fixture
+def plan(horizon):
+    """Planning courant construit comme planifier(), sur des créneaux fixes"""
+    production_w = production_journee()
+    solution = horizon.resoudre(production_w.copy(), PUISSANCES, poids_constants(), 50.0)
+    horizon._plan = {
+        "debuts": [DEBUT + timedelta(minutes=30 * i) for i in range(NB_CRENEAUX)],
+        "charges": [1, 2, 3],
+        "production_w": production_w.copy(),
+        "version_previsions": None,
+        "calcule_le": DEBUT,
+        "duree_ms": 0.0,
+        "creneau_courant": 0,
+        "repere": (DEBUT, 50.0, 0),
+        **solution,
+    }
+    return horizon._plan
+
+
+def test_mesure_conforme_sans_reparation(horizon, plan):
+    instant = DEBUT + timedelta(minutes=10)
+    soc = horizon.soc_attendu(plan, 0, instant)
+    assert not horizon.suivre_mesure(plan["production_w"][0], soc, instant)
+    assert horizon.statistiques["mesures_suivies"] == 1
+    assert horizon.statistiques["incrementaux"]["nombre"] == 0
+
+
+def test_ecart_de_soc_repare_les_creneaux_restants(horizon, plan):
+    instant = DEBUT + timedelta(minutes=10)
+    assert horizon.suivre_mesure(plan["production_w"][0], 20.0, instant)
+    plan = horizon._plan
+    assert horizon.statistiques["ecarts_detectes"] == 1
+    assert horizon.statistiques["incrementaux"]["nombre"] == 1
+    assert plan["repere"] == (instant, 20.0, 0)
+    attendu = horizon.resoudre(plan["production_w"], PUISSANCES, poids_constants(), 20.0)
+    assert np.array_equal(plan["planning"], attendu["planning"])
+
+
+def test_reparation_equivalente_a_une_resolution_complete(horizon, plan):
+    """La fonction de valeur ne dépend pas de l'état mesuré : seule la passe avant est refaite"""
+    plan = horizon.replanifier(plan, 0, 85.0)
+    complet = horizon.resoudre(plan["production_w"], PUISSANCES, poids_constants(), 85.0)
+    assert np.array_equal(plan["planning"], complet["planning"])
+    assert np.allclose(plan["soc_prevu"], complet["soc_prevu"])
+
+
+def test_ecart_de_production_remplace_la_prevision_du_creneau(horizon, plan):
+    creneau = 24  # midi
+    instant = plan["debuts"][creneau] + timedelta(minutes=5)
+    plan["creneau_courant"] = creneau
+    plan["repere"] = (plan["debuts"][creneau], plan["soc_prevu"][creneau - 1], creneau)
+    soc = horizon.soc_attendu(plan, creneau, instant)
+    assert horizon.suivre_mesure(0.0, soc, instant)
+    plan = horizon._plan
+    assert plan["production_w"][creneau] == 0.0
+    assert plan["production_kwh"][creneau] == 0.0
+
+
+def test_nouveau_creneau_deplace_le_creneau_courant(horizon, plan):
+    creneau = 3
+    instant = plan["debuts"][creneau] + timedelta(minutes=1)
+    soc = horizon.soc_attendu(plan, creneau, instant)
+    assert horizon.suivre_mesure(plan["production_w"][creneau], soc, instant)
+    assert horizon._plan["creneau_courant"] == creneau
+    assert horizon.statistiques["ecarts_detectes"] == 0
+
+
+def test_reparation_copie_sur_ecriture(horizon, plan):
+    """Un lecteur qui formate le planning publié ne voit jamais une réparation à moitié écrite"""
+    instantane = {cle: (v.copy() if isinstance(v, np.ndarray) else v) for cle, v in plan.items()}
+    formate = OptimiseurHorizon.formater(plan)
+    creneau = 24
+    instant = plan["debuts"][creneau] + timedelta(minutes=5)
+    assert horizon.suivre_mesure(0.0, 15.0, instant)
+    assert horizon._plan is not plan
+    for cle, valeur in instantane.items():
+        if isinstance(valeur, np.ndarray):
+            assert np.array_equal(plan[cle], valeur), cle
+        else:
+            assert plan[cle] == valeur, cle
+    assert OptimiseurHorizon.formater(plan) == formate
+    assert horizon._plan["creneau_courant"] == creneau
+    assert horizon._plan["production_w"][creneau] == 0.0
+
+
+def test_mesure_en_retard_ou_hors_horizon_ignoree(horizon, plan):
+    plan["creneau_courant"] = 5
+    assert not horizon.suivre_mesure(0.0, 10.0, plan["debuts"][2])
+    assert not horizon.suivre_mesure(0.0, 10.0, plan["debuts"][-1] + timedelta(hours=1))
+    assert horizon.statistiques["incrementaux"]["nombre"] == 0
+
+
+def test_sans_planning_rien_a_suivre(horizon):
+    assert not horizon.suivre_mesure(1000.0, 50.0, DEBUT)
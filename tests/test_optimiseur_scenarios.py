@@ -0,0 +1,129 @@
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from optimiseur_horizon import OptimiseurHorizon, POIDS_PRIORITE, PAS_H
+from optimiseur_scenarios import OptimiseurScenarios, scenarios_production
+
+SEUILS = {"batterie_securite": 10, "batterie_critique": 20, "batterie_optimale": 80}
+MAINTENANT = datetime(2024, 6, 1, 18, 0)
+NB_CRENEAUX = 24
+PUISSANCES = np.array([1000.0, 800.0, 1500.0])
+POIDS = np.tile([POIDS_PRIORITE[t] for t in ("prioritaire", "semi-prioritaire", "non-prioritaire")],
+                (NB_CRENEAUX, 1))
+
+
+@pytest.fixture
+def optimiseur():
+    return OptimiseurScenarios(OptimiseurHorizon(SEUILS, capacite_kwh=10.0, puissance_kw=5.0), nb_scenarios=50)
+
+
+def plannings(*colonnes) -> np.ndarray:
+    """Un planning (T, N) par liste de charges alimentées sur tout l'horizon"""
+    resultat = np.zeros((len(colonnes), NB_CRENEAUX, len(PUISSANCES)), dtype=bool)
+    for c, charges in enumerate(colonnes):
+        resultat[c][:, list(charges)] = True
+    return resultat
+
+
+# --- scenarios_production ---------------------------------------------------------
+
+def test_scenarios_entre_les_quantiles():
+    p50 = np.linspace(0, 4000, NB_CRENEAUX)
+    p10, p90 = 0.5 * p50, 1.3 * p50
+    scenarios = scenarios_production(p10, p50, p90, 100)
+    assert scenarios.shape == (100, NB_CRENEAUX)
+    assert np.all(np.diff(scenarios, axis=0) >= 0)  # stratified quantiles, shared by every slot
+    assert np.allclose(np.median(scenarios, axis=0), p50, rtol=0.02)
+    assert np.allclose(np.percentile(scenarios, 10, axis=0), p10, rtol=0.05)
+
+
+def test_scenarios_quantiles_inverses_et_positifs():
+    p50 = np.full(4, 1000.0)
+    scenarios = scenarios_production(p50 * 1.2, p50, p50 * 0.8, 20)  # P10 > P90: sorted first
+    assert scenarios.min() >= 0
+    assert scenarios[0].mean() < scenarios[-1].mean()
+
+
+# --- evaluer ----------------------------------------------------------------------
+
+def test_charges_prioritaires_seules_jamais_en_depassement(optimiseur):
+    """La nuit, les charges prioritaires vident la batterie : import réseau, pas un dépassement"""
+    scenarios = np.zeros((10, NB_CRENEAUX))
+    evaluation = optimiseur.evaluer(plannings([0]), scenarios, PUISSANCES, POIDS, 30.0)
+    assert evaluation["probabilite_depassement"][0] == 0.0
+    assert evaluation["probabilite_plancher"][0] == 1.0
+    assert evaluation["reseau_moyen_kwh"][0] > 0
+
+
+def test_charges_optionnelles_sous_le_plancher_en_depassement(optimiseur):
+    scenarios = np.zeros((10, NB_CRENEAUX))
+    evaluation = optimiseur.evaluer(plannings([0], [0, 1, 2]), scenarios, PUISSANCES, POIDS, 30.0)
+    assert evaluation["probabilite_depassement"].tolist() == [0.0, 1.0]
+    assert evaluation["reseau_moyen_kwh"][1] > evaluation["reseau_moyen_kwh"][0]
+
+
+def test_depassement_seulement_dans_les_scenarios_sombres(optimiseur):
+    p50 = np.full(NB_CRENEAUX, 2000.0)
+    scenarios = scenarios_production(p50 * 0.2, p50, p50 * 1.5, 50)
+    evaluation = optimiseur.evaluer(plannings([0, 1, 2]), scenarios, PUISSANCES, POIDS, 30.0)
+    assert 0.0 < evaluation["probabilite_depassement"][0] < 1.0
+
+
+def test_trajectoires_et_valeur(optimiseur):
+    scenarios = np.full((5, NB_CRENEAUX), 6000.0)
+    evaluation = optimiseur.evaluer(plannings([], [0, 1, 2]), scenarios, PUISSANCES, POIDS, 50.0)
+    assert evaluation["trajectoires_soc"].shape == (2, 5, NB_CRENEAUX)
+    assert evaluation["trajectoires_soc"].max() <= 100.0
+    assert evaluation["probabilite_depassement"].tolist() == [0.0, 0.0]
+    assert evaluation["valeur_moyenne"][1] > evaluation["valeur_moyenne"][0]
+
+
+# --- planifier / obtenir ----------------------------------------------------------
+
+@pytest.fixture
+def donnees_nuit(optimiseur, monkeypatch):
+    """preparer() sans base : soirée sans production, prévisions P10 < P50 < P90 le lendemain"""
+    heures = (np.arange(NB_CRENEAUX) * PAS_H + MAINTENANT.hour) % 24
+    p50 = np.where((heures > 7) & (heures < 17), 3000.0, 0.0)
+    donnees = {
+        "debuts": [MAINTENANT + timedelta(minutes=30 * i) for i in range(NB_CRENEAUX)],
+        "charges": [type("Charge", (), {"id": i + 1})() for i in range(len(PUISSANCES))],
+        "production": {"pv_estimate10": 0.5 * p50, "pv_estimate": p50, "pv_estimate90": 1.2 * p50},
+        "puissances": PUISSANCES,
+        "poids": POIDS,
+    }
+    monkeypatch.setattr(optimiseur.horizon, "preparer", lambda db, contexte, previsions, maintenant, cles: donnees)
+    return donnees
+
+
+def test_planifier_retient_un_candidat_admissible_sans_alerte(optimiseur, donnees_nuit, caplog):
+    with caplog.at_level(logging.WARNING, logger="optimiseur_scenarios"):
+        resultat = optimiseur.planifier(None, {"soc_batterie": 40.0, "maintenant": MAINTENANT}, [])
+    assert resultat["calcule_le"] == MAINTENANT  # replay clock, not datetime.now()
+    risques = resultat["evaluation"]["probabilite_depassement"]
+    assert risques[resultat["retenu"]] <= optimiseur.risque_max
+    assert not caplog.records
+    admissibles = np.flatnonzero(risques <= optimiseur.risque_max)
+    valeurs = resultat["evaluation"]["valeur_moyenne"]
+    assert valeurs[resultat["retenu"]] == valeurs[admissibles].max()
+
+
+def test_obtenir_en_cache_par_version(optimiseur, donnees_nuit):
+    contexte = {"soc_batterie": 40.0, "maintenant": MAINTENANT}
+    premier = optimiseur.obtenir(None, contexte, [], "v1")
+    assert optimiseur.obtenir(None, contexte, [], "v1") is premier
+    assert optimiseur.obtenir(None, contexte, [], "v2") is not premier
+    optimiseur.horizon.invalider()
+    assert optimiseur.obtenir(None, contexte, [], "v2")["version_previsions"] == "v2"
+
+
+def test_formater(optimiseur, donnees_nuit):
+    resultat = optimiseur.obtenir(None, {"soc_batterie": 40.0, "maintenant": MAINTENANT}, [], "v1")
+    reponse = optimiseur.formater(resultat)
+    assert reponse["planning_retenu"] in {c["nom"] for c in reponse["candidats"]}
+    assert len(reponse["creneaux"]) == NB_CRENEAUX
+    bande = reponse["creneaux"][-1]["soc_prevu"]
+    assert bande["p10"] <= bande["p50"] <= bande["p90"]
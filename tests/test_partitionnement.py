@@ -0,0 +1,67 @@
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import partitionnement
+
+JOUR = date(2024, 6, 1)
+
+
+class MoteurEnregistreur:
+    """Moteur factice : enregistre le SQL exécuté, la partition par défaut contient `en_retard` lignes"""
+
+    def __init__(self, en_retard: int):
+        self.en_retard = en_retard
+        self.sql = []
+
+    def begin(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, requete, parametres=None):
+        sql = str(requete)
+        self.sql.append(sql)
+        if sql.startswith("SELECT 1"):
+            return SimpleNamespace(first=lambda: (1,) if self.en_retard else None)
+        return SimpleNamespace(rowcount=self.en_retard if sql.startswith("INSERT") else 0)
+
+
+@pytest.fixture
+def par_jour(monkeypatch):
+    monkeypatch.setattr(partitionnement, "PARTITIONNEMENT", "jour")
+
+
+def test_partition_creee_directement_si_la_partition_par_defaut_est_vide(par_jour):
+    moteur = MoteurEnregistreur(en_retard=0)
+    assert partitionnement.creer_partition(moteur, "production", JOUR) == 0
+    assert [s.split(" ")[0] for s in moteur.sql] == ["LOCK", "SELECT", "CREATE"]
+
+
+def test_lignes_de_la_partition_par_defaut_deplacees(par_jour):
+    moteur = MoteurEnregistreur(en_retard=4)
+    assert partitionnement.creer_partition(moteur, "production", JOUR) == 4
+    assert moteur.sql[2:] == [
+        "ALTER TABLE production DETACH PARTITION production_defaut",
+        "CREATE TABLE IF NOT EXISTS production_p20240601 PARTITION OF production "
+        "FOR VALUES FROM ('2024-06-01') TO ('2024-06-02')",
+        "INSERT INTO production_p20240601 SELECT * FROM production_defaut "
+        "WHERE timestamp >= :debut AND timestamp < :fin",
+        "DELETE FROM production_defaut WHERE timestamp >= :debut AND timestamp < :fin",
+        "ALTER TABLE production ATTACH PARTITION production_defaut DEFAULT",
+    ]
+
+
+def test_creer_partitions_ignore_les_partitions_existantes(par_jour, monkeypatch):
+    monkeypatch.setattr(partitionnement, "PARTITIONS_AVANCE", 2)
+    monkeypatch.setattr(partitionnement, "est_partitionnee", lambda moteur, table: table == "production")
+    monkeypatch.setattr(partitionnement, "partitions",
+                        lambda moteur, table: ["production_defaut", "production_p20240601"])
+    moteur = MoteurEnregistreur(en_retard=0)
+    assert partitionnement.creer_partitions(moteur, aujourd_hui=JOUR) == [
+        "production_p20240602", "production_p20240603"]
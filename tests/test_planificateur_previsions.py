@@ -0,0 +1,121 @@
+from datetime import datetime, date, time, timedelta
+
+import pytest
+
+import solcast_manager
+import stockage_previsions
+import planificateur_previsions as planificateur
+from fournisseur_local import FournisseurLocal
+from stockage_previsions import StockagePrevisions
+from solcast_manager import GestionnaireSolcast
+
+JOUR = date(2024, 6, 1)
+SITES = ["s1", "s2", "s3", "s4"]
+
+
+class HorlogeFigee(datetime):
+    """datetime.now() suit l'horloge simulée du test"""
+    instant = datetime.combine(JOUR, time(0, 0))
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.instant
+
+
+class FournisseurCompte(FournisseurLocal):
+    def __init__(self):
+        super().__init__()
+        self.appels = []
+
+    def previsions(self, api_key, site_id, debut, fin):
+        self.appels.append((api_key, site_id))
+        return super().previsions(api_key, site_id, debut, fin)
+
+
+@pytest.fixture
+def gestionnaires(tmp_path, monkeypatch):
+    """Installation historique et quatre sites de la flotte sur une seule clé API"""
+    monkeypatch.setattr(solcast_manager, "charger_cles_solcast", lambda: [("cle-partagee", "s0")])
+    monkeypatch.setattr(solcast_manager, "datetime", HorlogeFigee)
+    monkeypatch.setattr(stockage_previsions, "datetime", HorlogeFigee)
+    monkeypatch.setattr(HorlogeFigee, "instant", datetime.combine(JOUR, time(0, 0)))
+    stockage = StockagePrevisions(str(tmp_path / "cache.json"))
+    fournisseur = FournisseurCompte()
+    gestionnaires = {None: GestionnaireSolcast(stockage, fournisseur=fournisseur)}
+    for site in SITES:
+        gestionnaires[site] = GestionnaireSolcast(stockage, solcast_site_id=site, fournisseur=fournisseur)
+    monkeypatch.setattr(planificateur, "get_gestionnaire_solcast", lambda site=None: gestionnaires[site])
+    monkeypatch.setattr(planificateur, "APPELS_RESERVE", 1)
+    return gestionnaires
+
+
+def test_budgets_partagent_le_quota_de_chaque_cle(gestionnaires):
+    budgets = planificateur.calculer_budgets(SITES)
+    # 10 calls shared by 5 managers, minus the /forcer_prevision/ reserve of the default site
+    assert budgets == {None: 1, "s1": 2, "s2": 2, "s3": 2, "s4": 2}
+    assert sum(budgets.values()) + planificateur.APPELS_RESERVE <= gestionnaires[None].limite_appels_par_cle
+
+
+def test_budgets_cles_propres_et_partagees(monkeypatch, tmp_path):
+    monkeypatch.setattr(solcast_manager, "charger_cles_solcast", lambda: [("cle-A", "s1"), ("cle-B", "s2")])
+    stockage = StockagePrevisions(str(tmp_path / "cache.json"))
+    gestionnaires = {None: GestionnaireSolcast(stockage, fournisseur=FournisseurLocal())}
+    for site in ("s1", "s2", "s3"):
+        gestionnaires[site] = GestionnaireSolcast(stockage, solcast_site_id=site, fournisseur=FournisseurLocal())
+    monkeypatch.setattr(planificateur, "get_gestionnaire_solcast", lambda site=None: gestionnaires[site])
+    monkeypatch.setattr(planificateur, "APPELS_RESERVE", 1)
+    # s1 uses key A only, s2 key B only, s3 (not in .env) and the default site rotate on both
+    assert planificateur.calculer_budgets(["s1", "s2", "s3"]) == {None: 5, "s1": 3, "s2": 3, "s3": 6}
+
+
+def test_une_journee_de_creneaux_sur_une_cle_partagee(gestionnaires, caplog):
+    fournisseur = gestionnaires[None].fournisseur
+    budgets = planificateur.calculer_budgets(SITES)
+    # Running service: every cache holds the refresh of yesterday's last slot
+    veille = datetime.combine(JOUR, time(0, 0)) - timedelta(minutes=1)
+    for site, gestionnaire in gestionnaires.items():
+        with gestionnaire.stockage.modifier(gestionnaire.espace) as entree:
+            entree["derniere_mise_a_jour"] = planificateur.dernier_creneau(veille, budgets[site]).isoformat()
+
+    instant = datetime.combine(JOUR, time(0, 0))
+    while instant.date() == JOUR:
+        HorlogeFigee.instant = instant
+        planificateur.rafraichir_si_necessaire(planificateur.dernier_creneau(instant, budgets[None]))
+        planificateur.rafraichir_sites(instant, budgets)
+        instant = planificateur.prochain_rafraichissement(instant, budgets)
+
+    assert "Quota Solcast atteint" not in caplog.text
+    appels = {site: [a for a in fournisseur.appels if a[1] == (site or "s0")] for site in gestionnaires}
+    assert {site: len(a) for site, a in appels.items()} == budgets
+    # Every manager got its last (afternoon) slot of the day, and the reserve is still there
+    fin = datetime.combine(JOUR, time(23, 59))
+    for site, gestionnaire in gestionnaires.items():
+        assert gestionnaire.derniere_mise_a_jour == planificateur.dernier_creneau(fin, budgets[site]), site
+    assert all(gestionnaires[s].derniere_mise_a_jour.time() >= time(12, 0) for s in SITES)
+    assert gestionnaires[None].peut_appeler_api()
+    assert gestionnaires[None].appels_aujourd_hui == gestionnaires[None].limite_appels_par_cle - 1
+
+
+def test_cache_vide_rattrape_au_demarrage(gestionnaires):
+    HorlogeFigee.instant = datetime.combine(JOUR, time(3, 0))
+    assert planificateur.rafraichir_si_necessaire(planificateur.dernier_creneau(HorlogeFigee.instant, 1))
+    assert not planificateur.rafraichir_si_necessaire(planificateur.dernier_creneau(HorlogeFigee.instant, 1))
+
+
+def test_dernier_creneau_avant_le_premier_du_jour_reste_celui_de_la_veille(gestionnaires):
+    avant = planificateur.dernier_creneau(datetime.combine(JOUR, time(3, 0)), budget=2)
+    assert avant.date() == date(2024, 5, 31)
+    assert avant == planificateur.dernier_creneau(datetime.combine(date(2024, 5, 31), time(23, 59)), budget=2)
+    assert planificateur.dernier_creneau(datetime.combine(JOUR, time(3, 0)), budget=0) == datetime.combine(JOUR, time(0))
+
+
+def test_prochain_rafraichissement_tous_gestionnaires_confondus():
+    budgets = {None: 9, "s1": 2}
+    instant = datetime.combine(JOUR, time(0, 0))
+    suivants = []
+    while instant.date() == JOUR:
+        instant = planificateur.prochain_rafraichissement(instant, budgets)
+        suivants.append(instant)
+    attendus = sorted({datetime.combine(JOUR, h) for b in budgets.values() for h in planificateur.calculer_horaires(b)})
+    assert suivants[:-1] == attendus
+    assert suivants[-1].date() > JOUR
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+import requetes
+from requetes import (
+    creneau_epoch, fenetre_serie, pas_agregat, requete_serie, fusionner_series, formater_serie,
+    executer, requetes_tendances, formater_tendances, EPOCH, NB_CRENEAUX_MAX
+)
+from models import Production
+from schemas import MesuresData, ConsommationData
+from ingestion import enregistrer_mesures
+
+DEBUT = datetime(2024, 6, 1, 10, 0, 0)
+
+
+def epoch(instant: datetime) -> int:
+    return int((instant - EPOCH).total_seconds())
+
+
+def remplir(Session, nombre: int = 360, pas_s: int = 5):
+    """Une heure et demie de mesures (production croissante, une charge constante), agrégats compris"""
+    echantillons = [MesuresData(
+        production=float(i), soc_batterie=50.0, tension_batterie=52.0, courant_batterie=1.0,
+        consommations=[ConsommationData(charge_id=1, consommation=200.0)],
+        timestamp=DEBUT + timedelta(seconds=pas_s * i),
+    ) for i in range(nombre)]
+    with Session() as db:
+        enregistrer_mesures(db, echantillons)
+
+
+# --- creneau_epoch ------------------------------------------------------------
+
+def test_creneau_epoch_sqlite(Session):
+    instants = [DEBUT, DEBUT + timedelta(seconds=19), DEBUT + timedelta(seconds=20), DEBUT + timedelta(minutes=7)]
+    with Session() as db:
+        db.add_all(Production(timestamp=t, production=1.0) for t in instants)
+        db.commit()
+        creneaux = db.execute(select(creneau_epoch(Production.timestamp, 20)).order_by(Production.timestamp)).scalars().all()
+    assert creneaux == [epoch(DEBUT), epoch(DEBUT), epoch(DEBUT) + 20, epoch(DEBUT) + 420]
+
+
+# --- fenetre_serie --------------------------------------------------------------
+
+def test_fenetre_serie_garde_un_pas_suffisant():
+    assert fenetre_serie(DEBUT, DEBUT + timedelta(hours=1), 60, DEBUT) == (DEBUT, DEBUT + timedelta(hours=1), 60)
+
+
+def test_fenetre_serie_elargit_le_pas_au_pas_usuel_suivant():
+    debut, fin, pas = fenetre_serie(DEBUT, DEBUT + timedelta(days=7), 5, DEBUT)
+    assert pas in requetes.PAS_USUELS
+    assert (fin - debut).total_seconds() / pas <= NB_CRENEAUX_MAX
+
+
+def test_fenetre_serie_au_dela_des_pas_usuels_en_jours():
+    _, _, pas = fenetre_serie(DEBUT, DEBUT + timedelta(days=365 * 20), None, DEBUT)
+    assert pas % 86400 == 0
+
+
+def test_fenetre_serie_debut_par_defaut():
+    fin = DEBUT + timedelta(hours=2)
+    assert fenetre_serie(None, fin, None, DEBUT)[0] == DEBUT
+
+
+@pytest.mark.parametrize("debut, fin, pas", [
+    (DEBUT, DEBUT, None),
+    (DEBUT + timedelta(hours=1), DEBUT, None),
+    (DEBUT, DEBUT + timedelta(hours=1), 0),
+])
+def test_fenetre_serie_invalide(debut, fin, pas):
+    with pytest.raises(ValueError):
+        fenetre_serie(debut, fin, pas, DEBUT)
+
+
+# --- requete_serie ------------------------------------------------------------
+
+def test_requete_serie_mesures_brutes(Session):
+    remplir(Session, nombre=12)  # 60 s
+    assert pas_agregat(30) is None
+    with Session() as db:
+        lignes = db.execute(requete_serie("production", DEBUT, DEBUT + timedelta(minutes=1), 30)).all()
+    assert [tuple(l) for l in lignes] == [(epoch(DEBUT), 6, 15.0, 0.0, 5.0), (epoch(DEBUT) + 30, 6, 51.0, 6.0, 11.0)]
+
+
+def test_requete_serie_agregats_identique_aux_mesures_brutes(Session, monkeypatch):
+    remplir(Session)
+    debut, fin = DEBUT, DEBUT + timedelta(minutes=30)
+    assert pas_agregat(900) == 900
+    with Session() as db:
+        agregee = [tuple(l) for l in db.execute(requete_serie("production", debut, fin, 900))]
+        agregee_conso = [tuple(l) for l in db.execute(requete_serie("consommation", debut, fin, 300, id_charge=1))]
+        monkeypatch.setattr(requetes, "AGREGATS_ACTIFS", False)
+        assert pas_agregat(900) is None
+        brute = [tuple(l) for l in db.execute(requete_serie("production", debut, fin, 900))]
+        brute_conso = [tuple(l) for l in db.execute(requete_serie("consommation", debut, fin, 300, id_charge=1))]
+    assert agregee == brute
+    assert agregee_conso == brute_conso
+    assert [l[1] for l in brute] == [180, 180]
+
+
+def test_tendances_totaux_depuis_les_creneaux(Session):
+    remplir(Session)
+    debut, fin, pas = DEBUT, DEBUT + timedelta(minutes=30), 300
+    with Session() as db:
+        resultat = formater_tendances(executer(db, requetes_tendances(debut, fin, pas)), debut, fin, pas)
+    assert resultat["nombre_mesures_production"] == 360
+    assert resultat["production_moyenne_24h"] == pytest.approx(sum(range(360)) / 360)
+    assert resultat["consommation_moyenne_24h"] == 200.0
+    assert len(resultat["serie"]["production"]) == 6
+    assert resultat["serie"]["production"][0]["debut"] == DEBUT.isoformat()
+
+
+# --- Fusion (archives + base) --------------------------------------------------
+
+def test_fusionner_series_par_creneau():
+    a = [(0, 2, 10.0, 4.0, 6.0), (60, 1, 3.0, 3.0, 3.0)]
+    b = [(60, 2, 20.0, 1.0, 19.0), (120, 1, 5.0, 5.0, 5.0)]
+    assert fusionner_series(a, b) == [(0, 2, 10.0, 4.0, 6.0), (60, 3, 23.0, 1.0, 19.0), (120, 1, 5.0, 5.0, 5.0)]
+
+
+def test_formater_serie():
+    serie = formater_serie([(epoch(DEBUT), 4, 10.0, 1.0, 4.0), (epoch(DEBUT) + 60, 0, 0, None, None)])
+    assert serie[0] == {"debut": DEBUT.isoformat(), "nombre": 4, "moyenne": 2.5, "minimum": 1.0, "maximum": 4.0}
+    assert serie[1]["moyenne"] == 0